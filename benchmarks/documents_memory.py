@@ -0,0 +1,115 @@
+"""Пиковая память и время записи документов для длинных транскриптов.
+
+Сравнивает склеенную строку (format_results_* + save_text_to_*) с потоковой
+записью (documents.render_blocks_sync) на синтетических записях 1, 5 и 10 часов.
+Каждый прогон — в отдельном процессе, чтобы пик RSS не смешивался.
+
+    python -m benchmarks.documents_memory [--hours 1 5 10] [--formats .txt .docx .pdf] [--timeout 900]
+
+Для PDF потоковая запись ограничивает объекты абзацев, но reportlab держит
+сжатые готовые страницы до save(), поэтому +RSS у PDF всё же растёт с длиной.
+"""
+import argparse
+import logging
+import multiprocessing
+import os
+import queue as queue_module
+import random
+import resource
+import sys
+import tempfile
+import time
+
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "benchmark")
+os.environ.setdefault("ASSEMBLYAI_API_KEY", "benchmark")
+
+WORDS_PER_MINUTE = 150
+WORDS_PER_UTTERANCE = 30
+VOCABULARY = ("сегодня", "мы", "обсуждаем", "транскрибацию", "длинных", "записей", "и", "как", "это",
+              "работает", "на", "практике", "спикер", "говорит", "очень", "быстро", "вопрос", "ответ")
+
+
+def synthetic_transcript(hours: float, seed: int = 0):
+    from src.transcript import Transcript
+
+    rng = random.Random(seed)
+    total_words = int(hours * 60 * WORDS_PER_MINUTE)
+    ms_per_word = 60_000 // WORDS_PER_MINUTE
+
+    def utterances():
+        for index in range(0, total_words, WORDS_PER_UTTERANCE):
+            words = []
+            for w in range(index, min(index + WORDS_PER_UTTERANCE, total_words)):
+                start = w * ms_per_word
+                words.append([start, start + ms_per_word - 50, rng.choice(VOCABULARY)])
+            yield {"speaker": "ABC"[index // WORDS_PER_UTTERANCE % 3], "text": " ".join(w[2] for w in words),
+                   "start": words[0][0], "end": words[-1][1], "words": words}
+
+    return Transcript.from_segments(utterances())
+
+
+def _peak_rss_mb() -> float:
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _run(hours: float, ext: str, mode: str, queue):
+    logging.disable(logging.WARNING)  # предупреждения о шрифтах при импорте
+    from src import documents, services
+
+    transcript = synthetic_transcript(hours)
+    if ext == ".pdf":
+        documents.get_pdf_context()  # шрифты и стили — разовая стоимость процесса, не документа
+    baseline = _peak_rss_mb()
+    output = tempfile.NamedTemporaryFile(delete=False, suffix=ext).name
+    started = time.perf_counter()
+    try:
+        if mode == "joined":
+            documents._RENDERERS[ext](services.format_results_with_speakers(transcript), output)
+        else:
+            documents.render_blocks_sync(ext, services.iter_blocks_with_speakers, transcript, output)
+        elapsed = time.perf_counter() - started
+        queue.put((elapsed, _peak_rss_mb() - baseline, os.path.getsize(output), len(transcript)))
+    finally:
+        os.remove(output)
+
+
+def measure(hours: float, ext: str, mode: str, timeout: float) -> tuple[float, float, int, int]:
+    """Прогон в отдельном процессе; если он упал или не уложился в timeout — RuntimeError, а не зависание."""
+    context = multiprocessing.get_context("spawn")
+    queue = context.Queue()
+    process = context.Process(target=_run, args=(hours, ext, mode, queue))
+    process.start()
+    deadline = time.monotonic() + timeout
+    try:
+        while True:
+            try:
+                return queue.get(timeout=1)
+            except queue_module.Empty:
+                if not process.is_alive():
+                    raise RuntimeError(f"{hours:g} ч {ext} {mode}: процесс завершился с кодом {process.exitcode}")
+                if time.monotonic() > deadline:
+                    raise RuntimeError(f"{hours:g} ч {ext} {mode}: не уложился в {timeout:g} с")
+    finally:
+        if process.is_alive():
+            process.terminate()
+        process.join()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--hours", type=float, nargs="+", default=[1, 5, 10])
+    parser.add_argument("--formats", nargs="+", default=[".txt", ".docx", ".pdf"])
+    parser.add_argument("--timeout", type=float, default=900, help="секунд на один прогон")
+    args = parser.parse_args()
+
+    print(f"{'часы':>5} {'формат':>6} {'режим':>8} {'реплик':>7} {'время, с':>9} {'+RSS, МБ':>9} {'файл, МБ':>9}")
+    for hours in args.hours:
+        for ext in args.formats:
+            for mode in ("joined", "streamed"):
+                elapsed, rss, size, utterances = measure(hours, ext, mode, args.timeout)
+                print(f"{hours:>5g} {ext:>6} {mode:>8} {utterances:>7} {elapsed:>9.2f} {rss:>9.1f} {size / 1e6:>9.2f}")
+
+
+if __name__ == "__main__":
+    main()
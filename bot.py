@@ -1,10 +1,24 @@
 import asyncio
 import logging
+import signal
 from aiogram import Bot, Dispatcher, types
 
-from src.config import TELEGRAM_BOT_TOKEN
-from src.database import init_db
+from src import services
+from src.config import (
+    TELEGRAM_BOT_TOKEN, HTTP_METRICS_INTERVAL, ASSEMBLYAI_WEBHOOK_URL, TRANSCRIPT_CACHE_ENABLED,
+    JOB_SHUTDOWN_TIMEOUT, BOT_MODE
+)
+from src.database import init_db, close_db
 from src.handlers import register_handlers
+from src.jobs import scheduler
+from src.youtube import download_manager, metadata_probe
+from src.ui import progress_manager
+from src.telegram_outbox import outbox
+from src.documents import get_render_pool, shutdown_render_pool
+from src.http_clients import HttpClients
+from src.transcript_webhook import TranscriptWebhook
+from src.telegram_webhook import TelegramWebhook
+from src.transcript_cache import TranscriptCache
 
 # =============================
 #        Логирование
@@ -42,19 +56,80 @@ async def setup_commands(bot: Bot):
     except Exception as e:
         logger.warning(f"Не удалось установить кнопку меню: {e}")
 
+# =============================
+#        Режим webhook
+# =============================
+async def run_webhook(bot: Bot, dp: Dispatcher):
+    """Принимает обновления через webhook до SIGTERM/SIGINT, затем дообрабатывает принятые."""
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGTERM, signal.SIGINT):
+        try:
+            loop.add_signal_handler(sig, stop.set)
+        except NotImplementedError:  # Windows
+            pass
+
+    webhook = TelegramWebhook(bot, dp)
+    await dp.emit_startup(bot=bot)
+    await webhook.start()
+    try:
+        await stop.wait()
+        logger.info("Получен сигнал остановки, завершаю обработку принятых обновлений")
+    finally:
+        await webhook.drain(timeout=JOB_SHUTDOWN_TIMEOUT)
+        await dp.emit_shutdown(bot=bot)
+
 # =============================
 #            main
 # =============================
 async def main():
     bot = Bot(token=TELEGRAM_BOT_TOKEN)
+    bot.session.middleware(outbox)
     dp = Dispatcher()
 
+    http_clients = HttpClients()
+    services.set_http_clients(http_clients)
+    http_clients.start_metrics_logging(HTTP_METRICS_INTERVAL)
+
+    transcript_webhook = None
+    if ASSEMBLYAI_WEBHOOK_URL:
+        transcript_webhook = TranscriptWebhook()
+        await transcript_webhook.start()
+        services.set_transcript_webhook(transcript_webhook)
+
+    transcript_cache = None
+    if TRANSCRIPT_CACHE_ENABLED:
+        transcript_cache = TranscriptCache()
+        await transcript_cache.open()
+        services.set_transcript_cache(transcript_cache)
+
     await init_db()
+    scheduler.start()
+    get_render_pool()
     await setup_commands(bot)
     register_handlers(dp, bot)
 
-    logger.info("Бот запущен")
-    await dp.start_polling(bot)
+    logger.info(f"Бот запущен (режим {BOT_MODE})")
+    try:
+        if BOT_MODE == "webhook":
+            await run_webhook(bot, dp)
+        else:
+            # Оставшийся webhook (после режима webhook) ломает getUpdates с 409 Conflict
+            await bot.delete_webhook()
+            await dp.start_polling(bot)
+    finally:
+        await scheduler.stop(timeout=JOB_SHUTDOWN_TIMEOUT)
+        await download_manager.shutdown()
+        metadata_probe.shutdown()
+        await progress_manager.aclose()
+        await outbox.aclose()
+        shutdown_render_pool()
+        await close_db()
+        if transcript_cache:
+            transcript_cache.close()
+        if transcript_webhook:
+            await transcript_webhook.stop()
+        await http_clients.aclose()
 
 
 if __name__ == "__main__":
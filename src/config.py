@@ -84,6 +84,24 @@ FFMPEG_DIR = os.getenv("FFMPEG_PATH", "")
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN")
 ASSEMBLYAI_API_KEY = os.getenv("ASSEMBLYAI_API_KEY")
 OPENROUTER_API_KEYS = [key.strip() for key in os.getenv("OPENROUTER_API_KEYS", "").split(",") if key.strip()]
+# OpenRouter: таймаут запроса, хедж-запрос со вторым ключом (0 — выключен), предохранители ключей
+OPENROUTER_BASE_URL = os.getenv("OPENROUTER_BASE_URL", "https://openrouter.ai/api/v1")
+OPENROUTER_MODEL = os.getenv("OPENROUTER_MODEL", "z-ai/glm-4.5-air:free")
+OPENROUTER_TIMEOUT = float(os.getenv("OPENROUTER_TIMEOUT", "60"))
+OPENROUTER_HEDGE_DELAY = float(os.getenv("OPENROUTER_HEDGE_DELAY", "0"))
+OPENROUTER_FAILURE_THRESHOLD = int(os.getenv("OPENROUTER_FAILURE_THRESHOLD", "3"))
+OPENROUTER_COOLDOWN = float(os.getenv("OPENROUTER_COOLDOWN", "30"))
+# Оглавление длинных записей: бюджет токенов на фрагмент, параллельных запросов, кэш ответов
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "6000"))
+SUMMARY_CONCURRENCY = int(os.getenv("SUMMARY_CONCURRENCY", "4"))
+SUMMARY_CACHE_SIZE = int(os.getenv("SUMMARY_CACHE_SIZE", "512"))
+# Оглавление от LLM — необязательное дополнение к транскрипту с тайм-кодами
+SUMMARY_OUTLINE_ENABLED = os.getenv("SUMMARY_OUTLINE_ENABLED", "true").lower() in ("1", "true", "yes")
+# Субтитры по реальным тайм-кодам слов (srt | vtt), отправляются вместе с тайм-кодами
+SUBTITLE_FORMAT = os.getenv("SUBTITLE_FORMAT", "srt")
+SUBTITLE_MAX_CHARS = int(os.getenv("SUBTITLE_MAX_CHARS", "84"))
+SUBTITLE_LINE_WIDTH = int(os.getenv("SUBTITLE_LINE_WIDTH", "42"))
+SUBTITLE_MAX_DURATION_MS = int(os.getenv("SUBTITLE_MAX_DURATION_MS", "7000"))
 
 # Опционально: включение/выключение платежей
 ENABLE_PAYMENTS = os.getenv("ENABLE_PAYMENTS", "false").lower() in ("1", "true", "yes")
@@ -114,6 +132,10 @@ missing = [k for k in required_base if not os.getenv(k)]
 if ENABLE_PAYMENTS:
     missing += [k for k in required_payments if not os.getenv(k)]
 
+if os.getenv("BOT_MODE", "polling").lower() == "webhook":
+    # Секрет общий для всех экземпляров: set_webhook каждого перезаписывает его у Telegram
+    missing += [k for k in ("TELEGRAM_WEBHOOK_URL", "TELEGRAM_WEBHOOK_SECRET") if not os.getenv(k)]
+
 if missing:
     raise ValueError(f"Отсутствуют переменные окружения: {', '.join(sorted(set(missing)))}")
 
@@ -122,16 +144,119 @@ if missing:
 # =============================
 ADMIN_USER_IDS = [5628988881]
 
-ASSEMBLYAI_BASE_URL = "https://api.assemblyai.com/v2"
+ASSEMBLYAI_BASE_URL = os.getenv("ASSEMBLYAI_BASE_URL", "https://api.assemblyai.com/v2")
 HEADERS = {"authorization": ASSEMBLYAI_API_KEY}
 SEGMENT_DURATION = 60
 MESSAGE_CHUNK_SIZE = 4000
 API_TIMEOUT = 300
+UPLOAD_CHUNK_SIZE = int(os.getenv("UPLOAD_CHUNK_SIZE", str(1024 * 1024)))  # байт на кусок при загрузке
 FREE_USER_FILE_LIMIT = 1_000_000_000
 PAID_USER_FILE_LIMIT = 2_000_000_000
 SUBSCRIPTION_DURATION_DAYS = 30
 SUBSCRIPTION_AMOUNT = int(PAYMENT_AMOUNT)
 
+# База данных пользователей (SQLite в режиме WAL)
+DB_PATH = os.getenv("DB_PATH", "users.db")
+DB_READ_POOL_SIZE = int(os.getenv("DB_READ_POOL_SIZE", "4"))
+# Кэш прав доступа пользователей (trials_used, is_paid, subscription_expiry)
+ENTITLEMENT_CACHE_SIZE = int(os.getenv("ENTITLEMENT_CACHE_SIZE", "10000"))
+ENTITLEMENT_CACHE_TTL = float(os.getenv("ENTITLEMENT_CACHE_TTL", "300"))
+# Отложенная запись: сброс очереди раз в N мс или при N пользователях в очереди
+DB_FLUSH_INTERVAL_MS = int(os.getenv("DB_FLUSH_INTERVAL_MS", "200"))
+DB_FLUSH_MAX_ROWS = int(os.getenv("DB_FLUSH_MAX_ROWS", "500"))
+# Кэш готовых транскриптов по хэшу аудио / ID видео YouTube (отдельный файл SQLite)
+TRANSCRIPT_CACHE_ENABLED = os.getenv("TRANSCRIPT_CACHE_ENABLED", "true").lower() in ("1", "true", "yes")
+TRANSCRIPT_CACHE_PATH = os.getenv("TRANSCRIPT_CACHE_PATH", "transcripts_cache.db")
+TRANSCRIPT_CACHE_MAX_MB = float(os.getenv("TRANSCRIPT_CACHE_MAX_MB", "200"))
+
+# Общие HTTP-клиенты для внешних API (AssemblyAI, YooMoney, OpenRouter)
+HTTP_MAX_CONNECTIONS = int(os.getenv("HTTP_MAX_CONNECTIONS", "100"))
+HTTP_MAX_KEEPALIVE_CONNECTIONS = int(os.getenv("HTTP_MAX_KEEPALIVE_CONNECTIONS", "20"))
+HTTP_KEEPALIVE_EXPIRY = float(os.getenv("HTTP_KEEPALIVE_EXPIRY", "60"))
+HTTP2_ENABLED = os.getenv("HTTP2_ENABLED", "true").lower() in ("1", "true", "yes")
+HTTP_METRICS_INTERVAL = int(os.getenv("HTTP_METRICS_INTERVAL", "300"))  # секунд, 0 — не логировать
+
+# Ожидание готовности транскрипта: оценка по длительности, backoff с jitter, жёсткий таймаут
+TRANSCRIBE_TIMEOUT = int(os.getenv("TRANSCRIBE_TIMEOUT", str(4 * 3600)))  # секунд
+TRANSCRIBE_SPEED_RATIO = float(os.getenv("TRANSCRIBE_SPEED_RATIO", "0.05"))  # секунд обработки на секунду аудио
+POLL_INITIAL_DELAY = float(os.getenv("POLL_INITIAL_DELAY", "3"))
+POLL_MAX_DELAY = float(os.getenv("POLL_MAX_DELAY", "30"))
+POLL_BACKOFF_FACTOR = float(os.getenv("POLL_BACKOFF_FACTOR", "1.5"))
+POLL_JITTER = float(os.getenv("POLL_JITTER", "0.2"))
+# Необязательный webhook AssemblyAI: публичный адрес, по которому доступен локальный эндпоинт
+ASSEMBLYAI_WEBHOOK_URL = os.getenv("ASSEMBLYAI_WEBHOOK_URL", "")
+ASSEMBLYAI_WEBHOOK_HOST = os.getenv("ASSEMBLYAI_WEBHOOK_HOST", "0.0.0.0")
+ASSEMBLYAI_WEBHOOK_PORT = int(os.getenv("ASSEMBLYAI_WEBHOOK_PORT", "8081"))
+ASSEMBLYAI_WEBHOOK_SECRET = os.getenv("ASSEMBLYAI_WEBHOOK_SECRET", "")
+POLL_WEBHOOK_FALLBACK_DELAY = float(os.getenv("POLL_WEBHOOK_FALLBACK_DELAY", "120"))
+
+# Режим получения обновлений Telegram: polling (по умолчанию) или webhook. Процесс в Procfile один,
+# режим выбирается только здесь; polling при старте снимает webhook, оставшийся от режима webhook
+BOT_MODE = os.getenv("BOT_MODE", "polling").lower()
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "")  # публичный https-адрес, без пути
+TELEGRAM_WEBHOOK_HOST = os.getenv("TELEGRAM_WEBHOOK_HOST", "0.0.0.0")
+TELEGRAM_WEBHOOK_PORT = int(os.getenv("PORT", os.getenv("TELEGRAM_WEBHOOK_PORT", "8080")))
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+TELEGRAM_WEBHOOK_WORKERS = int(os.getenv("TELEGRAM_WEBHOOK_WORKERS", "16"))
+TELEGRAM_WEBHOOK_QUEUE = int(os.getenv("TELEGRAM_WEBHOOK_QUEUE", "1000"))
+
+# Очередь транскрибаций: воркеры, размер очереди, заданий на пользователя
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_QUEUE_SIZE = int(os.getenv("JOB_QUEUE_SIZE", "100"))
+JOB_PER_USER_LIMIT = int(os.getenv("JOB_PER_USER_LIMIT", "2"))
+JOB_SHUTDOWN_TIMEOUT = float(os.getenv("JOB_SHUTDOWN_TIMEOUT", "60"))
+
+# Процессы для рендеринга PDF/DOCX (0 — рендерить в потоке)
+RENDER_PROCESSES = int(os.getenv("RENDER_PROCESSES", "2"))
+# Сколько абзацев PDF держать в памяти при потоковой вёрстке (страница за страницей)
+PDF_FLOWABLE_BUFFER = int(os.getenv("PDF_FLOWABLE_BUFFER", "64"))
+
+# Приём аудио: поток из Telegram сразу в ffmpeg, выход — компактный речевой профиль
+SPEECH_AUDIO_FORMAT = os.getenv("SPEECH_AUDIO_FORMAT", "opus")  # opus | mp3
+SPEECH_SAMPLE_RATE = int(os.getenv("SPEECH_SAMPLE_RATE", "16000"))
+SPEECH_AUDIO_BITRATE = os.getenv("SPEECH_AUDIO_BITRATE", "32k")
+TELEGRAM_DOWNLOAD_TIMEOUT = int(os.getenv("TELEGRAM_DOWNLOAD_TIMEOUT", "300"))
+TELEGRAM_DOWNLOAD_CHUNK_SIZE = int(os.getenv("TELEGRAM_DOWNLOAD_CHUNK_SIZE", str(256 * 1024)))
+# Кодеки, которые отправляются в AssemblyAI без перекодирования (как есть или с копированием потока)
+AUDIO_PASSTHROUGH_CODECS = [c.strip() for c in os.getenv("AUDIO_PASSTHROUGH_CODECS", "mp3,opus,vorbis,aac").split(",") if c.strip()]
+AUDIO_PASSTHROUGH_MAX_CHANNELS = int(os.getenv("AUDIO_PASSTHROUGH_MAX_CHANNELS", "2"))
+AUDIO_PASSTHROUGH_MAX_SAMPLE_RATE = int(os.getenv("AUDIO_PASSTHROUGH_MAX_SAMPLE_RATE", "48000"))
+
+# YouTube: самая компактная аудиодорожка (opus/aac) без перекодирования в MP3
+YOUTUBE_AUDIO_PASSTHROUGH = os.getenv("YOUTUBE_AUDIO_PASSTHROUGH", "true").lower() in ("1", "true", "yes")
+YOUTUBE_AUDIO_MIN_ABR = int(os.getenv("YOUTUBE_AUDIO_MIN_ABR", "32"))  # кбит/с — ниже речь распознаётся хуже
+YOUTUBE_CONCURRENT_FRAGMENTS = int(os.getenv("YOUTUBE_CONCURRENT_FRAGMENTS", "4"))
+# Метаданные видео (длительность, размер, форматы) проверяются до скачивания и кэшируются по ID видео
+YOUTUBE_METADATA_TTL = float(os.getenv("YOUTUBE_METADATA_TTL", "600"))  # секунд; ссылки на форматы живут ~6 ч
+YOUTUBE_METADATA_CACHE_SIZE = int(os.getenv("YOUTUBE_METADATA_CACHE_SIZE", "256"))
+YOUTUBE_PROBE_WORKERS = int(os.getenv("YOUTUBE_PROBE_WORKERS", "2"))  # свой пул: не ждут за скачиваниями
+# Лимиты длительности видео по ссылке, секунды
+FREE_USER_MAX_DURATION = int(os.getenv("FREE_USER_MAX_DURATION", str(3 * 3600)))
+PAID_USER_MAX_DURATION = int(os.getenv("PAID_USER_MAX_DURATION", str(12 * 3600)))
+# Отдельный пул для скачиваний yt-dlp: одновременно качается не больше N видео
+YOUTUBE_DOWNLOAD_WORKERS = int(os.getenv("YOUTUBE_DOWNLOAD_WORKERS", "3"))
+YOUTUBE_DOWNLOAD_QUEUE = int(os.getenv("YOUTUBE_DOWNLOAD_QUEUE", "20"))
+
+# Прогресс-бары: не чаще раза в N секунд на сообщение и не больше M правок в секунду на весь бот
+PROGRESS_MIN_INTERVAL = float(os.getenv("PROGRESS_MIN_INTERVAL", "3"))
+PROGRESS_EDITS_PER_SECOND = float(os.getenv("PROGRESS_EDITS_PER_SECOND", "10"))
+PROGRESS_IDLE_TIMEOUT = float(os.getenv("PROGRESS_IDLE_TIMEOUT", "300"))  # забыть сообщение без событий
+
+# Исходящие запросы к Bot API: общий лимит бота, лимит на чат (в группах строже), повторы после 429
+TELEGRAM_GLOBAL_RATE = float(os.getenv("TELEGRAM_GLOBAL_RATE", "25"))  # запросов в секунду
+TELEGRAM_CHAT_RATE = float(os.getenv("TELEGRAM_CHAT_RATE", "1"))
+TELEGRAM_CHAT_BURST = int(os.getenv("TELEGRAM_CHAT_BURST", "3"))
+TELEGRAM_GROUP_RATE = float(os.getenv("TELEGRAM_GROUP_RATE", str(20 / 60)))
+TELEGRAM_PROGRESS_MAX_AGE = float(os.getenv("TELEGRAM_PROGRESS_MAX_AGE", "15"))  # секунд в очереди
+TELEGRAM_MAX_RETRIES = int(os.getenv("TELEGRAM_MAX_RETRIES", "3"))
+
+# Параллельная транскрибация длинных записей по фрагментам
+TRANSCRIBE_CHUNKED = os.getenv("TRANSCRIBE_CHUNKED", "true").lower() in ("1", "true", "yes")
+TRANSCRIBE_CHUNK_THRESHOLD = int(os.getenv("TRANSCRIBE_CHUNK_THRESHOLD", "1800"))  # секунд
+TRANSCRIBE_CHUNK_DURATION = int(os.getenv("TRANSCRIBE_CHUNK_DURATION", "600"))  # секунд
+TRANSCRIBE_CHUNK_OVERLAP = float(os.getenv("TRANSCRIBE_CHUNK_OVERLAP", "30"))  # секунд общего звука у соседних фрагментов
+TRANSCRIBE_CHUNK_CONCURRENCY = int(os.getenv("TRANSCRIBE_CHUNK_CONCURRENCY", "4"))
+
 # Поддерживаемые форматы выдачи
 SUPPORTED_FORMATS = {
     "google": {"ext": ".docx", "label": "Google Docs", "cb": "set_format_google"},
@@ -144,3 +269,4 @@ DEFAULT_FORMAT = "pdf"
 
 # Расширяем PATH, если FFMPEG_DIR задан вручную (но обычно не требуется)
 FFMPEG_PATH = os.getenv("FFMPEG_PATH", "/usr/bin/ffmpeg")
+FFPROBE_PATH = os.getenv("FFPROBE_PATH", os.path.join(os.path.dirname(FFMPEG_PATH), "ffprobe"))
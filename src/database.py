@@ -1,27 +1,375 @@
 import sqlite3
 import time
 import logging
-from asyncio import Lock
-from .config import SUBSCRIPTION_DURATION_DAYS, ADMIN_USER_IDS
+import asyncio
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from .config import (
+    SUBSCRIPTION_DURATION_DAYS, ADMIN_USER_IDS, DB_PATH, DB_READ_POOL_SIZE,
+    ENTITLEMENT_CACHE_SIZE, ENTITLEMENT_CACHE_TTL, DB_FLUSH_INTERVAL_MS, DB_FLUSH_MAX_ROWS
+)
 
 logger = logging.getLogger(__name__)
-db_lock = Lock()
 
-async def init_db():
-    async with db_lock:
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        cursor.execute('''
+# =============================
+#          SQL-запросы
+# =============================
+# Тексты запросов неизменны, поэтому sqlite3 кэширует их подготовленные
+# версии на каждом соединении (cached_statements).
+CREATE_USERS_SQL = '''
             CREATE TABLE IF NOT EXISTS users (
                 user_id INTEGER PRIMARY KEY,
                 trials_used INTEGER DEFAULT 0,
                 is_paid BOOLEAN DEFAULT FALSE,
                 subscription_expiry INTEGER DEFAULT 0
             )
-        ''')
-        conn.commit()
-        conn.close()
-        logger.info("База данных инициализирована")
+        '''
+SELECT_USER_SQL = 'SELECT trials_used, is_paid, subscription_expiry FROM users WHERE user_id = ?'
+INSERT_USER_SQL = 'INSERT OR IGNORE INTO users (user_id, trials_used, is_paid, subscription_expiry) VALUES (?, 0, FALSE, 0)'
+ADD_TRIALS_SQL = 'UPDATE users SET trials_used = trials_used + ? WHERE user_id = ?'
+SET_SUBSCRIPTION_SQL = 'UPDATE users SET is_paid = ?, subscription_expiry = ? WHERE user_id = ?'
+
+
+# =============================
+#        Движок SQLite
+# =============================
+class Database:
+    """Долгоживущие соединения SQLite в режиме WAL, работающие вне event loop.
+
+    Запись идёт через один выделенный поток (одно соединение), чтение —
+    через небольшой пул потоков, у каждого из которых своё соединение.
+    В режиме WAL читатели не блокируют писателя и друг друга, поэтому
+    глобальная блокировка вокруг чтения не нужна.
+    """
+
+    def __init__(self, path: str = DB_PATH, read_pool_size: int = DB_READ_POOL_SIZE):
+        self.path = path
+        self.read_pool_size = max(1, read_pool_size)
+        self._local = threading.local()
+        self._connections: list[sqlite3.Connection] = []
+        self._connections_lock = threading.Lock()
+        self._writer: ThreadPoolExecutor | None = None
+        self._readers: ThreadPoolExecutor | None = None
+
+    def _connection(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=64)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA busy_timeout=5000")
+            self._local.conn = conn
+            with self._connections_lock:
+                self._connections.append(conn)
+        return conn
+
+    def _executor(self, write: bool) -> ThreadPoolExecutor:
+        if write:
+            if self._writer is None:
+                self._writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db-writer")
+            return self._writer
+        if self._readers is None:
+            self._readers = ThreadPoolExecutor(max_workers=self.read_pool_size, thread_name_prefix="db-reader")
+        return self._readers
+
+    async def _run(self, write: bool, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor(write), self._call, write, func, args)
+
+    def _call(self, write: bool, func, args):
+        conn = self._connection()
+        if not write:
+            return func(conn, *args)
+        try:
+            result = func(conn, *args)
+            conn.commit()
+            return result
+        except Exception:
+            conn.rollback()
+            raise
+
+    async def read(self, func, *args):
+        """Выполняет func(conn, *args) в пуле читателей."""
+        return await self._run(False, func, *args)
+
+    async def write(self, func, *args):
+        """Выполняет func(conn, *args) в потоке писателя и фиксирует транзакцию."""
+        return await self._run(True, func, *args)
+
+    async def fetchone(self, sql: str, params: tuple = ()):
+        return await self.read(lambda conn: conn.execute(sql, params).fetchone())
+
+    async def execute(self, sql: str, params: tuple = ()):
+        return await self.write(lambda conn: conn.execute(sql, params).rowcount)
+
+    def close(self):
+        """Останавливает потоки и закрывает все соединения. Движок можно открыть повторно."""
+        for executor in (self._writer, self._readers):
+            if executor is not None:
+                executor.shutdown(wait=True)
+        self._writer = None
+        self._readers = None
+        with self._connections_lock:
+            for conn in self._connections:
+                try:
+                    conn.close()
+                except sqlite3.Error as e:
+                    logger.warning(f"Ошибка закрытия соединения с БД: {e}")
+            self._connections.clear()
+        self._local = threading.local()
+
+
+# =============================
+#      Кэш прав доступа
+# =============================
+class EntitlementCache:
+    """LRU-кэш строк (trials_used, is_paid, subscription_expiry) с TTL.
+
+    Срок подписки хранится в записи и проверяется локально, поэтому
+    истечение подписки учитывается точно, без обращения к SQLite.
+    Пока изменения пользователя ждут записи в БД, его строка закреплена
+    (pin): она не вытесняется, не устаревает и является источником истины.
+    Любое закрепление увеличивает generation, так что чтение из БД,
+    начатое раньше, уже не сможет положить в кэш устаревшую строку.
+    """
+
+    def __init__(self, maxsize: int = ENTITLEMENT_CACHE_SIZE, ttl: float = ENTITLEMENT_CACHE_TTL):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.generation = 0
+        self._entries: OrderedDict[int, tuple[float, tuple[int, bool, int]]] = OrderedDict()
+        self._pinned: set[int] = set()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, user_id: int):
+        entry = self._entries.get(user_id)
+        if entry is None:
+            return None
+        stored_at, row = entry
+        if user_id not in self._pinned and time.monotonic() - stored_at > self.ttl:
+            del self._entries[user_id]
+            return None
+        self._entries.move_to_end(user_id)
+        return row
+
+    def put(self, user_id: int, row: tuple[int, bool, int], generation: int | None = None):
+        if generation is not None and generation != self.generation:
+            return
+        if user_id in self._pinned:
+            return
+        self._store(user_id, row)
+
+    def pin(self, user_id: int, row: tuple[int, bool, int]):
+        self.generation += 1
+        self._pinned.add(user_id)
+        self._store(user_id, row)
+
+    def unpin(self, user_id: int):
+        self._pinned.discard(user_id)
+        entry = self._entries.get(user_id)
+        if entry is not None:
+            self._entries[user_id] = (time.monotonic(), entry[1])
+        self._evict()
+
+    def invalidate(self, user_id: int | None = None):
+        self.generation += 1
+        if user_id is None:
+            for key in [k for k in self._entries if k not in self._pinned]:
+                del self._entries[key]
+        elif user_id not in self._pinned:
+            self._entries.pop(user_id, None)
+
+    def _store(self, user_id: int, row: tuple[int, bool, int]):
+        self._entries[user_id] = (time.monotonic(), row)
+        self._entries.move_to_end(user_id)
+        self._evict()
+
+    def _evict(self):
+        for _ in range(len(self._entries)):
+            if len(self._entries) <= self.maxsize:
+                break
+            user_id, entry = self._entries.popitem(last=False)
+            if user_id in self._pinned:
+                self._entries[user_id] = entry
+
+
+# =============================
+#   Отложенная запись в БД
+# =============================
+class WriteBehindQueue:
+    """Очередь отложенной записи (write-behind) для таблицы users.
+
+    Изменения одного пользователя склеиваются (вставка, сумма прибавок
+    trials_used, последнее состояние подписки) и записываются одной
+    транзакцией раз в flush_interval секунд или как только набралось
+    max_rows пользователей. До записи строка пользователя закреплена
+    в кэше прав доступа, поэтому чтения видят изменения сразу.
+    """
+
+    def __init__(self, engine: Database, cache: EntitlementCache,
+                 flush_interval: float = DB_FLUSH_INTERVAL_MS / 1000,
+                 max_rows: int = DB_FLUSH_MAX_ROWS):
+        self.engine = engine
+        self.cache = cache
+        self.flush_interval = flush_interval
+        self.max_rows = max(1, max_rows)
+        self._pending: dict[int, dict] = {}
+        self._waiters: list[asyncio.Future] = []
+        self._wakeup = asyncio.Event()
+        self._flush_lock = asyncio.Lock()
+        self._task: asyncio.Task | None = None
+
+    def __len__(self):
+        return len(self._pending)
+
+    def _enqueue(self, user_id: int, row: tuple[int, bool, int],
+                 insert: bool = False, trials: int = 0, subscription: tuple[bool, int] | None = None):
+        op = self._pending.setdefault(user_id, {"insert": False, "trials": 0, "subscription": None})
+        op["insert"] = op["insert"] or insert
+        op["trials"] += trials
+        if subscription is not None:
+            op["subscription"] = subscription
+        self.cache.pin(user_id, row)
+        if len(self._pending) >= self.max_rows:
+            self._wakeup.set()
+
+    def insert_user(self, user_id: int):
+        self._enqueue(user_id, (0, False, 0), insert=True)
+
+    def increment_trials(self, user_id: int, row: tuple[int, bool, int]):
+        self._enqueue(user_id, (row[0] + 1, row[1], row[2]), trials=1)
+
+    def set_subscription(self, user_id: int, row: tuple[int, bool, int], is_paid: bool, expiry: int):
+        self._enqueue(user_id, (row[0], is_paid, expiry), subscription=(is_paid, expiry))
+
+    async def wait_flushed(self):
+        """Ждёт, пока всё поставленное в очередь до этого момента окажется в БД."""
+        if not self._pending:
+            return
+        if self._task is None:
+            await self.flush()
+            return
+        waiter = asyncio.get_running_loop().create_future()
+        self._waiters.append(waiter)
+        self._wakeup.set()
+        await waiter
+
+    @staticmethod
+    def _apply(conn: sqlite3.Connection, batch: dict[int, dict]):
+        conn.executemany(INSERT_USER_SQL, [(uid,) for uid, op in batch.items() if op["insert"]])
+        conn.executemany(ADD_TRIALS_SQL, [(op["trials"], uid) for uid, op in batch.items() if op["trials"]])
+        conn.executemany(SET_SUBSCRIPTION_SQL, [
+            (op["subscription"][0], op["subscription"][1], uid)
+            for uid, op in batch.items() if op["subscription"] is not None
+        ])
+
+    async def flush(self) -> int:
+        """Записывает накопленные изменения одной транзакцией. Возвращает число пользователей."""
+        async with self._flush_lock:
+            if not self._pending:
+                return 0
+            batch, waiters = self._pending, self._waiters
+            self._pending, self._waiters = {}, []
+            try:
+                await self.engine.write(self._apply, batch)
+            except Exception as e:
+                logger.error(f"Не удалось записать {len(batch)} изменений в БД, повторю позже: {e}")
+                for user_id, op in self._pending.items():
+                    old = batch.setdefault(user_id, {"insert": False, "trials": 0, "subscription": None})
+                    old["insert"] = old["insert"] or op["insert"]
+                    old["trials"] += op["trials"]
+                    if op["subscription"] is not None:
+                        old["subscription"] = op["subscription"]
+                self._pending = batch
+                self._waiters = waiters + self._waiters
+                raise
+            for user_id in batch:
+                if user_id not in self._pending:
+                    self.cache.unpin(user_id)
+            for waiter in waiters:
+                if not waiter.done():
+                    waiter.set_result(None)
+            logger.debug(f"Записано изменений пользователей: {len(batch)}")
+            return len(batch)
+
+    async def _run(self):
+        while True:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self.flush_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                await asyncio.sleep(self.flush_interval)
+
+    def start(self):
+        if self._task is None:
+            self._wakeup = asyncio.Event()
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        """Останавливает фоновую запись и гарантированно сбрасывает остаток очереди."""
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        try:
+            await self.flush()
+        except Exception as e:
+            for waiter in self._waiters:
+                if not waiter.done():
+                    waiter.set_exception(e)
+            self._waiters = []
+            raise
+
+
+engine = Database()
+entitlements = EntitlementCache()
+writes = WriteBehindQueue(engine, entitlements)
+
+
+async def init_db():
+    await engine.execute(CREATE_USERS_SQL)
+    writes.start()
+    logger.info("База данных инициализирована")
+
+
+async def flush_db():
+    await writes.flush()
+
+
+async def close_db():
+    try:
+        await writes.stop()
+    finally:
+        await asyncio.get_running_loop().run_in_executor(None, engine.close)
+    logger.info("Соединения с базой данных закрыты")
+
+
+async def _load_entitlements(user_id: int) -> tuple[int, bool, int]:
+    row = entitlements.get(user_id)
+    if row is not None:
+        return row
+    generation = entitlements.generation
+    db_row = await engine.fetchone(SELECT_USER_SQL, (user_id,))
+    # Пока шло чтение, строку мог закрепить конкурентный запрос
+    row = entitlements.get(user_id)
+    if row is not None:
+        return row
+    if db_row is None:
+        writes.insert_user(user_id)
+        return 0, False, 0
+    row = (db_row[0], bool(db_row[1]), db_row[2])
+    entitlements.put(user_id, row, generation)
+    return row
 
 
 async def check_user_trials(user_id: int) -> tuple[bool, bool]:
@@ -29,46 +377,28 @@ async def check_user_trials(user_id: int) -> tuple[bool, bool]:
         logger.info(f"User {user_id} is an admin, granting full access.")
         return True, True
 
-    async with db_lock:
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        cursor.execute('SELECT trials_used, is_paid, subscription_expiry FROM users WHERE user_id = ?', (user_id,))
-        row = cursor.fetchone()
-        if row is None:
-            cursor.execute('INSERT INTO users (user_id, trials_used, is_paid, subscription_expiry) VALUES (?, 0, FALSE, 0)', (user_id,))
-            conn.commit()
-            trials_used = 0
-            is_paid = False
-        else:
-            trials_used, is_paid, subscription_expiry = row
-            if is_paid and subscription_expiry > 0 and time.time() > subscription_expiry:
-                is_paid = False
-                cursor.execute('UPDATE users SET is_paid = FALSE, subscription_expiry = 0 WHERE user_id = ?', (user_id,))
-                conn.commit()
-                logger.info(f"Подписка для user_id {user_id} истекла")
-        conn.close()
-        can_use = is_paid or trials_used < 2
-        logger.info(f"User {user_id}: can_use={can_use}, is_paid={is_paid}, trials_used={trials_used}")
-        return can_use, is_paid
+    row = await _load_entitlements(user_id)
+    trials_used, is_paid, subscription_expiry = row
+    if is_paid and subscription_expiry > 0 and time.time() > subscription_expiry:
+        is_paid = False
+        writes.set_subscription(user_id, row, False, 0)
+        logger.info(f"Подписка для user_id {user_id} истекла")
+    can_use = is_paid or trials_used < 2
+    logger.info(f"User {user_id}: can_use={can_use}, is_paid={is_paid}, trials_used={trials_used}")
+    return can_use, is_paid
 
 
 async def increment_trials(user_id: int):
-    async with db_lock:
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        cursor.execute('UPDATE users SET trials_used = trials_used + 1 WHERE user_id = ?', (user_id,))
-        conn.commit()
-        conn.close()
-        logger.info(f"Попытки для user {user_id} обновлены")
+    row = await _load_entitlements(user_id)
+    writes.increment_trials(user_id, row)
+    logger.info(f"Попытки для user {user_id} обновлены")
 
 
 async def activate_subscription(user_id: int):
-    async with db_lock:
-        conn = sqlite3.connect('users.db')
-        cursor = conn.cursor()
-        expiry_time = int(time.time()) + SUBSCRIPTION_DURATION_DAYS * 24 * 60 * 60
-        cursor.execute('UPDATE users SET is_paid = TRUE, subscription_expiry = ? WHERE user_id = ?', (expiry_time, user_id))
-        conn.commit()
-        conn.close()
-        logger.info(f"Подписка активирована для user_id {user_id} до {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expiry_time))}")
-        return expiry_time
+    expiry_time = int(time.time()) + SUBSCRIPTION_DURATION_DAYS * 24 * 60 * 60
+    row = await _load_entitlements(user_id)
+    writes.set_subscription(user_id, row, True, expiry_time)
+    # Оплата должна быть в БД до того, как пользователь увидит подтверждение
+    await writes.wait_flushed()
+    logger.info(f"Подписка активирована для user_id {user_id} до {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(expiry_time))}")
+    return expiry_time
@@ -0,0 +1,336 @@
+import asyncio
+import functools
+import io
+import itertools
+import logging
+import multiprocessing
+import os
+import re
+import threading
+import unicodedata
+import zipfile
+from typing import NamedTuple
+from xml.sax.saxutils import escape
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+from .config import FONT_PATH, RENDER_PROCESSES, PDF_FLOWABLE_BUFFER
+
+logger = logging.getLogger(__name__)
+
+
+# =============================
+#     Контекст рендеринга PDF
+# =============================
+# reportlab и TTF-шрифты загружаются при первом PDF, а не при импорте модуля:
+# бот и тесты, которые PDF не строят, за них не платят. Дальше контекст
+# живёт до конца процесса и переиспользуется всеми документами.
+PDF_MARGIN = 50
+
+# По предпочтению: NotoSans — лучшая поддержка кириллицы/Unicode, затем Arial, затем DejaVu
+_PDF_FONT_FILES = (
+    ("NotoSans", "NotoSans-Regular.ttf"),
+    ("Arial", "arial.ttf"),
+    ("DejaVu", None),  # FONT_PATH
+)
+# Встроенные шрифты на случай, если ни одного TTF нет
+_PDF_FALLBACK_FONTS = ('Times-Roman', 'Courier', 'Times-Bold', 'Courier-Bold')
+
+
+class PdfContext(NamedTuple):
+    font_name: str
+    style: "ParagraphStyle"  # общий для всех документов, не изменяется
+    page_size: tuple[float, float]
+
+
+def _register_pdf_font() -> str:
+    """Регистрирует первый найденный TTF-шрифт из _PDF_FONT_FILES и возвращает его имя."""
+    from reportlab.pdfbase import pdfmetrics
+    from reportlab.pdfbase.ttfonts import TTFont
+
+    for name, filename in _PDF_FONT_FILES:
+        path = os.path.join(os.path.dirname(FONT_PATH), filename) if filename else FONT_PATH
+        if not os.path.exists(path):
+            logger.warning(f"{name} font not found: {path}")
+            continue
+        try:
+            if name not in pdfmetrics.getRegisteredFontNames():
+                pdfmetrics.registerFont(TTFont(name, path))
+            logger.info(f"Successfully registered {name} font: {path}")
+            return name
+        except Exception as e:
+            logger.error(f"Failed to register {name} font: {e}")
+    available_fonts = pdfmetrics.getRegisteredFontNames()
+    font_name = next((f for f in _PDF_FALLBACK_FONTS if f in available_fonts), 'Times-Roman')
+    logger.warning(f"Custom fonts unavailable, using default font {font_name}")
+    return font_name
+
+
+@functools.lru_cache(maxsize=None)
+def get_pdf_context() -> PdfContext:
+    """Шрифт и стиль абзаца — один раз на процесс."""
+    from reportlab.lib.pagesizes import A4
+    from reportlab.lib.styles import ParagraphStyle, getSampleStyleSheet
+    from reportlab.pdfbase import pdfdoc
+
+    # Ensure proper encoding for Cyrillic text
+    pdfdoc.ENCODING = 'UTF-8'
+    font_name = _register_pdf_font()
+    style = ParagraphStyle(
+        "Transcript", parent=getSampleStyleSheet()['Normal'],
+        fontName=font_name, fontSize=12, leading=15,
+    )
+    return PdfContext(font_name, style, A4)
+
+
+_pdf_local = threading.local()
+
+
+def _pdf_page_template():
+    """Шаблон страницы с рамкой текста. Frame хранит позицию вёрстки, поэтому
+    шаблон свой у каждого потока (при RENDER_PROCESSES=0 PDF строятся в потоках)."""
+    template = getattr(_pdf_local, "page_template", None)
+    if template is None:
+        from reportlab.platypus import Frame, PageTemplate
+
+        width, height = get_pdf_context().page_size
+        frame = Frame(PDF_MARGIN, PDF_MARGIN, width - 2 * PDF_MARGIN, height - 2 * PDF_MARGIN, id='normal')
+        template = _pdf_local.page_template = PageTemplate(id='Transcript', frames=[frame])
+    return template
+
+
+def split_paragraphs(text) -> list[str]:
+    """Абзацы готового текста — то же деление по пустой строке, что у потоковых писателей."""
+    # Ensure text is properly handled as Unicode
+    if isinstance(text, bytes):
+        text = text.decode('utf-8', errors='replace')
+    elif not isinstance(text, str):
+        text = str(text)
+    return text.split('\n\n')
+
+
+# =============================
+#   Потоковые писатели документов
+# =============================
+# Писатели принимают итератор абзацев (блоков), а не одну склеенную строку:
+# блок — это реплика, абзац или титр, внутри него допустимы одиночные "\n".
+# Память определяется одним блоком и буфером, а не длиной транскрипта.
+def _build_incrementally(doc, flowables, buffer_size: int = PDF_FLOWABLE_BUFFER):
+    """То же, что doc.build(list), но flowables читаются из итератора порциями.
+
+    Повторяет цикл BaseDocTemplate.build из reportlab 4.x (requirements:
+    reportlab~=4.0): _startBuild, handle_flowable по одному абзацу, _endBuild.
+    В буфере не больше buffer_size абзацев, поэтому Python-объекты абзацев
+    и вёрстки не накапливаются. Готовые страницы canvas держит до save() —
+    в сжатом виде (pageCompression), это остаётся небольшим линейным ростом.
+    """
+    source = iter(flowables)
+    buffer = []
+    doc._startBuild()
+    canv = doc.canv
+    canv._doctemplate = doc
+    try:
+        while True:
+            if not buffer:
+                buffer.extend(itertools.islice(source, max(1, buffer_size)))
+                if not buffer:
+                    break
+            doc.clean_hanging()
+            doc.handle_flowable(buffer)
+    finally:
+        del canv._doctemplate
+    doc._endBuild()
+
+
+def write_pdf_blocks(blocks, output_path: str, buffer_size: int = PDF_FLOWABLE_BUFFER):
+    from reportlab.platypus import BaseDocTemplate, Paragraph, Spacer
+
+    context = get_pdf_context()
+    doc = BaseDocTemplate(output_path, pagesize=context.page_size,
+                          rightMargin=PDF_MARGIN, leftMargin=PDF_MARGIN,
+                          topMargin=PDF_MARGIN, bottomMargin=PDF_MARGIN,
+                          pageTemplates=[_pdf_page_template()],
+                          pageCompression=1)
+
+    def flowables():
+        for block in blocks:
+            if not block.strip():
+                continue
+            # Clean and normalize the text; & и < в речи — не разметка reportlab
+            block = escape(unicodedata.normalize('NFC', block))
+            yield Paragraph(block.replace('\n', '<br />'), context.style)
+            yield Spacer(1, 12)
+
+    _build_incrementally(doc, flowables(), buffer_size * 2)
+
+
+def write_text_blocks(blocks, output_path: str, trailer: str = ""):
+    with open(output_path, 'w', encoding='utf-8') as f:
+        first = True
+        for block in blocks:
+            if not first:
+                f.write('\n\n')
+            f.write(block)
+            first = False
+        if not first:
+            f.write(trailer)
+
+
+_INVALID_XML_CHARS = re.compile('[\x00-\x08\x0b\x0c\x0e-\x1f\ufffe\uffff]')
+
+
+def _docx_paragraph(line: str) -> str:
+    line = _INVALID_XML_CHARS.sub('', line)
+    if not line:
+        return '<w:p/>'
+    return f'<w:p><w:r><w:t xml:space="preserve">{escape(line)}</w:t></w:r></w:p>'
+
+
+def write_docx_blocks(blocks, output_path: str):
+    """DOCX без дерева python-docx: части шаблона копируются, document.xml пишется потоком.
+
+    Разметка та же, что даёт Document().add_paragraph(line): абзац на строку
+    и пустой абзац после каждого блока.
+    """
+    import docx
+    template_path = os.path.join(os.path.dirname(docx.__file__), 'templates', 'default.docx')
+    with zipfile.ZipFile(template_path) as template, \
+            zipfile.ZipFile(output_path, 'w', zipfile.ZIP_DEFLATED) as out:
+        for item in template.infolist():
+            if item.filename != 'word/document.xml':
+                out.writestr(item, template.read(item.filename))
+        skeleton = template.read('word/document.xml').decode('utf-8')
+        body_end = skeleton.index('<w:sectPr')
+        with out.open('word/document.xml', 'w') as raw:
+            stream = io.TextIOWrapper(raw, encoding='utf-8')
+            stream.write(skeleton[:body_end])
+            for block in blocks:
+                for line in block.split('\n'):
+                    stream.write(_docx_paragraph(line))
+                stream.write('<w:p/>')
+            stream.write(skeleton[body_end:])
+            stream.flush()
+            stream.detach()
+
+
+# ---------- Сохранение готового текста ----------
+
+def save_text_to_pdf(text: str, output_path: str):
+    write_pdf_blocks(split_paragraphs(text), output_path)
+
+
+def save_text_to_txt(text: str, output_path: str):
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def save_text_to_md(text: str, output_path: str):
+    with open(output_path, 'w', encoding='utf-8') as f:
+        f.write(text)
+
+
+def save_text_to_docx(text: str, output_path: str):
+    try:
+        write_docx_blocks(split_paragraphs(text), output_path)
+    except Exception as e:
+        logger.warning(f"Не удалось сохранить DOCX ({e}), сохраняю как TXT")
+        save_text_to_txt(text, output_path)
+
+
+# =============================
+#   Пул процессов для рендеринга
+# =============================
+# PDF (reportlab) и DOCX (python-docx) — чистый CPU и держат GIL секундами,
+# поэтому рендерятся в отдельных процессах, а event loop только ждёт результат.
+_RENDERERS = {
+    ".pdf": save_text_to_pdf,
+    ".docx": save_text_to_docx,
+    ".txt": save_text_to_txt,
+    ".md": save_text_to_md,
+    ".srt": save_text_to_txt,
+    ".vtt": save_text_to_txt,
+}
+_CPU_BOUND = (".pdf", ".docx")
+
+_write_subtitles = functools.partial(write_text_blocks, trailer='\n')
+_STREAM_WRITERS = {
+    ".pdf": write_pdf_blocks,
+    ".docx": write_docx_blocks,
+    ".txt": write_text_blocks,
+    ".md": write_text_blocks,
+    ".srt": _write_subtitles,
+    ".vtt": _write_subtitles,
+}
+
+
+def render_blocks_sync(ext: str, make_blocks, source, output_path: str):
+    """Пишет make_blocks(source) в output_path; блоки порождаются прямо в процессе рендеринга.
+
+    make_blocks должна быть функцией уровня модуля (её передают в процесс по
+    имени), source — транскрипт; склеенный текст в процесс не передаётся вовсе.
+    """
+    try:
+        _STREAM_WRITERS[ext](make_blocks(source), output_path)
+    except Exception as e:
+        if ext != ".docx":
+            raise
+        logger.warning(f"Не удалось сохранить DOCX ({e}), сохраняю как TXT")
+        write_text_blocks(make_blocks(source), output_path)
+
+_render_pool: ProcessPoolExecutor | None = None
+
+
+def _init_render_worker():
+    """Инициализатор процесса: шрифты и python-docx загружаются один раз, а не на каждый документ."""
+    get_pdf_context()
+    try:
+        import docx  # noqa: F401
+    except ImportError:
+        pass
+
+
+def get_render_pool() -> ProcessPoolExecutor | None:
+    global _render_pool
+    if RENDER_PROCESSES <= 0:
+        return None
+    if _render_pool is None:
+        # spawn: не наследуем потоки SQLite и event loop родителя через fork
+        _render_pool = ProcessPoolExecutor(
+            max_workers=RENDER_PROCESSES,
+            mp_context=multiprocessing.get_context("spawn"),
+            initializer=_init_render_worker,
+        )
+        logger.info(f"Пул рендеринга документов: {RENDER_PROCESSES} процессов")
+    return _render_pool
+
+
+def shutdown_render_pool():
+    global _render_pool
+    if _render_pool is not None:
+        _render_pool.shutdown(wait=True, cancel_futures=True)
+        _render_pool = None
+
+
+async def _run_renderer(ext: str, renderer, *args):
+    loop = asyncio.get_running_loop()
+    pool = get_render_pool() if ext in _CPU_BOUND else None
+    if pool is None:
+        await asyncio.to_thread(renderer, *args)
+        return
+    try:
+        await loop.run_in_executor(pool, renderer, *args)
+    except BrokenProcessPool:
+        # Процесс упал (например, OOM) — пересоздаём пул и пробуем ещё раз
+        logger.error(f"Пул рендеринга сломан, пересоздаю и повторяю {args[-1]}")
+        shutdown_render_pool()
+        await loop.run_in_executor(get_render_pool(), renderer, *args)
+
+
+async def render_document(ext: str, text: str, output_path: str):
+    """Сохраняет text в output_path в формате ext, не блокируя event loop."""
+    await _run_renderer(ext, _RENDERERS[ext], text, output_path)
+
+
+async def render_blocks(ext: str, make_blocks, source, output_path: str):
+    """Как render_document, но без склеенной строки: документ пишется блок за блоком из make_blocks(source)."""
+    await _run_renderer(ext, render_blocks_sync, ext, make_blocks, source, output_path)
@@ -11,11 +11,18 @@ from aiogram.exceptions import TelegramBadRequest
 
 from . import database as db
 from . import services
+from . import documents
 from . import ui
+from .jobs import scheduler, JobQueueFull, UserJobLimit
+from .transcript_cache import youtube_cache_key, audio_cache_key, SourceHasher
+from .transcript import as_transcript
+from . import youtube
 from .config import (
     YOOMONEY_WALLET, YOOMONEY_REDIRECT_URI, SUBSCRIPTION_AMOUNT,
     SUBSCRIPTION_DURATION_DAYS, PAID_USER_FILE_LIMIT, FREE_USER_FILE_LIMIT,
-    SUPPORTED_FORMATS, CUSTOM_THUMBNAIL_PATH
+    SUPPORTED_FORMATS, CUSTOM_THUMBNAIL_PATH,
+    TELEGRAM_DOWNLOAD_TIMEOUT, TELEGRAM_DOWNLOAD_CHUNK_SIZE, SUBTITLE_FORMAT, SUMMARY_OUTLINE_ENABLED,
+    FREE_USER_MAX_DURATION, PAID_USER_MAX_DURATION
 )
 from .localization import get_string
 
@@ -23,6 +30,48 @@ logger = logging.getLogger(__name__)
 
 # --- Handler Functions ---
 
+async def ingest_telegram_file(bot: Bot, file) -> tuple[str, str]:
+    """Скачивает аудио из Telegram; возвращает путь к файлу для AssemblyAI и ключ кэша.
+
+    MP3/OGG обычно уже подходят как есть: они сохраняются на диск и проходят
+    через services.prepare_audio (пропуск, копирование потока или перекодирование).
+    Прочие потоковые форматы идут из сети прямо в stdin ffmpeg. MP4/M4A требуют
+    seek по файлу, поэтому для них (и для локального Bot API сервера) тоже
+    используется временный файл. Ключ кэша транскриптов — хэш исходных байтов,
+    снятый по дороге, а не хэш перекодированного результата.
+    """
+    mime_type = getattr(file, 'mime_type', None)
+    file_name = getattr(file, 'file_name', None)
+    if (not bot.session.api.is_local
+            and not services.needs_seekable_input(mime_type, file_name)
+            and not services.likely_passthrough(mime_type, file_name)):
+        tg_file = await bot.get_file(file.file_id)
+        url = bot.session.api.file_url(bot.token, tg_file.file_path)
+        chunks = bot.session.stream_content(
+            url=url,
+            timeout=TELEGRAM_DOWNLOAD_TIMEOUT,
+            chunk_size=TELEGRAM_DOWNLOAD_CHUNK_SIZE,
+            raise_for_status=True
+        )
+        hasher = SourceHasher()
+        audio_path = await services.transcode_stream(hasher.wrap(chunks))
+        return audio_path, hasher.cache_key
+
+    suffix = os.path.splitext(file_name or "")[1].lower() or ".temp"
+    temp_path = tempfile.NamedTemporaryFile(delete=False, suffix=suffix).name
+    audio_path = None
+    try:
+        await bot.download(file, destination=temp_path, timeout=TELEGRAM_DOWNLOAD_TIMEOUT)
+        cache_key = await audio_cache_key(temp_path)
+        audio_path = await services.prepare_audio(temp_path)
+        return audio_path, cache_key
+    finally:
+        if audio_path != temp_path:
+            try:
+                os.remove(temp_path)
+            except OSError:
+                logger.warning(f"Не удалось удалить временный файл {temp_path}")
+
 async def start_handler(message: types.Message):
     welcome_text = (
         "🎙️ *Добро пожаловать в Transcribe To!*\n\n"
@@ -155,33 +204,106 @@ async def callback_handler(callback: types.CallbackQuery, bot: Bot):
             await callback.answer("Сначала отправьте аудиофайл или ссылку на YouTube.")
             return
         selections = ui.user_selections[user_id]
+        if selections.get('confirmed'):
+            # Повторное нажатие, пока ждём скачивание: задание уже создаётся
+            try:
+                await callback.answer(get_string('download_in_progress', 'ru'))
+            except TelegramBadRequest:
+                pass
+            return
         if not any([selections['speakers'], selections['plain'], selections['timecodes']]):
             await callback.message.edit_text(
                 f"❌ {get_string('no_selection', 'ru')}",
                 reply_markup=ui.create_transcription_selection_keyboard(user_id)
             )
             return
-        audio_path = selections.get('file_path')
-        if not audio_path:
-            await callback.message.edit_text(
-                f"❌ Ошибка: файл не найден. Попробуйте отправить файл или ссылку снова.",
-                reply_markup=ui.create_menu_keyboard()
-            )
-            if user_id in ui.user_selections:
-                del ui.user_selections[user_id]
+        # Выбор подтверждён: файл теперь принадлежит заданию, новая ссылка его не отменит
+        selections['confirmed'] = True
+        download = selections.get('download')
+        if download is not None and not download.done():
+            try:
+                await callback.answer(get_string('download_in_progress', 'ru'))
+            except TelegramBadRequest:
+                pass
+            # Скачивание ждёт отдельная задача: обработчик (в режиме webhook — воркер) не занят
+            task = asyncio.create_task(submit_when_downloaded(bot, callback.message, user_id, selections))
+            _waiting_for_download.add(task)
+            task.add_done_callback(_waiting_for_download.discard)
             return
-        try:
-            await callback.message.delete()
-            await process_audio_file_for_user(bot, callback.message, user_id, selections, audio_path)
-        except Exception as e:
-            logger.error(f"Ошибка обработки после подтверждения для user_id {user_id}: {str(e)}")
-            await callback.message.edit_text(f"❌ {get_string('error', 'ru', error=str(e))}")
+        await submit_when_downloaded(bot, callback.message, user_id, selections)
 
     try:
         await callback.answer()
     except TelegramBadRequest:
         pass
 
+_waiting_for_download: set[asyncio.Task] = set()
+
+
+async def submit_when_downloaded(bot: Bot, message: types.Message, user_id: int, selections: dict):
+    """Дожидается фонового скачивания (если оно ещё идёт) и ставит задание в очередь."""
+    download = selections.get('download')
+    if download is not None:
+        await asyncio.wait([download])
+        if download.cancelled() or download.exception() is not None:
+            return  # об ошибке скачивания пользователь уже знает
+    audio_path = selections.get('file_path')
+    if not audio_path and selections.get('segments') is None:
+        await message.edit_text(
+            f"❌ Ошибка: файл не найден. Попробуйте отправить файл или ссылку снова.",
+            reply_markup=ui.create_menu_keyboard()
+        )
+        if ui.user_selections.get(user_id) is selections:
+            del ui.user_selections[user_id]
+        return
+    try:
+        _, is_paid = await db.check_user_trials(user_id)
+        await message.delete()
+        await submit_transcription_job(bot, message, user_id, selections, audio_path, is_paid)
+    except Exception as e:
+        logger.error(f"Ошибка обработки после подтверждения для user_id {user_id}: {str(e)}")
+        await message.answer(f"❌ {get_string('error', 'ru', error=str(e))}")
+
+def abandon_pending_selection(user_id: int):
+    """Новый файл или ссылка заменяют неподтверждённый выбор: его скачивание
+    отменяется, а уже скачанный файл удаляется."""
+    previous = ui.user_selections.get(user_id)
+    if not previous or previous.get('confirmed'):
+        return
+    download = previous.get('download')
+    if download is not None and not download.done():
+        logger.info(f"user_id {user_id} отправил новый файл — отменяю незавершённое скачивание")
+        download.cancel()
+    elif previous.get('file_path'):
+        try:
+            os.remove(previous['file_path'])
+        except OSError:
+            pass
+    del ui.user_selections[user_id]
+
+
+def youtube_limit_error(metadata: youtube.YoutubeMetadata, is_paid: bool) -> str | None:
+    """Проверка тарифных лимитов по метаданным — до того, как скачан хоть один байт."""
+    if metadata.is_live:
+        return get_string('video_is_live', 'ru')
+    max_duration = PAID_USER_MAX_DURATION if is_paid else FREE_USER_MAX_DURATION
+    if metadata.duration and metadata.duration > max_duration:
+        return get_string('video_too_long', 'ru', duration=services.format_clock(metadata.duration * 1000),
+                          limit=services.format_clock(max_duration * 1000))
+    file_limit = PAID_USER_FILE_LIMIT if is_paid else FREE_USER_FILE_LIMIT
+    if metadata.estimated_size and metadata.estimated_size > file_limit:
+        return get_string('file_too_large', 'ru', size=metadata.estimated_size, limit=file_limit)
+    return None
+
+
+async def _delete_message_quietly(message: types.Message):
+    await ui.progress_manager.finish(message)
+    try:
+        await message.delete()
+    except Exception:
+        pass
+
+
 async def universal_handler(message: types.Message, bot: Bot):
     user_id = message.from_user.id
     if message.text and message.text.startswith('/'):
@@ -202,13 +324,36 @@ async def universal_handler(message: types.Message, bot: Bot):
             await message.answer(f"❌ {get_string('file_too_large', 'ru', size=file_size, limit=file_limit)}", reply_markup=ui.create_menu_keyboard())
             return
 
-    audio_path = None
+    abandon_pending_selection(user_id)
+    cache_key = None
+    cached_segments = None
+    start_download = None
     try:
         ui.ensure_user_settings(user_id)
 
         if message.text and message.text.startswith(('http://', 'https://')):
             url = message.text.strip()
-            logger.info(f"Скачивание YouTube: {url}")
+            cache_key = youtube_cache_key(url)
+            if cache_key and services.transcript_cache is not None:
+                cached_segments = await services.transcript_cache.get(cache_key)
+
+        if cached_segments is not None:
+            logger.info(f"YouTube {url}: транскрипт уже в кэше, скачивание пропущено")
+        elif message.text and message.text.startswith(('http://', 'https://')):
+            try:
+                metadata = await youtube.metadata_probe.probe(url)
+            except youtube.YoutubeProbeError as e:
+                logger.warning(f"Метаданные {url} недоступны: {e}")
+                await message.answer(f"❌ {get_string('video_unavailable', 'ru', error=str(e))}",
+                                     reply_markup=ui.create_menu_keyboard())
+                return
+            limit_error = youtube_limit_error(metadata, is_paid)
+            if limit_error:
+                logger.info(f"Видео {url} отклонено до скачивания для user_id {user_id}: {limit_error}")
+                await message.answer(f"❌ {limit_error}", reply_markup=ui.create_menu_keyboard())
+                return
+
+            logger.info(f"Скачивание YouTube: {url} (~{metadata.estimated_size} байт)")
 
             async def download_progress(percent_value):
                 try:
@@ -218,25 +363,63 @@ async def universal_handler(message: types.Message, bot: Bot):
                     logger.warning(f"Ошибка обработки прогресса загрузки: {e}")
 
             temp_message = await message.answer(f"📥 Начинаю скачивание...\n⬜⬜⬜⬜⬜⬜⬜⬜⬜⬜ 0%")
-            audio_path = await services.download_youtube_audio(url, progress_callback=download_progress)
-            await temp_message.delete()
+
+            # Скачивание идёт в фоне, пока пользователь выбирает варианты; если он
+            # пришлёт другой файл, abandon_pending_selection отменит эту загрузку
+            async def fetch(selections: dict):
+                try:
+                    path = await services.download_youtube_audio(url, progress_callback=download_progress,
+                                                                 metadata=metadata)
+                except asyncio.CancelledError:
+                    await _delete_message_quietly(temp_message)
+                    raise
+                except Exception as e:
+                    logger.error(f"Ошибка скачивания для user_id {user_id}: {e}")
+                    error = (get_string('queue_full', 'ru') if isinstance(e, youtube.DownloadQueueFull)
+                             else get_string('error', 'ru', error=str(e)))
+                    await _delete_message_quietly(temp_message)
+                    await message.answer(f"❌ {error}", reply_markup=ui.create_menu_keyboard())
+                    if ui.user_selections.get(user_id) is selections:
+                        del ui.user_selections[user_id]
+                    raise
+                selections['file_path'] = path
+                await _delete_message_quietly(temp_message)
+                return path
+
+            start_download = fetch
         else:
             file = message.audio or message.document
-            temp_path = tempfile.NamedTemporaryFile(delete=False, suffix=".temp").name
-            await bot.download(file, destination=temp_path)
-            audio_path = await services.convert_to_mp3(temp_path)
-            try:
-                os.remove(temp_path)
-            except:
-                logger.warning(f"Не удалось удалить временный файл {temp_path}")
 
-        ui.user_selections[user_id] = {
+            # Загрузка из Telegram и перекодирование тоже идут в фоне, а не в обработчике
+            async def ingest(selections: dict):
+                try:
+                    path, key = await ingest_telegram_file(bot, file)
+                except Exception as e:
+                    logger.error(f"Ошибка загрузки файла из Telegram для user_id {user_id}: {e}")
+                    await message.answer(f"❌ {get_string('error', 'ru', error=str(e))}",
+                                         reply_markup=ui.create_menu_keyboard())
+                    if ui.user_selections.get(user_id) is selections:
+                        del ui.user_selections[user_id]
+                    raise
+                selections['file_path'], selections['cache_key'] = path, key
+                return path
+
+            start_download = ingest
+
+        selections = ui.user_selections[user_id] = {
             'speakers': False,
             'plain': False,
             'timecodes': False,
-            'file_path': audio_path,
+            'file_path': None,
+            'cache_key': cache_key,
+            'segments': cached_segments,
+            'download': None,
             'message_id': None
         }
+        if start_download is not None:
+            selections['download'] = asyncio.create_task(start_download(selections))
+            # Ошибку уже показали пользователю; ждать результат необязательно
+            selections['download'].add_done_callback(lambda t: t.cancelled() or t.exception())
         selection_message = await message.answer(
             get_string('select_transcription', 'ru'),
             reply_markup=ui.create_transcription_selection_keyboard(user_id)
@@ -246,13 +429,66 @@ async def universal_handler(message: types.Message, bot: Bot):
     except Exception as e:
         logger.error(f"Ошибка предварительной обработки для user_id {user_id}: {str(e)}")
         await message.answer(f"❌ {get_string('error', 'ru', error=str(e))}")
+        abandon_pending_selection(user_id)
+
+async def submit_transcription_job(bot: Bot, message: types.Message, user_id: int, selections: dict,
+                                   audio_path: str, is_paid: bool):
+    """Ставит транскрибацию в общую очередь вместо выполнения прямо в обработчике."""
+    chat_id = message.chat.id
+    position_lock = asyncio.Lock()
+    queue_message = None
+
+    async def report_position(position: int):
+        nonlocal queue_message
+        async with position_lock:
+            if position == 0:
+                if queue_message is not None:
+                    await queue_message.delete()
+                    queue_message = None
+                return
+            text = get_string('queue_position', 'ru', position=position)
+            if queue_message is None:
+                queue_message = await bot.send_message(chat_id, text)
+            else:
+                try:
+                    await queue_message.edit_text(text)
+                except TelegramBadRequest:
+                    pass
+
+    async def run():
+        await process_audio_file_for_user(bot, message, user_id, selections, audio_path)
+
+    async def cancelled():
+        # Остановка бота: задание не выполнится, его finally с очисткой не сработает
         if audio_path:
             try:
                 os.remove(audio_path)
-            except:
+            except OSError:
                 pass
-        if user_id in ui.user_selections:
+        await bot.send_message(chat_id, f"⚠️ {get_string('job_cancelled_shutdown', 'ru')}",
+                               reply_markup=ui.create_menu_keyboard())
+
+    try:
+        scheduler.submit(user_id, run, paid=is_paid, on_position=report_position, on_cancel=cancelled)
+    except (JobQueueFull, UserJobLimit) as e:
+        logger.warning(f"Задание user_id {user_id} отклонено: {e}")
+        if isinstance(e, UserJobLimit):
+            text = get_string('queue_user_limit', 'ru', limit=scheduler.per_user_limit)
+        else:
+            text = get_string('queue_full', 'ru')
+        await bot.send_message(chat_id, f"❌ {text}", reply_markup=ui.create_menu_keyboard())
+        if audio_path:
+            try:
+                os.remove(audio_path)
+            except OSError:
+                pass
+        if ui.user_selections.get(user_id) is selections:
             del ui.user_selections[user_id]
+        return
+    # Выбор принадлежит заданию: новый файл пользователя не затрёт его
+    if ui.user_selections.get(user_id) is selections:
+        del ui.user_selections[user_id]
+
 
 async def process_audio_file_for_user(bot: Bot, message: types.Message, user_id: int, selections: dict, audio_path: str):
     # ... (implementation is unchanged)
@@ -277,48 +513,26 @@ async def process_audio_file_for_user(bot: Bot, message: types.Message, user_id:
 
     out_files = []
     try:
+        # Не ждёт Telegram: progress_manager схлопывает события и сам соблюдает лимиты правок
         async def update_audio_progress(progress, status_text=None):
             if isinstance(progress, (int, float)):
-                if progress < 0.99:
-                    await asyncio.sleep(5)
                 await ui.progress_manager.update_progress(progress, progress_message, lang)
             elif status_text:
-                await progress_message.edit_text(f"{EMOJI['processing']} {status_text}")
+                await ui.progress_manager.update_progress(f"{EMOJI['processing']} {status_text}", progress_message)
 
-        results = await services.process_audio_file(audio_path, user_id, progress_callback=update_audio_progress)
+        results = selections.get('segments')
+        if results is None:
+            results = await services.process_audio_file(
+                audio_path, user_id, progress_callback=update_audio_progress,
+                cache_key=selections.get('cache_key')
+            )
+        # Дальше сообщение правится напрямую — запоздалый прогресс не должен его перезаписать
+        await ui.progress_manager.finish(progress_message)
 
-        if not results or not any(seg.get('text') for seg in results):
+        if not results or not as_transcript(results).has_text():
             await progress_message.edit_text(f"{EMOJI['error']} {get_string('no_speech', lang)}")
             return
 
-        def _save_with_format(text_data: str, base_name: str):
-            temp_out = tempfile.NamedTemporaryFile(delete=False, suffix=chosen_ext).name
-            if chosen_ext == ".pdf":
-                services.save_text_to_pdf(text_data, temp_out)
-            elif chosen_ext == ".docx":
-                services.save_text_to_docx(text_data, temp_out)
-            elif chosen_ext == ".txt":
-                services.save_text_to_txt(text_data, temp_out)
-            elif chosen_ext == ".md":
-                services.save_text_to_md(text_data, temp_out)
-            display_name = f"{base_name}{' (Google Docs)' if chosen_format=='google' else ''}{chosen_ext}"
-            return temp_out, display_name
-
-        if selections['speakers']:
-            text_with_speakers = services.format_results_with_speakers(results)
-            path, name = _save_with_format(text_with_speakers, f"{EMOJI['speakers']} Транскрипция со спикерами")
-            out_files.append((path, name))
-
-        if selections['plain']:
-            text_plain = services.format_results_plain(results)
-            path, name = _save_with_format(text_plain, f"{EMOJI['text']} Транскрипция без спикеров")
-            out_files.append((path, name))
-
-        if selections['timecodes']:
-            timecodes_text = services.generate_summary_timecodes(results)
-            path, name = _save_with_format(timecodes_text, f"{EMOJI['timecodes']} Транскрипт с тайм-кодами")
-            out_files.append((path, name))
-
         thumbnail_bytes = services.create_custom_thumbnail(CUSTOM_THUMBNAIL_PATH)
         logger.info(f"thumbnail_bytes: {thumbnail_bytes}, chosen_ext: {chosen_ext}")
         if thumbnail_bytes:
@@ -330,12 +544,24 @@ async def process_audio_file_for_user(bot: Bot, message: types.Message, user_id:
             thumbnail_file = None
         logger.info(f"thumbnail_file: {thumbnail_file}")
 
-        for file_path, filename in out_files:
+        async def _save_with_format(render, base_name: str, ext: str | None = None):
+            ext = ext or chosen_ext
+            temp_out = tempfile.NamedTemporaryFile(delete=False, suffix=ext).name
+            try:
+                await render(ext, temp_out)
+            except Exception:
+                os.remove(temp_out)
+                raise
+            google_suffix = ' (Google Docs)' if chosen_format == 'google' and ext == chosen_ext else ''
+            display_name = f"{base_name}{google_suffix}{ext}"
+            return temp_out, display_name
+
+        async def _send(file_path: str, filename: str):
             try:
                 await bot.send_document(
                     chat_id,
                     document=FSInputFile(file_path, filename=filename),
-                    caption=filename.replace(chosen_ext, ""),
+                    caption=os.path.splitext(filename)[0],
                     thumbnail=thumbnail_file
                 )
             except Exception as e:
@@ -343,9 +569,46 @@ async def process_audio_file_for_user(bot: Bot, message: types.Message, user_id:
                 await bot.send_document(
                     chat_id,
                     document=FSInputFile(file_path, filename=filename),
-                    caption=filename.replace(chosen_ext, "")
+                    caption=os.path.splitext(filename)[0]
                 )
 
+        # Каждый выбранный вариант — отдельная задача: документ -> отправка.
+        # Запрос к LLM за оглавлением идёт параллельно с рендерингом остальных,
+        # и готовый файл уходит пользователю сразу, не дожидаясь других.
+        # Транскрипт пишется в документ потоком по репликам, без склеенной строки.
+        def _stream(make_blocks):
+            async def render(ext: str, path: str):
+                await documents.render_blocks(ext, make_blocks, results, path)
+            return render
+
+        async def _render_outline(ext: str, path: str):
+            text_data = await services.generate_summary_timecodes(results)
+            await documents.render_document(ext, text_data, path)
+
+        outputs = []
+        if selections['speakers']:
+            outputs.append((_stream(services.iter_blocks_with_speakers), f"{EMOJI['speakers']} Транскрипция со спикерами"))
+        if selections['plain']:
+            outputs.append((_stream(services.iter_blocks_plain), f"{EMOJI['text']} Транскрипция без спикеров"))
+        if selections['timecodes']:
+            # Транскрипт с тайм-кодами и субтитры строятся локально по смещениям AssemblyAI — без LLM, сразу
+            outputs.append((_stream(services.iter_blocks_with_timecodes), f"{EMOJI['timecodes']} Транскрипт с тайм-кодами"))
+            subtitle_blocks = services.iter_vtt_blocks if SUBTITLE_FORMAT == "vtt" else services.iter_srt_blocks
+            outputs.append((_stream(subtitle_blocks), f"{EMOJI['timecodes']} Субтитры", f".{SUBTITLE_FORMAT}"))
+            if SUMMARY_OUTLINE_ENABLED:
+                outputs.append((_render_outline, f"{EMOJI['timecodes']} Оглавление"))
+
+        async def _produce(render, base_name: str, ext: str | None = None):
+            path, name = await _save_with_format(render, base_name, ext)
+            out_files.append((path, name))
+            await _send(path, name)
+            logger.info(f"Файл «{name}» отправлен user_id {user_id}")
+
+        produced = await asyncio.gather(*(_produce(*output) for output in outputs), return_exceptions=True)
+        failures = [r for r in produced if isinstance(r, BaseException)]
+        if failures:
+            raise failures[0]
+
         await progress_message.edit_text(
             f"{EMOJI['success']} {get_string('done')}\nВсе файлы успешно сформированы и отправлены",
             reply_markup=ui.create_menu_keyboard()
@@ -356,6 +619,7 @@ async def process_audio_file_for_user(bot: Bot, message: types.Message, user_id:
 
     except Exception as e:
         logger.exception(f"Ошибка обработки для user_id {user_id}: {str(e)}")
+        await ui.progress_manager.finish(progress_message)
         await progress_message.edit_text(f"{EMOJI['error']} {get_string('error', lang, error=str(e))}")
     finally:
         if audio_path:
@@ -368,7 +632,7 @@ async def process_audio_file_for_user(bot: Bot, message: types.Message, user_id:
                 os.remove(file_path)
             except:
                 pass
-        if user_id in ui.user_selections:
+        if ui.user_selections.get(user_id) is selections:
             del ui.user_selections[user_id]
 
 # --- Registration Function ---
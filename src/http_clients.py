@@ -0,0 +1,150 @@
+import asyncio
+import logging
+import httpx
+
+from .config import (
+    HTTP_MAX_CONNECTIONS, HTTP_MAX_KEEPALIVE_CONNECTIONS,
+    HTTP_KEEPALIVE_EXPIRY, HTTP2_ENABLED
+)
+
+logger = logging.getLogger(__name__)
+
+try:
+    import h2  # noqa: F401  (нужен httpx для HTTP/2)
+    HTTP2_AVAILABLE = True
+except ImportError:
+    HTTP2_AVAILABLE = False
+
+
+# =============================
+#   Транспорт с метриками пула
+# =============================
+class _CountingStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, on_close):
+        self._stream = stream
+        self._on_close = on_close
+        self._closed = False
+
+    async def __aiter__(self):
+        async for chunk in self._stream:
+            yield chunk
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._closed:
+                self._closed = True
+                self._on_close()
+
+
+class MeteredTransport(httpx.AsyncHTTPTransport):
+    """AsyncHTTPTransport, который считает запросы в работе и состояние пула соединений."""
+
+    def __init__(self, *args, limits: httpx.Limits, **kwargs):
+        super().__init__(*args, limits=limits, **kwargs)
+        self.max_connections = limits.max_connections
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self.requests_total = 0
+        self.errors_total = 0
+
+    def _release(self):
+        self.in_flight -= 1
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        self.in_flight += 1
+        self.requests_total += 1
+        self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            self.in_flight -= 1
+            self.errors_total += 1
+            raise
+        response.stream = _CountingStream(response.stream, self._release)
+        return response
+
+    def stats(self) -> dict:
+        connections = list(getattr(self._pool, "connections", []))
+        idle = sum(1 for conn in connections if conn.is_idle())
+        return {
+            "in_flight": self.in_flight,
+            "peak_in_flight": self.peak_in_flight,
+            "requests": self.requests_total,
+            "errors": self.errors_total,
+            "connections": len(connections),
+            "idle_connections": idle,
+            "max_connections": self.max_connections,
+            "utilisation": round(self.in_flight / self.max_connections, 3) if self.max_connections else 0.0,
+        }
+
+
+# =============================
+#     Реестр HTTP-клиентов
+# =============================
+class HttpClients:
+    """Общие httpx.AsyncClient на всё приложение — по одному на внешний сервис.
+
+    Клиенты держат keep-alive соединения (и HTTP/2, если установлен h2),
+    поэтому повторные запросы и ретраи не делают новое TLS-рукопожатие.
+    Создаётся в bot.main и закрывается при остановке.
+    """
+
+    def __init__(self, max_connections: int = HTTP_MAX_CONNECTIONS,
+                 max_keepalive_connections: int = HTTP_MAX_KEEPALIVE_CONNECTIONS,
+                 keepalive_expiry: float = HTTP_KEEPALIVE_EXPIRY,
+                 http2: bool = HTTP2_ENABLED):
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive_connections,
+            keepalive_expiry=keepalive_expiry,
+        )
+        if http2 and not HTTP2_AVAILABLE:
+            logger.warning("Пакет h2 не установлен, HTTP/2 отключён (pip install 'httpx[http2]')")
+        self.http2 = http2 and HTTP2_AVAILABLE
+        self._clients: dict[str, httpx.AsyncClient] = {}
+        self._transports: dict[str, MeteredTransport] = {}
+        self._metrics_task: asyncio.Task | None = None
+
+    def get(self, name: str) -> httpx.AsyncClient:
+        """Клиент для сервиса name ("assemblyai", "yoomoney", ...), создаётся при первом обращении."""
+        client = self._clients.get(name)
+        if client is None or client.is_closed:
+            transport = MeteredTransport(limits=self.limits, http2=self.http2)
+            client = httpx.AsyncClient(transport=transport)
+            self._clients[name] = client
+            self._transports[name] = transport
+        return client
+
+    def stats(self) -> dict[str, dict]:
+        return {name: transport.stats() for name, transport in self._transports.items()}
+
+    def log_stats(self):
+        for name, stats in self.stats().items():
+            logger.info(
+                f"HTTP pool {name}: в работе {stats['in_flight']}/{stats['max_connections']} "
+                f"(пик {stats['peak_in_flight']}), соединений {stats['connections']} "
+                f"(простаивает {stats['idle_connections']}), запросов {stats['requests']}, ошибок {stats['errors']}"
+            )
+
+    def start_metrics_logging(self, interval: float):
+        if interval <= 0 or self._metrics_task is not None:
+            return
+
+        async def report():
+            while True:
+                await asyncio.sleep(interval)
+                self.log_stats()
+
+        self._metrics_task = asyncio.create_task(report())
+
+    async def aclose(self):
+        if self._metrics_task is not None:
+            self._metrics_task.cancel()
+            self._metrics_task = None
+        self.log_stats()
+        for client in self._clients.values():
+            await client.aclose()
+        self._clients.clear()
+        self._transports.clear()
@@ -0,0 +1,218 @@
+import asyncio
+import heapq
+import itertools
+import logging
+import time
+
+from .config import JOB_WORKERS, JOB_QUEUE_SIZE, JOB_PER_USER_LIMIT
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_PAID = 0
+PRIORITY_FREE = 1
+
+
+class JobQueueFull(Exception):
+    """Очередь заполнена — новое задание не принято."""
+
+
+class UserJobLimit(Exception):
+    """У пользователя уже максимум заданий в очереди и в работе."""
+
+
+class Job:
+    def __init__(self, user_id: int, run, priority: int, on_position=None, on_cancel=None):
+        self.user_id = user_id
+        self.run = run
+        self.priority = priority
+        self.on_position = on_position
+        self.on_cancel = on_cancel
+        self.position: int | None = None
+        self.submitted_at = time.monotonic()
+        self.started_at: float | None = None
+        self.done = asyncio.get_running_loop().create_future()
+        # Ошибку уже залогировал воркер; ждать результат необязательно
+        self.done.add_done_callback(lambda f: f.cancelled() or f.exception())
+
+
+# =============================
+#     Планировщик заданий
+# =============================
+class JobScheduler:
+    """Ограниченная очередь транскрибаций и фиксированный пул воркеров.
+
+    Одновременно выполняется не больше workers заданий, в очереди ждёт не
+    больше max_queue, у одного пользователя — не больше per_user_limit
+    (в очереди и в работе вместе). Задания платных пользователей идут
+    раньше бесплатных, внутри приоритета — в порядке поступления.
+    """
+
+    def __init__(self, workers: int = JOB_WORKERS, max_queue: int = JOB_QUEUE_SIZE,
+                 per_user_limit: int = JOB_PER_USER_LIMIT):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self.per_user_limit = per_user_limit
+        self._heap: list[tuple[int, int, Job]] = []
+        self._seq = itertools.count()
+        self._active: dict[int, int] = {}
+        self._running = 0
+        self._wakeup: asyncio.Condition | None = None
+        self._tasks: list[asyncio.Task] = []
+        self._closing = False
+        self._interrupted: list[Job] = []
+        self._background: set[asyncio.Task] = set()
+
+    @property
+    def queued(self) -> int:
+        return len(self._heap)
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def active_for(self, user_id: int) -> int:
+        return self._active.get(user_id, 0)
+
+    def submit(self, user_id: int, run, paid: bool = False, on_position=None, on_cancel=None) -> Job:
+        """Ставит run() (корутинную функцию без аргументов) в очередь.
+
+        on_position(position) вызывается, если заданию приходится ждать, и
+        затем при каждом изменении позиции; 0 означает, что задание начало
+        выполняться. Если свободный воркер есть сразу, вызовов нет.
+        on_cancel() вызывается, если задание так и не выполнилось из-за
+        остановки планировщика (stop): убрать файлы и предупредить пользователя.
+        """
+        if self.active_for(user_id) >= self.per_user_limit:
+            raise UserJobLimit(f"У пользователя {user_id} уже {self.active_for(user_id)} заданий")
+        if self._closing or len(self._heap) >= self.max_queue:
+            raise JobQueueFull(f"Очередь заполнена ({len(self._heap)} заданий)")
+        self.start()
+        job = Job(user_id, run, PRIORITY_PAID if paid else PRIORITY_FREE, on_position, on_cancel)
+        heapq.heappush(self._heap, (job.priority, next(self._seq), job))
+        self._active[user_id] = self._active.get(user_id, 0) + 1
+        logger.info(
+            f"Задание user_id {user_id} в очереди (приоритет {job.priority}): "
+            f"в очереди {len(self._heap)}, в работе {self._running}/{self.workers}"
+        )
+        self._publish_positions()
+        self._notify()
+        return job
+
+    def _spawn(self, coro):
+        task = asyncio.get_running_loop().create_task(coro)
+        self._background.add(task)
+        task.add_done_callback(self._background.discard)
+
+    def _notify(self):
+        async def wake():
+            async with self._wakeup:
+                self._wakeup.notify()
+
+        self._spawn(wake())
+
+    def _publish_positions(self):
+        idle = self.workers - self._running
+        for position, (_, _, job) in enumerate(sorted(self._heap), start=1):
+            if position <= idle:
+                continue  # его сразу заберёт свободный воркер, сообщать нечего
+            if job.position != position:
+                job.position = position
+                self._report(job, position)
+
+    def _report(self, job: Job, position: int):
+        if job.on_position is None:
+            return
+
+        async def report():
+            try:
+                await job.on_position(position)
+            except Exception as e:
+                logger.warning(f"Не удалось сообщить позицию в очереди user_id {job.user_id}: {e}")
+
+        self._spawn(report())
+
+    async def _worker(self, index: int):
+        while True:
+            async with self._wakeup:
+                await self._wakeup.wait_for(lambda: bool(self._heap))
+                _, _, job = heapq.heappop(self._heap)
+            self._running += 1
+            job.started_at = time.monotonic()
+            if job.position:
+                self._report(job, 0)
+            job.position = 0
+            self._publish_positions()
+            logger.info(
+                f"Воркер {index}: старт задания user_id {job.user_id} "
+                f"после {job.started_at - job.submitted_at:.1f} с в очереди"
+            )
+            try:
+                result = await job.run()
+                if not job.done.done():
+                    job.done.set_result(result)
+            except asyncio.CancelledError:
+                job.done.cancel()
+                self._interrupted.append(job)
+                raise
+            except Exception as e:
+                logger.exception(f"Задание user_id {job.user_id} завершилось с ошибкой: {e}")
+                if not job.done.done():
+                    job.done.set_exception(e)
+            finally:
+                self._running -= 1
+                remaining = self._active.get(job.user_id, 1) - 1
+                if remaining:
+                    self._active[job.user_id] = remaining
+                else:
+                    self._active.pop(job.user_id, None)
+                logger.info(
+                    f"Воркер {index}: задание user_id {job.user_id} заняло "
+                    f"{time.monotonic() - job.started_at:.1f} с"
+                )
+
+    def start(self):
+        if self._tasks:
+            return
+        self._wakeup = asyncio.Condition()
+        self._tasks = [asyncio.create_task(self._worker(i)) for i in range(self.workers)]
+        logger.info(f"Планировщик заданий: {self.workers} воркеров, очередь до {self.max_queue}")
+
+    async def stop(self, timeout: float | None = None):
+        """Перестаёт принимать задания и дорабатывает очередь (не дольше timeout).
+
+        Что не успело выполниться — и ждавшее в очереди, и прерванное на ходу —
+        отменяется, и для каждого такого задания вызывается on_cancel.
+        """
+        if not self._tasks:
+            return
+        self._closing = True
+        if timeout:
+            deadline = time.monotonic() + timeout
+            while (self._running or self._heap) and time.monotonic() < deadline:
+                await asyncio.sleep(0.1)
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        dropped = self._interrupted + [job for _, _, job in sorted(self._heap)]
+        for _, _, job in self._heap:
+            job.done.cancel()
+        if dropped:
+            logger.warning(f"Остановка планировщика: не выполнено заданий {len(dropped)}")
+        await asyncio.gather(*(self._cancelled(job) for job in dropped))
+        self._heap.clear()
+        self._interrupted = []
+        self._active.clear()
+        self._running = 0
+        self._tasks = []
+        self._closing = False
+
+    async def _cancelled(self, job: Job):
+        if job.on_cancel is None:
+            return
+        try:
+            await job.on_cancel()
+        except Exception as e:
+            logger.warning(f"Ошибка отмены задания user_id {job.user_id}: {e}")
+
+
+scheduler = JobScheduler()
@@ -35,7 +35,15 @@ locales = {
             "• TXT – простой текстовый файл\n"
             "• Markdown – файл в формате .md"
         ),
-        'back': "← Назад"
+        'back': "← Назад",
+        'queue_position': "⏳ Файл в очереди на обработку. Ваша позиция: {position}",
+        'queue_full': "Сервис сейчас перегружен. Попробуйте отправить файл через несколько минут.",
+        'queue_user_limit': "У вас уже обрабатывается {limit} файла(ов). Дождитесь результата и отправьте следующий.",
+        'job_cancelled_shutdown': "Бот перезапускается, и ваш файл не успел обработаться. Пожалуйста, отправьте его снова.",
+        'video_too_long': "Видео слишком длинное ({duration}). Лимит: {limit}. Оформите подписку для увеличения лимита.",
+        'video_is_live': "Прямые трансляции не поддерживаются. Отправьте ссылку после окончания эфира.",
+        'video_unavailable': "Не удалось получить информацию о видео: {error}",
+        'download_in_progress': "Файл ещё скачивается — обработка начнётся сразу после загрузки."
     },
     'en': {
         'welcome': "Hi! Send me an audio file or YouTube link for transcription.",
@@ -70,7 +78,15 @@ locales = {
             "• TXT – plain text file\n"
             "• Markdown – .md"
         ),
-        'back': "← Back"
+        'back': "← Back",
+        'queue_position': "⏳ Your file is queued for processing. Position: {position}",
+        'queue_full': "The service is busy right now. Please try again in a few minutes.",
+        'queue_user_limit': "You already have {limit} file(s) in progress. Wait for the result before sending another.",
+        'job_cancelled_shutdown': "The bot is restarting and your file was not processed. Please send it again.",
+        'video_too_long': "The video is too long ({duration}). Limit: {limit}. Subscribe to increase the limit.",
+        'video_is_live': "Live streams are not supported. Send the link after the broadcast ends.",
+        'video_unavailable': "Could not get video information: {error}",
+        'download_in_progress': "The file is still downloading — processing starts as soon as it finishes."
     }
 }
 
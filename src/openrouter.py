@@ -0,0 +1,233 @@
+import asyncio
+import logging
+import random
+import time
+import httpx
+
+from .config import (
+    OPENROUTER_API_KEYS, OPENROUTER_BASE_URL, OPENROUTER_TIMEOUT, OPENROUTER_HEDGE_DELAY,
+    OPENROUTER_FAILURE_THRESHOLD, OPENROUTER_COOLDOWN
+)
+
+logger = logging.getLogger(__name__)
+
+
+class OpenRouterError(RuntimeError):
+    """Запрос не удался ни с одним ключом."""
+
+
+class _FatalRequest(Exception):
+    """Ошибка в самом запросе (400/422) — другой ключ не поможет."""
+
+
+# =============================
+#   Предохранитель на каждый ключ
+# =============================
+class KeyBreaker:
+    """Состояние одного API-ключа: circuit breaker, лимиты и статистика.
+
+    closed — ключ используется; после failure_threshold ошибок подряд он
+    открывается на cooldown секунд (растёт вдвое при повторных срывах, до
+    10 минут). По истечении паузы пропускается одна пробная попытка
+    (half-open): успех закрывает предохранитель, ошибка открывает снова.
+    429 ставит ключ на паузу по Retry-After, не считаясь поломкой.
+    """
+
+    MAX_COOLDOWN = 600.0
+
+    def __init__(self, key: str, failure_threshold: int = OPENROUTER_FAILURE_THRESHOLD,
+                 cooldown: float = OPENROUTER_COOLDOWN):
+        self.key = key
+        self.failure_threshold = max(1, failure_threshold)
+        self.base_cooldown = cooldown
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0.0
+        self.rate_limited_until = 0.0
+        self.probing = False
+        self.success_rate = 1.0  # EWMA
+        self.latency = 1.0  # EWMA, секунды
+
+    @property
+    def label(self) -> str:
+        return f"{self.key[:10]}..."
+
+    @property
+    def state(self) -> str:
+        if self.failures < self.failure_threshold:
+            return "closed"
+        return "open" if time.monotonic() < self.open_until else "half_open"
+
+    def available(self, now: float | None = None) -> bool:
+        now = time.monotonic() if now is None else now
+        if now < self.rate_limited_until:
+            return False
+        if self.failures < self.failure_threshold:
+            return True
+        return now >= self.open_until and not self.probing
+
+    def ready_at(self) -> float:
+        return max(self.rate_limited_until, self.open_until if self.failures >= self.failure_threshold else 0.0)
+
+    def weight(self) -> float:
+        """Чем надёжнее и быстрее ключ, тем чаще он выбирается первым."""
+        return max(self.success_rate, 0.05) / max(self.latency, 0.05)
+
+    def acquire(self):
+        if self.failures >= self.failure_threshold:
+            self.probing = True
+
+    def record_success(self, latency: float):
+        self.failures = 0
+        self.probing = False
+        self.cooldown = self.base_cooldown
+        self.success_rate = 0.8 * self.success_rate + 0.2
+        self.latency = 0.8 * self.latency + 0.2 * latency
+
+    def record_failure(self, fatal_for_key: bool = False):
+        self.success_rate *= 0.8
+        was_probing = self.probing
+        self.probing = False
+        self.failures = self.failure_threshold if fatal_for_key else self.failures + 1
+        if self.failures >= self.failure_threshold:
+            if was_probing:
+                self.cooldown = min(self.cooldown * 2, self.MAX_COOLDOWN)
+            cooldown = self.MAX_COOLDOWN if fatal_for_key else self.cooldown
+            self.open_until = time.monotonic() + cooldown
+            logger.warning(f"OpenRouter ключ {self.label} отключён на {cooldown:.0f} с")
+
+    def record_rate_limit(self, retry_after: float):
+        self.probing = False
+        self.rate_limited_until = time.monotonic() + retry_after
+        logger.warning(f"OpenRouter ключ {self.label}: лимит запросов, пауза {retry_after:.0f} с")
+
+    def release(self):
+        """Попытка отменена (проиграла хедж-гонку) — пробный слот освобождается."""
+        self.probing = False
+
+
+def _retry_after_seconds(response: httpx.Response, default: float = 10.0) -> float:
+    value = response.headers.get("Retry-After")
+    try:
+        return max(0.0, float(value)) if value is not None else default
+    except ValueError:
+        return default
+
+
+# =============================
+#       Асинхронный клиент
+# =============================
+class OpenRouterClient:
+    """Асинхронный клиент OpenRouter с несколькими ключами.
+
+    Ключи выбираются случайно с весом по здоровью (успешность и задержка),
+    сломанные и упёршиеся в лимит пропускаются мгновенно. Если hedge_delay > 0
+    и первый ключ не ответил за это время, параллельно запускается запрос со
+    следующим ключом — побеждает первый успешный ответ.
+    """
+
+    def __init__(self, keys: list[str] = OPENROUTER_API_KEYS, http=None, base_url: str = OPENROUTER_BASE_URL,
+                 timeout: float = OPENROUTER_TIMEOUT, hedge_delay: float = OPENROUTER_HEDGE_DELAY,
+                 rng: random.Random | None = None):
+        self.breakers = [KeyBreaker(key) for key in keys]
+        self._http = http
+        self._own_client: httpx.AsyncClient | None = None
+        self.url = f"{base_url.rstrip('/')}/chat/completions"
+        self.timeout = timeout
+        self.hedge_delay = hedge_delay
+        self.rng = rng or random.Random()
+
+    def _client(self) -> httpx.AsyncClient:
+        if self._http is not None:
+            return self._http()
+        if self._own_client is None or self._own_client.is_closed:
+            self._own_client = httpx.AsyncClient()
+        return self._own_client
+
+    def _order(self) -> list[KeyBreaker]:
+        """Доступные ключи в порядке взвешенной случайной выборки; если доступных нет — ближайший к восстановлению."""
+        now = time.monotonic()
+        pool = [b for b in self.breakers if b.available(now)]
+        order = []
+        while pool:
+            weights = [b.weight() for b in pool]
+            chosen = self.rng.choices(pool, weights=weights)[0]
+            pool.remove(chosen)
+            order.append(chosen)
+        if not order and self.breakers:
+            order.append(min(self.breakers, key=KeyBreaker.ready_at))
+        return order
+
+    async def _attempt(self, breaker: KeyBreaker, payload: dict) -> str:
+        breaker.acquire()
+        started = time.monotonic()
+        try:
+            response = await self._client().post(
+                self.url,
+                headers={"Authorization": f"Bearer {breaker.key}"},
+                json=payload,
+                timeout=self.timeout,
+            )
+        except asyncio.CancelledError:
+            breaker.release()
+            raise
+        except httpx.HTTPError as e:
+            breaker.record_failure()
+            raise OpenRouterError(f"Ключ {breaker.label}: {type(e).__name__}: {e}") from e
+
+        if response.status_code == 429:
+            breaker.record_rate_limit(_retry_after_seconds(response))
+            raise OpenRouterError(f"Ключ {breaker.label}: 429 Too Many Requests")
+        if response.status_code in (401, 402, 403):
+            breaker.record_failure(fatal_for_key=True)
+            raise OpenRouterError(f"Ключ {breaker.label}: HTTP {response.status_code}")
+        if response.status_code in (400, 422):
+            breaker.release()
+            raise _FatalRequest(f"OpenRouter отклонил запрос: HTTP {response.status_code} {response.text[:200]}")
+        if response.status_code >= 400:
+            breaker.record_failure()
+            raise OpenRouterError(f"Ключ {breaker.label}: HTTP {response.status_code}")
+        try:
+            content = response.json()["choices"][0]["message"]["content"].strip()
+        except (ValueError, KeyError, IndexError, TypeError, AttributeError) as e:
+            breaker.record_failure()
+            raise OpenRouterError(f"Ключ {breaker.label}: неожиданный ответ ({e})") from e
+        breaker.record_success(time.monotonic() - started)
+        return content
+
+    async def chat(self, messages: list[dict], model: str, temperature: float = 0.2) -> str:
+        payload = {"model": model, "messages": messages, "temperature": temperature}
+        order = self._order()
+        if not order:
+            raise OpenRouterError("Не задан ни один ключ OpenRouter (OPENROUTER_API_KEYS)")
+        errors: list[str] = []
+        pending: set[asyncio.Task] = set()
+        try:
+            while order or pending:
+                if order and (not pending or self.hedge_delay > 0):
+                    pending.add(asyncio.create_task(self._attempt(order.pop(0), payload)))
+                wait_for_hedge = self.hedge_delay if order and self.hedge_delay > 0 else None
+                done, pending = await asyncio.wait(pending, timeout=wait_for_hedge, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        return task.result()
+                    except _FatalRequest as e:
+                        raise OpenRouterError(str(e)) from e
+                    except OpenRouterError as e:
+                        logger.warning(str(e))
+                        errors.append(str(e))
+        finally:
+            for task in pending:
+                task.cancel()
+        raise OpenRouterError(f"Все ключи OpenRouter не сработали: {'; '.join(errors)}")
+
+    def stats(self) -> list[dict]:
+        return [
+            {"key": b.label, "state": b.state, "success_rate": round(b.success_rate, 3),
+             "latency": round(b.latency, 3), "rate_limited": b.rate_limited_until > time.monotonic()}
+            for b in self.breakers
+        ]
+
+    async def aclose(self):
+        if self._own_client is not None:
+            await self._own_client.aclose()
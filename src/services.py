@@ -1,30 +1,78 @@
 import asyncio
+import copy
 import logging
 import os
 import tempfile
 import subprocess
+import threading
+import time
 import io
-import yt_dlp
 import httpx
 import uuid
 import json
-import requests
-from reportlab.pdfbase import pdfmetrics
-from reportlab.pdfbase.ttfonts import TTFont
-from reportlab.lib.pagesizes import A4
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Spacer
-from reportlab.lib.styles import getSampleStyleSheet
-from PIL import Image, ImageDraw, ImageFont
+import re
+import hashlib
+import random
+import textwrap
+from collections import OrderedDict
 
 from .config import (
     ASSEMBLYAI_BASE_URL, HEADERS, API_TIMEOUT, FFMPEG_PATH,
-    SEGMENT_DURATION, OPENROUTER_API_KEYS, FONT_PATH,
-    YOOMONEY_WALLET, SUBSCRIPTION_AMOUNT
+    SEGMENT_DURATION, OPENROUTER_MODEL, SUBTITLE_MAX_CHARS, SUBTITLE_MAX_DURATION_MS, SUBTITLE_LINE_WIDTH, SUMMARY_CHUNK_TOKENS, SUMMARY_CONCURRENCY, SUMMARY_CACHE_SIZE,
+    YOOMONEY_WALLET, SUBSCRIPTION_AMOUNT,
+    TRANSCRIBE_CHUNKED, TRANSCRIBE_CHUNK_THRESHOLD, TRANSCRIBE_CHUNK_DURATION,
+    TRANSCRIBE_CHUNK_OVERLAP, TRANSCRIBE_CHUNK_CONCURRENCY, UPLOAD_CHUNK_SIZE,
+    TRANSCRIBE_TIMEOUT, TRANSCRIBE_SPEED_RATIO, POLL_INITIAL_DELAY, POLL_MAX_DELAY,
+    POLL_BACKOFF_FACTOR, POLL_JITTER, POLL_WEBHOOK_FALLBACK_DELAY,
+    SPEECH_AUDIO_FORMAT, SPEECH_SAMPLE_RATE, SPEECH_AUDIO_BITRATE,
+    FFPROBE_PATH, AUDIO_PASSTHROUGH_CODECS, AUDIO_PASSTHROUGH_MAX_CHANNELS,
+    AUDIO_PASSTHROUGH_MAX_SAMPLE_RATE, YOUTUBE_AUDIO_PASSTHROUGH
 )
+from .http_clients import HttpClients
+from .transcript_webhook import TranscriptWebhook
+from .transcript_cache import TranscriptCache, audio_cache_key
+from .openrouter import OpenRouterClient
+from .youtube import YoutubeMetadata, DownloadCancelled, download_manager, youtube_download_options
+from .transcript import Transcript, as_transcript
+from .documents import save_text_to_pdf, save_text_to_txt, save_text_to_md, save_text_to_docx  # noqa: F401
 
 logger = logging.getLogger(__name__)
 
 
+# =============================
+#     Общие HTTP-клиенты
+# =============================
+http_clients: HttpClients | None = None
+transcript_webhook: TranscriptWebhook | None = None
+transcript_cache: TranscriptCache | None = None
+openrouter: OpenRouterClient | None = None
+
+
+def set_http_clients(clients: HttpClients):
+    """Подключает реестр клиентов, созданный в bot.main."""
+    global http_clients
+    http_clients = clients
+
+
+def set_transcript_webhook(webhook: TranscriptWebhook | None):
+    """Включает ожидание транскриптов по webhook вместо частого опроса."""
+    global transcript_webhook
+    transcript_webhook = webhook
+
+
+def set_transcript_cache(cache: TranscriptCache | None):
+    """Включает кэш готовых транскриптов (повторные файлы и ссылки не идут в AssemblyAI)."""
+    global transcript_cache
+    transcript_cache = cache
+
+
+def _http(name: str) -> httpx.AsyncClient:
+    global http_clients
+    if http_clients is None:
+        http_clients = HttpClients()
+    return http_clients.get(name)
+
+
 # =============================
 #     YooMoney Payment
 # =============================
@@ -41,170 +89,196 @@ async def create_yoomoney_payment(user_id: int, amount: int, description: str) -
         "label": payment_label,
     }
     
-    async with httpx.AsyncClient() as client:
-        try:
-            # The POST request is for validation. A 302 redirect is expected and not an error.
-            await client.post(quickpay_url, data=params)
-            
-            # YooMoney QuickPay form doesn't return a JSON with a URL,
-            # it redirects. We build the URL for the user to follow.
-            # The above POST is more for validation/logging on YooMoney's side.
-            # The actual payment link is constructed with GET parameters.
-            
-            from urllib.parse import urlencode
-            encoded_params = urlencode(params)
-            payment_url = f"https://yoomoney.ru/quickpay/confirm.xml?{encoded_params}"
-            
-            logger.info(f"Создана ссылка на оплату для user_id {user_id}: {payment_label}")
-            return payment_url, payment_label
-
-        except httpx.RequestError as e:
-            logger.error(f"Ошибка при создании платежа YooMoney для user_id {user_id}: {e}")
-            return None, None
-
-
-# =============================
-#     Регистрация шрифта PDF
-# =============================
-try:
-    # Try to register DejaVu font first
-    if os.path.exists(FONT_PATH):
-        pdfmetrics.registerFont(TTFont("DejaVu", FONT_PATH))
-        logger.info(f"Successfully registered DejaVu font: {FONT_PATH}")
-    else:
-        logger.warning(f"DejaVu font not found: {FONT_PATH}")
-
-    # Register Noto Sans font for excellent Cyrillic/Unicode support
-    noto_path = os.path.join(os.path.dirname(FONT_PATH), "NotoSans-Regular.ttf")
-    if os.path.exists(noto_path):
-        pdfmetrics.registerFont(TTFont("NotoSans", noto_path))
-        logger.info(f"Successfully registered NotoSans font: {noto_path}")
-    else:
-        logger.warning(f"NotoSans font not found: {noto_path}")
-
-    # Register Arial font as fallback
-    arial_path = os.path.join(os.path.dirname(FONT_PATH), "arial.ttf")
-    if os.path.exists(arial_path):
-        pdfmetrics.registerFont(TTFont("Arial", arial_path))
-        logger.info(f"Successfully registered Arial font: {arial_path}")
-    else:
-        logger.warning(f"Arial font not found: {arial_path}, using default fonts")
-except Exception as e:
-    logger.error(f"Failed to register custom fonts: {e}, using default fonts")
-
-# ---------- Сохранение в разные форматы ----------
-
-def _register_pdf_font_if_needed():
-    try:
-        # Register NotoSans if not already registered (best Unicode support)
-        noto_path = os.path.join(os.path.dirname(FONT_PATH), "NotoSans-Regular.ttf")
-        if 'NotoSans' not in pdfmetrics.getRegisteredFontNames() and os.path.exists(noto_path):
-            pdfmetrics.registerFont(TTFont("NotoSans", noto_path))
-
-        # Register Arial if not already registered
-        arial_path = os.path.join(os.path.dirname(FONT_PATH), "arial.ttf")
-        if 'Arial' not in pdfmetrics.getRegisteredFontNames() and os.path.exists(arial_path):
-            pdfmetrics.registerFont(TTFont("Arial", arial_path))
-
-        # Register DejaVu if not already registered
-        if 'DejaVu' not in pdfmetrics.getRegisteredFontNames() and os.path.exists(FONT_PATH):
-            pdfmetrics.registerFont(TTFont("DejaVu", FONT_PATH))
-    except Exception:
-        pass
-
-def save_text_to_pdf(text: str, output_path: str):
-    _register_pdf_font_if_needed()
-    doc = SimpleDocTemplate(output_path, pagesize=A4,
-                            rightMargin=50, leftMargin=50,
-                            topMargin=50, bottomMargin=50)
-    styles = getSampleStyleSheet()
-
-    # Ensure proper encoding for Cyrillic text
-    from reportlab.pdfbase import pdfdoc
-    pdfdoc.ENCODING = 'UTF-8'
-
-    style = styles['Normal']
-    # Use NotoSans if available (best Unicode support), otherwise Arial, then DejaVu, then defaults
-    available_fonts = pdfmetrics.getRegisteredFontNames()
-    if 'NotoSans' in available_fonts:
-        style.fontName = 'NotoSans'
-    elif 'Arial' in available_fonts:
-        style.fontName = 'Arial'
-    elif 'DejaVu' in available_fonts:
-        style.fontName = 'DejaVu'
-    else:
-        # Try fonts that typically support Cyrillic/Unicode
-        preferred_fonts = ['Times-Roman', 'Courier', 'Times-Bold', 'Courier-Bold']
-        style.fontName = next((f for f in preferred_fonts if f in available_fonts), 'Times-Roman')
-    style.fontSize = 12
-    style.leading = 15
-
-    # Ensure text is properly handled as Unicode
-    if isinstance(text, bytes):
-        text = text.decode('utf-8', errors='replace')
-    elif not isinstance(text, str):
-        text = str(text)
-
-    # Clean and normalize the text
-    import unicodedata
-    text = unicodedata.normalize('NFC', text)
-
-    paragraphs = [Paragraph(p.replace('\n', '<br />'), style) for p in text.split('\n\n') if p.strip()]
-    elems = []
-    for p in paragraphs:
-        elems.append(p)
-        elems.append(Spacer(1, 12))
-    doc.build(elems)
-
-
-def save_text_to_txt(text: str, output_path: str):
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(text)
-
-
-def save_text_to_md(text: str, output_path: str):
-    with open(output_path, 'w', encoding='utf-8') as f:
-        f.write(text)
-
-
-def save_text_to_docx(text: str, output_path: str):
+    client = _http("yoomoney")
     try:
-        from docx import Document
-        doc = Document()
-        for par in text.split("\n\n"):
-            for line in par.split("\n"):
-                doc.add_paragraph(line)
-            doc.add_paragraph("")
-        doc.save(output_path)
-    except Exception as e:
-        logger.warning(f"Не удалось сохранить DOCX ({e}), сохраняю как TXT")
-        save_text_to_txt(text, output_path)
+        # The POST request is for validation. A 302 redirect is expected and not an error.
+        await client.post(quickpay_url, data=params)
+        
+        # YooMoney QuickPay form doesn't return a JSON with a URL,
+        # it redirects. We build the URL for the user to follow.
+        # The above POST is more for validation/logging on YooMoney's side.
+        # The actual payment link is constructed with GET parameters.
+        
+        from urllib.parse import urlencode
+        encoded_params = urlencode(params)
+        payment_url = f"https://yoomoney.ru/quickpay/confirm.xml?{encoded_params}"
+        
+        logger.info(f"Создана ссылка на оплату для user_id {user_id}: {payment_label}")
+        return payment_url, payment_label
+
+    except httpx.RequestError as e:
+        logger.error(f"Ошибка при создании платежа YooMoney для user_id {user_id}: {e}")
+        return None, None
 
 
 # ---------- Аудио-обработка / API ----------
+_DURATION_RE = re.compile(r"Duration:\s*(\d+):(\d+):(\d+(?:\.\d+)?)")
+_SILENCE_START_RE = re.compile(r"silence_start:\s*(-?\d+(?:\.\d+)?)")
+_SILENCE_END_RE = re.compile(r"silence_end:\s*(-?\d+(?:\.\d+)?)")
+
+
+def _parse_duration(ffmpeg_stderr: str) -> float | None:
+    match = _DURATION_RE.search(ffmpeg_stderr)
+    if not match:
+        return None
+    hours, minutes, seconds = match.groups()
+    return int(hours) * 3600 + int(minutes) * 60 + float(seconds)
+
+
+def _parse_silencedetect(ffmpeg_stderr: str) -> tuple[float, list[tuple[float, float]]]:
+    duration = _parse_duration(ffmpeg_stderr) or 0.0
+    silences = []
+    start = None
+    for line in ffmpeg_stderr.splitlines():
+        if (m := _SILENCE_START_RE.search(line)):
+            start = max(0.0, float(m.group(1)))
+        elif (m := _SILENCE_END_RE.search(line)) and start is not None:
+            silences.append((start, float(m.group(1))))
+            start = None
+    if start is not None:
+        silences.append((start, duration))
+    return duration, silences
+
+
+def choose_split_points(duration: float, silences: list[tuple[float, float]],
+                        chunk_duration: float, search_window: float | None = None) -> list[float]:
+    """Выбирает точки разреза около каждых chunk_duration секунд.
+
+    Режем в середине ближайшей паузы в пределах search_window от цели;
+    если пауз рядом нет — ровно в целевой точке. Хвост короче четверти
+    фрагмента присоединяется к последнему фрагменту.
+    """
+    window = chunk_duration * 0.2 if search_window is None else search_window
+    midpoints = [(start + end) / 2 for start, end in silences]
+    points = []
+    last = 0.0
+    while duration - last > chunk_duration * 1.25:
+        target = last + chunk_duration
+        candidates = [m for m in midpoints if abs(m - target) <= window and m > last]
+        point = min(candidates, key=lambda m: abs(m - target)) if candidates else target
+        points.append(point)
+        last = point
+    return points
+
+
 class AudioProcessor:
     @staticmethod
-    def split_audio(input_path: str, segment_time: int = SEGMENT_DURATION) -> list[str]:
+    def _segment(input_path: str, segment_args: list[str], ext: str) -> list[tuple[str, float]]:
+        """Режет файл сегмент-мультиплексором ffmpeg без перекодирования.
+
+        Возвращает пары (путь к фрагменту, фактическое начало в секундах):
+        при -c copy ffmpeg режет по границам кадров, поэтому реальные
+        смещения берём из списка сегментов, а не из запрошенных точек.
+        """
         output_dir = tempfile.mkdtemp(prefix="fragments_")
-        output_pattern = os.path.join(output_dir, "fragment_%03d.mp3")
+        output_pattern = os.path.join(output_dir, f"fragment_%03d{ext}")
+        segment_list = os.path.join(output_dir, "segments.csv")
         command = [
             FFMPEG_PATH,
             "-i", input_path,
             "-f", "segment",
-            "-segment_time", str(segment_time),
+            *segment_args,
+            "-segment_list", segment_list,
+            "-segment_list_type", "csv",
+            "-reset_timestamps", "1",
             "-c", "copy",
             output_pattern
         ]
         try:
             subprocess.run(command, check=True, capture_output=True, text=True)
-            return sorted([
-                os.path.join(output_dir, f)
-                for f in os.listdir(output_dir)
-                if f.startswith("fragment_") and f.endswith(".mp3")
-            ])
         except subprocess.CalledProcessError as e:
             logger.error(f"FFmpeg error: {e.stderr}")
+            AudioProcessor.cleanup([output_dir])
             raise RuntimeError("Ошибка при разделении аудио") from e
+        fragments = []
+        with open(segment_list, encoding="utf-8") as f:
+            for line in f:
+                name, start, _end = line.strip().rsplit(",", 2)
+                fragments.append((os.path.join(output_dir, name), float(start)))
+        os.remove(segment_list)
+        return fragments
+
+    @staticmethod
+    def split_audio(input_path: str, segment_time: int = SEGMENT_DURATION) -> list[str]:
+        ext = os.path.splitext(input_path)[1] or ".mp3"
+        fragments = AudioProcessor._segment(input_path, ["-segment_time", str(segment_time)], ext)
+        return [path for path, _ in fragments]
+
+    @staticmethod
+    def detect_silences(input_path: str, noise_db: int = -30, min_silence: float = 0.5) -> tuple[float, list[tuple[float, float]]]:
+        """Находит паузы через фильтр silencedetect. Возвращает (длительность, [(начало, конец)])."""
+        command = [
+            FFMPEG_PATH,
+            "-i", input_path,
+            "-af", f"silencedetect=noise={noise_db}dB:d={min_silence}",
+            "-f", "null", "-"
+        ]
+        try:
+            result = subprocess.run(command, check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            logger.error(f"FFmpeg error: {e.stderr}")
+            raise RuntimeError("Ошибка анализа пауз в аудио") from e
+        return _parse_silencedetect(result.stderr)
+
+    @staticmethod
+    def _concat(paths: list[str], output_path: str):
+        """Склеивает куски одного файла concat-демультиплексором без перекодирования."""
+        list_path = f"{output_path}.txt"
+        with open(list_path, "w", encoding="utf-8") as f:
+            for path in paths:
+                f.write(f"file '{path}'\n")
+        command = [FFMPEG_PATH, "-f", "concat", "-safe", "0", "-i", list_path, "-c", "copy", "-y", output_path]
+        try:
+            subprocess.run(command, check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            logger.error(f"FFmpeg error: {e.stderr}")
+            raise RuntimeError("Ошибка при склейке фрагментов аудио") from e
+        finally:
+            os.remove(list_path)
+
+    @staticmethod
+    def split_on_silence(input_path: str, chunk_duration: int = TRANSCRIBE_CHUNK_DURATION,
+                         overlap: float = TRANSCRIBE_CHUNK_OVERLAP) -> list[tuple[str, float, float]]:
+        """Режет длинную запись на фрагменты ~chunk_duration секунд по ближайшим паузам.
+
+        Возвращает тройки (путь, начало фрагмента, перекрытие): каждый фрагмент,
+        кроме первого, начинается на overlap секунд раньше своей точки разреза и
+        повторяет конец предыдущего. По этому общему звуку merge_chunk_transcripts
+        сопоставляет спикеров соседних фрагментов.
+        """
+        duration, silences = AudioProcessor.detect_silences(input_path)
+        points = choose_split_points(duration, silences, chunk_duration)
+        if not points:
+            return [(input_path, 0.0, 0.0)]
+        ext = os.path.splitext(input_path)[1] or ".mp3"
+        overlap = min(overlap, chunk_duration / 4)
+        if overlap <= 0:
+            segment_times = ",".join(f"{p:.3f}" for p in points)
+            fragments = AudioProcessor._segment(input_path, ["-segment_times", segment_times], ext)
+            return [(path, start, 0.0) for path, start in fragments]
+
+        # Куски: основной, перекрытие, основной, перекрытие, ... — перекрытие
+        # входит и в конец предыдущего фрагмента, и в начало следующего
+        segment_times = ",".join(f"{t:.3f}" for p in points for t in (p - overlap, p))
+        pieces = AudioProcessor._segment(input_path, ["-segment_times", segment_times], ext)
+        output_dir = os.path.dirname(pieces[0][0])
+        if len(pieces) != 2 * len(points) + 1:
+            AudioProcessor.cleanup([output_dir])
+            raise RuntimeError(f"Ожидалось {2 * len(points) + 1} кусков аудио, получено {len(pieces)}")
+        fragments = []
+        try:
+            for i in range(len(points) + 1):
+                first = max(0, 2 * i - 1)
+                last = min(len(pieces) - 1, 2 * i + 1)
+                output_path = os.path.join(output_dir, f"fragment_joined_{i:03d}{ext}")
+                AudioProcessor._concat([path for path, _ in pieces[first:last + 1]], output_path)
+                start = pieces[first][1]
+                fragments.append((output_path, start, pieces[2 * i][1] - start))
+        except Exception:
+            AudioProcessor.cleanup([output_dir])
+            raise
+        AudioProcessor.cleanup([path for path, _ in pieces])
+        return fragments
 
     @staticmethod
     def cleanup(files: list[str]):
@@ -220,27 +294,110 @@ class AudioProcessor:
                 logger.warning(f"Ошибка удаления {path}: {e}")
 
 
-async def upload_to_assemblyai(file_path: str, retries: int = 3) -> str:
+class _LatestProgress:
+    """Передаёт прогресс в callback, не задерживая производителя.
+
+    Пока предыдущий вызов callback не завершился, промежуточные значения
+    схлопываются до последнего.
+    """
+
+    def __init__(self, callback):
+        self._callback = callback
+        self._latest = None
+        self._task: asyncio.Task | None = None
+
+    def report(self, value: float):
+        self._latest = value
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._drain())
+
+    async def _drain(self):
+        while self._latest is not None:
+            value, self._latest = self._latest, None
+            try:
+                await self._callback(value)
+            except Exception as e:
+                logger.warning(f"Ошибка обработки прогресса: {e}")
+
+    async def aclose(self):
+        if self._task is not None:
+            await self._task
+
+
+async def _read_file_chunks(file_path: str, chunk_size: int, on_sent=None):
+    """Асинхронно отдаёт файл кусками по chunk_size байт; on_sent(отправлено, всего)."""
+    total = os.path.getsize(file_path)
+    sent = 0
+    with open(file_path, "rb") as f:
+        while True:
+            chunk = await asyncio.to_thread(f.read, chunk_size)
+            if not chunk:
+                break
+            yield chunk
+            # Сюда возвращаемся, когда httpx уже записал кусок в сокет
+            sent += len(chunk)
+            if on_sent:
+                on_sent(sent, total)
+
+
+async def upload_to_assemblyai(file_path: str, retries: int = 3, progress_callback=None) -> str:
+    """Загружает файл сырым телом запроса (без multipart), читая его потоково.
+
+    Память не зависит от размера файла; progress_callback(доля 0..1)
+    вызывается по фактически отправленным байтам.
+    """
+    client = _http("assemblyai")
+    headers = {**HEADERS, "content-type": "application/octet-stream",
+               "content-length": str(os.path.getsize(file_path))}
     for attempt in range(retries):
+        progress = _LatestProgress(progress_callback) if progress_callback else None
+        on_sent = (lambda sent, total: progress.report(sent / total if total else 1.0)) if progress else None
         try:
-            async with httpx.AsyncClient() as client:
-                with open(file_path, "rb") as f:
-                    response = await client.post(
-                        f"{ASSEMBLYAI_BASE_URL}/upload",
-                        headers=HEADERS,
-                        files={"file": f},
-                        timeout=API_TIMEOUT
-                    )
-                response.raise_for_status()
-                return response.json()["upload_url"]
+            response = await client.post(
+                f"{ASSEMBLYAI_BASE_URL}/upload",
+                headers=headers,
+                content=_read_file_chunks(file_path, UPLOAD_CHUNK_SIZE, on_sent),
+                timeout=API_TIMEOUT
+            )
+            response.raise_for_status()
+            return response.json()["upload_url"]
         except Exception as e:
             logger.warning(f"Попытка {attempt + 1}/{retries} загрузки файла не удалась: {str(e)}")
             if attempt == retries - 1:
                 raise RuntimeError("Не удалось загрузить файл на сервер AssemblyAI") from e
             await asyncio.sleep(2 ** attempt)
+        finally:
+            if progress:
+                await progress.aclose()
+
+
+def polling_delays(audio_duration: float | None = None, rng=random.random):
+    """Паузы между опросами статуса транскрипта.
+
+    Первая пауза — около ожидаемого времени обработки (по длительности
+    аудио), дальше экспоненциальный backoff от POLL_INITIAL_DELAY до
+    POLL_MAX_DELAY. К каждой паузе добавляется jitter ±POLL_JITTER, чтобы
+    одновременно запущенные задания не опрашивали API синхронно.
+    """
+    def jittered(value: float) -> float:
+        return value * (1 + POLL_JITTER * (2 * rng() - 1))
+
+    if audio_duration:
+        yield jittered(max(POLL_INITIAL_DELAY, 0.8 * audio_duration * TRANSCRIBE_SPEED_RATIO))
+    delay = POLL_INITIAL_DELAY
+    while True:
+        yield jittered(delay)
+        delay = min(delay * POLL_BACKOFF_FACTOR, POLL_MAX_DELAY)
+
+
+def _retry_after(response: httpx.Response) -> float | None:
+    try:
+        return float(response.headers.get("retry-after"))
+    except (TypeError, ValueError):
+        return None
 
 
-async def transcribe_with_assemblyai(audio_url: str, retries: int = 3) -> dict:
+async def transcribe_with_assemblyai(audio_url: str, retries: int = 3, audio_duration: float | None = None) -> dict:
     headers = {
         "authorization": HEADERS['authorization'],
         "content-type": "application/json"
@@ -253,69 +410,331 @@ async def transcribe_with_assemblyai(audio_url: str, retries: int = 3) -> dict:
         "language_code": "ru",  # Explicitly set Russian language
         "language_detection": False  # Disable auto-detection since we specify Russian
     }
+    webhook = transcript_webhook
+    if webhook:
+        payload.update(webhook.request_params())
+    client = _http("assemblyai")
+    loop = asyncio.get_running_loop()
+    deadline = loop.time() + TRANSCRIBE_TIMEOUT
+
+    async def wait(delay: float, waiter: asyncio.Future | None):
+        remaining = deadline - loop.time()
+        if remaining <= 0:
+            raise TimeoutError(f"Транскрибация не завершилась за {TRANSCRIBE_TIMEOUT} с")
+        delay = min(delay, remaining)
+        if waiter is None:
+            await asyncio.sleep(delay)
+            return
+        try:
+            await asyncio.wait_for(asyncio.shield(waiter), timeout=delay)
+        except asyncio.TimeoutError:
+            pass
+
     for attempt in range(retries):
+        transcript_id = None
         try:
-            async with httpx.AsyncClient() as client:
-                resp = await client.post(
-                    "https://api.assemblyai.com/v2/transcript",
-                    headers=headers, json=payload
-                )
-                resp.raise_for_status()
-                transcript_id = resp.json()["id"]
-                while True:
+            resp = await client.post(
+                f"{ASSEMBLYAI_BASE_URL}/transcript",
+                headers=headers, json=payload
+            )
+            resp.raise_for_status()
+            transcript_id = resp.json()["id"]
+            waiter = webhook.expect(transcript_id) if webhook else None
+            delays = polling_delays(audio_duration)
+            while True:
+                if waiter is None:
+                    await wait(next(delays), None)
+                elif not waiter.done():
+                    # С webhook опрос — лишь редкая страховка на случай потерянного уведомления
+                    await wait(POLL_WEBHOOK_FALLBACK_DELAY, waiter)
+                # Временные сбои опроса повторяются здесь же: транскрипт уже создан и оплачен
+                try:
                     status = await client.get(
-                        f"https://api.assemblyai.com/v2/transcript/{transcript_id}",
+                        f"{ASSEMBLYAI_BASE_URL}/transcript/{transcript_id}",
                         headers=headers
                     )
-                    result = status.json()
-                    if result["status"] == "completed":
-                        return result
-                    elif result["status"] == "error":
-                        raise Exception(result["error"])
-                    await asyncio.sleep(3)
+                except httpx.TransportError as e:
+                    logger.warning(f"Опрос {transcript_id} не удался ({e!r}), повторю позже")
+                    await wait(next(delays), None)
+                    continue
+                if status.status_code in (408, 429) or status.status_code >= 500:
+                    logger.warning(f"AssemblyAI ответил {status.status_code} на опрос {transcript_id}, повторю позже")
+                    await wait(_retry_after(status) or next(delays), None)
+                    continue
+                status.raise_for_status()
+                result = status.json()
+                if result["status"] == "completed":
+                    return result
+                elif result["status"] == "error":
+                    raise Exception(result["error"])
+                if waiter is not None and waiter.done():
+                    waiter = webhook.expect(transcript_id)
+        except TimeoutError:
+            logger.error(f"Транскрипт {transcript_id} не готов за {TRANSCRIBE_TIMEOUT} с")
+            raise
         except Exception as e:
+            if isinstance(e, httpx.HTTPStatusError) and transcript_id is not None:
+                # Постоянная ошибка опроса: новый транскрипт её не исправит, а будет оплачен повторно
+                logger.error(f"Опрос транскрипта {transcript_id} отклонён: {e.response.status_code}")
+                raise
             logger.warning(f"Попытка {attempt + 1}/{retries} транскрипции не удалась: {str(e)}")
             if attempt == retries - 1:
                 raise
             await asyncio.sleep(2 ** attempt)
+        finally:
+            if webhook and transcript_id:
+                webhook.forget(transcript_id)
 
 
-async def download_youtube_audio(url: str, progress_callback: callable = None) -> str:
-    loop = asyncio.get_running_loop()
-    progress_queue = asyncio.Queue()
+async def get_audio_duration(file_path: str) -> float | None:
+    """Длительность записи в секундах по заголовку, который печатает ffmpeg -i."""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFMPEG_PATH, "-i", file_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        _, stderr = await process.communicate()
+    except OSError as e:
+        logger.warning(f"Не удалось определить длительность {file_path}: {e}")
+        return None
+    return _parse_duration(stderr.decode(errors="replace"))
+
 
-    def progress_hook(data):
-        if data['status'] == 'downloading' and progress_callback:
+SPEAKER_MATCH_MIN_MS = 1000  # меньше общей речи в перекрытии — не считаем одним человеком
+
+
+def _speaker_label(index: int) -> str:
+    return chr(ord("A") + index) if index < 26 else f"S{index + 1}"
+
+
+def _talk_time(utterances: list[dict]) -> dict[str, int]:
+    talk_time = {}
+    for utt in utterances:
+        label = utt.get("speaker", "?")
+        if label == "?":
+            continue
+        spoken = (utt.get("end") or 0) - (utt.get("start") or 0)
+        talk_time[label] = talk_time.get(label, 0) + (spoken if spoken > 0 else len(utt.get("text") or ""))
+    return talk_time
+
+
+def _match_speakers(previous: list[dict], current: list[dict], window: tuple[int, int]) -> dict[str, str]:
+    """Метки текущего фрагмента -> общие метки по совместной речи в окне перекрытия.
+
+    previous — реплики предыдущего фрагмента уже с общими метками, current —
+    с метками своего задания; времена абсолютные. Пары берутся жадно по
+    убыванию длительности совпадения.
+    """
+    lo, hi = window
+    shared: dict[tuple[str, str], int] = {}
+    for cur in current:
+        if cur.get("speaker", "?") == "?":
+            continue
+        c_start, c_end = max(cur["start"], lo), min(cur["end"], hi)
+        if c_end <= c_start:
+            continue
+        for prev in previous:
+            if prev["speaker"] == "?":
+                continue
+            common = min(c_end, prev["end"]) - max(c_start, prev["start"])
+            if common > 0:
+                pair = (cur["speaker"], prev["speaker"])
+                shared[pair] = shared.get(pair, 0) + common
+    mapping = {}
+    for (label, global_label), common in sorted(shared.items(), key=lambda item: item[1], reverse=True):
+        if common < SPEAKER_MATCH_MIN_MS:
+            break
+        if label not in mapping and global_label not in mapping.values():
+            mapping[label] = global_label
+    return mapping
+
+
+def merge_chunk_transcripts(chunk_results: list[tuple[float, dict, float]]) -> dict:
+    """Склеивает результаты AssemblyAI по фрагментам (начало, результат, перекрытие) в один.
+
+    Времена (start/end реплик и слов) сдвигаются на начало фрагмента.
+    AssemblyAI размечает спикеров в каждом задании независимо, поэтому метки
+    сопоставляются по перекрытию: начало фрагмента повторяет конец
+    предыдущего, и метка получает общую метку того спикера, с чьей речью
+    в этом окне она совпала дольше всего. Несовпавшие спикеры (и все — при
+    нулевом перекрытии) получают новые метки. Из перекрытия берутся реплики
+    предыдущего фрагмента; реплика следующего, начатая в перекрытии,
+    обрезается по словам до границы, дубликаты отбрасываются.
+    """
+    utterances = []
+    texts = []
+    previous: list[dict] = []
+    speaker_count = 0
+    for offset, result, overlap in sorted(chunk_results, key=lambda item: item[0]):
+        offset_ms = int(round(offset * 1000))
+        own_from = offset_ms + int(round(overlap * 1000))
+        chunk_utterances = []
+        for utt in result.get("utterances") or []:
+            shifted = dict(utt)
+            shifted["start"] = (utt.get("start") or 0) + offset_ms
+            shifted["end"] = (utt.get("end") or 0) + offset_ms
+            chunk_utterances.append(shifted)
+        if not chunk_utterances and (result.get("text") or "").strip():
+            # Без реплик дубликаты не отделить — текст фрагмента берётся целиком
+            chunk_utterances = [{"speaker": "?", "text": result["text"], "start": own_from,
+                                 "end": offset_ms + int((result.get("audio_duration") or 0) * 1000), "words": []}]
+
+        speakers = _match_speakers(previous, chunk_utterances, (offset_ms, own_from)) if overlap > 0 else {}
+        talk_time = _talk_time(chunk_utterances)
+        for label in sorted(talk_time, key=talk_time.get, reverse=True):
+            if label not in speakers:
+                speakers[label] = _speaker_label(speaker_count)
+                speaker_count += 1
+
+        kept = []
+        for utt in chunk_utterances:
+            merged = dict(utt)
+            merged["speaker"] = speakers.get(utt.get("speaker", "?"), "?")
+            merged["words"] = [
+                {**word, "start": word["start"] + offset_ms, "end": word["end"] + offset_ms,
+                 "speaker": merged["speaker"]}
+                for word in (utt.get("words") or [])
+            ]
+            if merged["start"] < own_from:
+                # Начало реплики уже есть в предыдущем фрагменте — остаются слова после границы
+                merged["words"] = [word for word in merged["words"] if word["start"] >= own_from]
+                if not merged["words"]:
+                    continue
+                merged["start"] = merged["words"][0]["start"]
+                merged["text"] = " ".join(word["text"] for word in merged["words"])
+            kept.append(merged)
+        utterances.extend(kept)
+        texts.extend(u["text"].strip() for u in kept if (u.get("text") or "").strip())
+        previous = kept
+    return {"status": "completed", "utterances": utterances, "text": " ".join(texts)}
+
+
+async def transcribe_in_chunks(file_path: str, progress_callback=None,
+                               chunk_duration: int = TRANSCRIBE_CHUNK_DURATION,
+                               concurrency: int = TRANSCRIBE_CHUNK_CONCURRENCY) -> dict:
+    """Режет запись по паузам и транскрибирует фрагменты параллельно (не более concurrency)."""
+    chunks = await asyncio.to_thread(AudioProcessor.split_on_silence, file_path, chunk_duration)
+    return await transcribe_chunks(chunks, progress_callback, concurrency)
+
+
+async def transcribe_chunks(chunks: list[tuple[str, float, float]], progress_callback=None,
+                            concurrency: int = TRANSCRIBE_CHUNK_CONCURRENCY) -> dict:
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    done = 0
+    logger.info(f"Транскрибация по фрагментам: {len(chunks)} шт., параллельно до {concurrency}")
+
+    async def run(chunk_path: str, offset: float, overlap: float, end: float | None):
+        nonlocal done
+        async with semaphore:
+            audio_url = await upload_to_assemblyai(chunk_path)
+            result = await transcribe_with_assemblyai(audio_url, audio_duration=(end - offset) if end else None)
+        done += 1
+        if progress_callback:
+            await progress_callback(0.30 + 0.60 * done / len(chunks))
+        return offset, result, overlap
+
+    # Фрагмент кончается там, где начинается своя часть следующего
+    ends = [offset + overlap for _, offset, overlap in chunks[1:]] + [None]
+    tasks = [asyncio.create_task(run(path, offset, overlap, end))
+             for (path, offset, overlap), end in zip(chunks, ends)]
+    try:
+        done, _ = await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+        for task in done:
+            if task.exception() is not None:
+                raise task.exception()
+        results = [task.result() for task in tasks]
+    finally:
+        # Ошибка одного фрагмента (или отмена задания) останавливает остальные
+        # до удаления файлов, которые они ещё читают
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        fragment_dirs = {os.path.dirname(path) for path, *_ in chunks if os.path.basename(path).startswith("fragment_")}
+        AudioProcessor.cleanup(sorted(fragment_dirs))
+    return merge_chunk_transcripts(results)
+
+
+def _download_percent(data: dict, expected_size: int | None) -> float | None:
+    """Процент скачивания по байтам; оценка размера из метаданных выручает, когда
+    yt-dlp не знает total (фрагментные загрузки, нет Content-Length)."""
+    downloaded = data.get('downloaded_bytes')
+    total = data.get('total_bytes') or data.get('total_bytes_estimate') or expected_size
+    if downloaded is not None and total:
+        return min(100.0, downloaded * 100.0 / total)
+    percent_str = data.get('_percent_str')
+    if percent_str:
+        return float(percent_str.strip().replace('%', ''))
+    return None
+
+
+async def download_youtube_audio(url: str, progress_callback: callable = None,
+                                 metadata: YoutubeMetadata | None = None) -> str:
+    """Скачивает звук видео через youtube.download_manager: отдельный пул потоков,
+    лимит одновременных скачиваний, одна загрузка на одинаковые ссылки.
+
+    Если metadata уже получены (youtube.metadata_probe), страница видео повторно
+    не запрашивается. Возвращает путь к собственной копии файла.
+    """
+    async def fetch(progress, cancelled, executor):
+        return await _fetch_youtube_audio(url, metadata, progress, cancelled, executor)
+
+    return await download_manager.download(url, fetch, progress_callback)
+
+
+def _remove_partial_downloads(temp_dir: str, unique_id: str):
+    for file in os.listdir(temp_dir):
+        if file.startswith(unique_id):
             try:
-                percent_str = data.get('_percent_str', '0%')
-                percent_value = float(percent_str.strip().replace('%', ''))
-                loop.call_soon_threadsafe(progress_queue.put_nowait, percent_value)
-            except:
+                os.remove(os.path.join(temp_dir, file))
+            except OSError:
                 pass
 
+
+async def _fetch_youtube_audio(url: str, metadata: YoutubeMetadata | None, progress_callback,
+                               cancelled: threading.Event, executor) -> str:
+    loop = asyncio.get_running_loop()
+    progress_queue = asyncio.Queue()
+    expected_size = metadata.estimated_size if metadata else None
+
     def sync_download():
+        import yt_dlp  # тяжёлый импорт — только когда действительно качаем
+
+        def progress_hook(data):
+            if cancelled.is_set():
+                # yt-dlp прерывает загрузку, если хук бросает DownloadCancelled
+                raise yt_dlp.utils.DownloadCancelled("скачивание отменено")
+            if data['status'] == 'downloading' and progress_callback:
+                try:
+                    percent_value = _download_percent(data, expected_size)
+                    if percent_value is not None:
+                        loop.call_soon_threadsafe(progress_queue.put_nowait, percent_value)
+                except:
+                    pass
+
         temp_dir = tempfile.gettempdir()
         unique_id = str(uuid.uuid4())
         outtmpl = os.path.join(temp_dir, f"{unique_id}")
-        ydl_opts = {
-            "format": "bestaudio/best",
-            "outtmpl": outtmpl,
-            "ffmpeg_location": FFMPEG_PATH,
-            "progress_hooks": [progress_hook],
-            "postprocessors": [{
-                "key": "FFmpegExtractAudio",
-                "preferredcodec": "mp3",
-            }],
-            "quiet": True,
-            "no_warnings": False,
-            "extract_flat": False,
-            "http_headers": {
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
-            },
-        }
+        if YOUTUBE_AUDIO_PASSTHROUGH:
+            outtmpl += ".%(ext)s"  # расширение исходной дорожки: .webm, .m4a
+        ydl_opts = youtube_download_options(outtmpl, progress_hook)
         try:
             with yt_dlp.YoutubeDL(ydl_opts) as ydl:
-                ydl.download([url])
+                if metadata is not None:
+                    # Тот же выбор формата по уже полученному ответу; копия — кэш метаданных общий
+                    info = ydl.process_ie_result(copy.deepcopy(metadata.info), download=True)
+                else:
+                    info = ydl.extract_info(url, download=True)
+                if cancelled.is_set():
+                    raise yt_dlp.utils.DownloadCancelled("скачивание отменено")
+                downloads = (info or {}).get("requested_downloads") or []
+                if downloads and downloads[0].get("filepath") and os.path.exists(downloads[0]["filepath"]):
+                    chosen = downloads[0]
+                    logger.info(
+                        f"YouTube {url}: формат {chosen.get('format_id')} {chosen.get('acodec')} "
+                        f"{chosen.get('abr')} кбит/с, {chosen.get('ext')}"
+                    )
+                    return chosen["filepath"]
                 expected_filename = f"{outtmpl}.mp3"
                 if os.path.exists(expected_filename):
                     return expected_filename
@@ -325,6 +744,10 @@ async def download_youtube_audio(url: str, progress_callback: callable = None) -
                             return os.path.join(temp_dir, file)
                     raise FileNotFoundError(f"Скачанный аудиофайл не найден: {expected_filename}")
         except Exception as e:
+            _remove_partial_downloads(temp_dir, unique_id)
+            if cancelled.is_set():
+                logger.info(f"Скачивание YouTube {url} отменено")
+                raise DownloadCancelled(url) from e
             logger.error(f"Ошибка скачивания YouTube: {str(e)}")
             raise RuntimeError(f"Ошибка скачивания видео: {str(e)}") from e
 
@@ -341,11 +764,22 @@ async def download_youtube_audio(url: str, progress_callback: callable = None) -
                 logger.warning(f"Ошибка обработки прогресса: {str(e)}")
                 break
 
-    download_task = loop.run_in_executor(None, sync_download)
+    download_task = loop.run_in_executor(executor, sync_download)
     progress_task = asyncio.create_task(process_progress())
     try:
         result = await download_task
-        return result
+        if not YOUTUBE_AUDIO_PASSTHROUGH:
+            return result
+        # Дорожка YouTube уже сжата речевым кодеком: webm/opus только перепаковывается
+        # в ogg (-c:a copy), m4a/aac уходит в AssemblyAI как есть
+        try:
+            prepared = await prepare_audio(result)
+        except BaseException:
+            os.remove(result)
+            raise
+        if prepared != result:
+            os.remove(result)
+        return prepared
     finally:
         progress_task.cancel()
         try:
@@ -354,52 +788,118 @@ async def download_youtube_audio(url: str, progress_callback: callable = None) -
             pass
 
 
-def format_results_with_speakers(segments: list[dict]) -> str:
-    return "\n\n".join(f"Спикер {seg['speaker']}:\n{seg['text']}" for seg in segments)
+# iter_*_blocks отдают документ по абзацам — их потребляют потоковые писатели
+# documents.render_blocks; format_* склеивают те же абзацы в одну строку.
+def iter_blocks_with_speakers(segments: Transcript | list[dict]):
+    for speaker, _, _, text in as_transcript(segments).rows():
+        yield f"Спикер {speaker}:\n{text}"
 
 
-def format_results_plain(segments: list[dict]) -> str:
-    return "\n\n".join(seg["text"] for seg in segments)
+def iter_blocks_plain(segments: Transcript | list[dict]):
+    for _, _, _, text in as_transcript(segments).rows():
+        yield text
 
 
-def _call_openrouter_with_key_rotation(messages: list[dict], model: str = "z-ai/glm-4.5-air:free", temperature: float = 0.2, timeout: int = 60) -> str:
-    """Вызывает OpenRouter API с ротацией ключей при неудаче."""
-    url = "https://openrouter.ai/api/v1/chat/completions"
-    data = {
-        "model": model,
-        "messages": messages,
-        "temperature": temperature
-    }
+def format_results_with_speakers(segments: Transcript | list[dict]) -> str:
+    return "\n\n".join(iter_blocks_with_speakers(segments))
+
+
+def format_results_plain(segments: Transcript | list[dict]) -> str:
+    return "\n\n".join(iter_blocks_plain(segments))
+
+
+# =============================
+#   Тайм-коды и субтитры без LLM
+# =============================
+# Transcript хранит реальные смещения AssemblyAI в миллисекундах для реплик и слов.
+def format_clock(ms: int) -> str:
+    """MM:SS, а для записей длиннее часа — H:MM:SS."""
+    total = max(0, int(ms)) // 1000
+    hours, rest = divmod(total, 3600)
+    minutes, seconds = divmod(rest, 60)
+    return f"{hours}:{minutes:02}:{seconds:02}" if hours else f"{minutes:02}:{seconds:02}"
+
+
+def _subtitle_time(ms: int, separator: str) -> str:
+    ms = max(0, int(ms))
+    hours, rest = divmod(ms, 3_600_000)
+    minutes, rest = divmod(rest, 60_000)
+    seconds, millis = divmod(rest, 1000)
+    return f"{hours:02}:{minutes:02}:{seconds:02}{separator}{millis:03}"
+
+
+def iter_blocks_with_timecodes(segments: Transcript | list[dict]):
+    for speaker, start, _, text in as_transcript(segments).rows():
+        yield f"[{format_clock(start)}] Спикер {speaker}:\n{text}"
+
+
+def format_results_with_timecodes(segments: Transcript | list[dict]) -> str:
+    return "\n\n".join(iter_blocks_with_timecodes(segments))
+
+
+def iter_subtitle_cues(segments: Transcript | list[dict], max_chars: int = SUBTITLE_MAX_CHARS,
+                       max_duration_ms: int = SUBTITLE_MAX_DURATION_MS):
+    """Режет реплики на титры по границам слов: не длиннее max_chars и max_duration_ms."""
+    transcript = as_transcript(segments)
+    for i, (_, seg_start, seg_end, seg_text) in enumerate(transcript.rows()):
+        cue_start, cue_end, cue_words, cue_len = None, None, [], 0
+        for start, end, text in transcript.words(i):
+            if cue_words and (cue_len + 1 + len(text) > max_chars or end - cue_start > max_duration_ms):
+                yield cue_start, cue_end, " ".join(cue_words)
+                cue_words, cue_len = [], 0
+            if not cue_words:
+                cue_start = start
+                cue_len = len(text)
+            else:
+                cue_len += 1 + len(text)
+            cue_words.append(text)
+            cue_end = end
+        if cue_words:
+            yield cue_start, cue_end, " ".join(cue_words)
+        elif seg_text:
+            yield seg_start, max(seg_end, seg_start + 1000), seg_text
+
+
+def _wrap_cue(text: str, width: int) -> str:
+    return "\n".join(textwrap.wrap(text, width=width)) or text
+
+
+def iter_srt_blocks(segments: Transcript | list[dict]):
+    for n, (start, end, text) in enumerate(iter_subtitle_cues(segments), start=1):
+        yield f"{n}\n{_subtitle_time(start, ',')} --> {_subtitle_time(end, ',')}\n{_wrap_cue(text, SUBTITLE_LINE_WIDTH)}"
+
+
+def iter_vtt_blocks(segments: Transcript | list[dict]):
+    yield "WEBVTT"
+    for start, end, text in iter_subtitle_cues(segments):
+        yield f"{_subtitle_time(start, '.')} --> {_subtitle_time(end, '.')}\n{_wrap_cue(text, SUBTITLE_LINE_WIDTH)}"
 
-    for api_key in OPENROUTER_API_KEYS:
-        try:
-            headers = {
-                "Authorization": f"Bearer {api_key}",
-                "Content-Type": "application/json"
-            }
-            response = requests.post(url, headers=headers, data=json.dumps(data), timeout=timeout)
-            response.raise_for_status()
-            result = response.json()
-            return result['choices'][0]['message']['content'].strip()
-        except Exception as e:
-            logger.warning(f"Ключ {api_key[:10]}... не сработал: {str(e)}")
-            continue  # Пробуем следующий ключ
 
-    # Если все ключи не сработали, вызываем исключение
-    raise RuntimeError("Все OpenRouter API ключи не сработали")
+def _get_openrouter() -> OpenRouterClient:
+    global openrouter
+    if openrouter is None:
+        openrouter = OpenRouterClient(http=lambda: _http("openrouter"))
+    return openrouter
 
 
-def generate_summary_timecodes(segments: list[dict]) -> str:
-    full_text_with_timestamps = ""
-    for i, seg in enumerate(segments):
-        start_minute = i * SEGMENT_DURATION // 60
-        start_second = i * SEGMENT_DURATION % 60
-        start_code = f"{start_minute:02}:{start_second:02}"
-        full_text_with_timestamps += f"[{start_code}] {seg['text']}\n\n"
-    prompt = f"""
+async def call_openrouter(messages: list[dict], model: str = OPENROUTER_MODEL, temperature: float = 0.2) -> str:
+    """Запрос к OpenRouter: выбор здорового ключа, мгновенное переключение при сбое."""
+    return await _get_openrouter().chat(messages, model=model, temperature=temperature)
+
+
+# =============================
+#   Оглавление с тайм-кодами (map-reduce)
+# =============================
+# Длинную расшифровку нельзя отправить одним промптом: она не влезает в контекст
+# модели. Сегменты режутся на куски по бюджету токенов, куски суммируются
+# параллельно (map), затем частичные оглавления сводятся в одно (reduce) —
+# при необходимости в несколько уровней.
+SUMMARY_PROMPT_VERSION = 1
+
+_TOC_PROMPT = """
 Проанализируй полную расшифровку аудио с тайм-кодами и создай структурированное оглавление с краткими суммами.
 Текст с тайм-кодами:
-{full_text_with_timestamps}
+{text}
 Инструкции:
 1. Выдели ОСНОВНЫЕ смысловые блоки и темы разговора
 2. Группируй несколько последовательных сегментов в один логический блок
@@ -414,31 +914,300 @@ def generate_summary_timecodes(segments: list[dict]) -> str:
 01:00 - [Краткое описание второго блока]
 ...
 """
-    messages = [{"role": "user", "content": prompt}]
+
+_MAP_PROMPT = """
+Это фрагмент длинной расшифровки аудио с тайм-кодами.
+Текст фрагмента:
+{text}
+Выдели смысловые блоки ЭТОГО фрагмента в хронологическом порядке. Для каждого блока — строка
+"ММ:СС - краткое описание (1 предложение)", где время — тайм-код начала блока из текста.
+Используй русский язык. Ответь только списком строк, без вступления.
+"""
+
+_MERGE_PROMPT = """
+Ниже частичные оглавления последовательных частей одной записи (строки "ММ:СС - описание").
+{text}
+Объедини их в единое оглавление: слей соседние блоки на одну тему, сохрани тайм-код начала
+каждого блока и хронологический порядок. Используй русский язык.
+{format_hint}
+"""
+
+_TOC_FORMAT_HINT = """Формат ответа (ТОЧНО следуй этому формату):
+Тайм-коды
+00:00 - [Краткое описание первого блока]
+01:00 - [Краткое описание второго блока]
+..."""
+
+_summary_cache: OrderedDict[str, str] = OrderedDict()
+
+
+def estimate_tokens(text: str) -> int:
+    """Грубая оценка числа токенов: ~4 байта UTF-8 на токен (кириллица — ~2 символа на токен)."""
+    return max(1, len(text.encode("utf-8")) // 4)
+
+
+def _timecode_lines(segments: Transcript | list[dict]) -> list[str]:
+    return [f"[{format_clock(start)}] {text}" for _, start, _, text in as_transcript(segments).rows()]
+
+
+def chunk_by_token_budget(lines: list[str], budget: int) -> list[str]:
+    """Склеивает строки в куски не больше budget токенов; слишком длинная строка режется."""
+    chunks, current, current_tokens = [], [], 0
+    for line in lines:
+        tokens = estimate_tokens(line)
+        if tokens > budget:
+            # ~2 символа на токен — безопасная длина куска даже для кириллицы
+            pieces = [line[i:i + budget * 2] for i in range(0, len(line), budget * 2)]
+        else:
+            pieces = [line]
+        for piece in pieces:
+            piece_tokens = estimate_tokens(piece)
+            if current and current_tokens + piece_tokens > budget:
+                chunks.append("\n\n".join(current))
+                current, current_tokens = [], 0
+            current.append(piece)
+            current_tokens += piece_tokens
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+async def _summarise_cached(prompt: str, semaphore: asyncio.Semaphore) -> str:
+    key = hashlib.sha256(f"{SUMMARY_PROMPT_VERSION}:{OPENROUTER_MODEL}:{prompt}".encode("utf-8")).hexdigest()
+    cached = _summary_cache.get(key)
+    if cached is not None:
+        _summary_cache.move_to_end(key)
+        return cached
+    async with semaphore:
+        result = await call_openrouter([{"role": "user", "content": prompt}], temperature=0.2)
+    _summary_cache[key] = result
+    while len(_summary_cache) > SUMMARY_CACHE_SIZE:
+        _summary_cache.popitem(last=False)
+    return result
+
+
+async def summarise_hierarchically(lines: list[str], budget: int = SUMMARY_CHUNK_TOKENS,
+                                   concurrency: int = SUMMARY_CONCURRENCY) -> str:
+    semaphore = asyncio.Semaphore(max(1, concurrency))
+    chunks = chunk_by_token_budget(lines, budget)
+    if len(chunks) <= 1:
+        return await _summarise_cached(_TOC_PROMPT.format(text=chunks[0] if chunks else ""), semaphore)
+
+    logger.info(f"Оглавление: {len(chunks)} фрагментов по ~{budget} токенов, суммирую параллельно")
+    partials = await asyncio.gather(*(_summarise_cached(_MAP_PROMPT.format(text=c), semaphore) for c in chunks))
+    level = 1
+    while True:
+        merged = chunk_by_token_budget(list(partials), budget)
+        if len(merged) == 1:
+            prompt = _MERGE_PROMPT.format(text=merged[0], format_hint=_TOC_FORMAT_HINT)
+            return await _summarise_cached(prompt, semaphore)
+        if len(merged) >= len(partials):
+            # Частичные оглавления не сжимаются дальше — сводим как есть
+            prompt = _MERGE_PROMPT.format(text="\n\n".join(partials), format_hint=_TOC_FORMAT_HINT)
+            return await _summarise_cached(prompt, semaphore)
+        level += 1
+        logger.info(f"Оглавление: уровень {level}, сводим {len(merged)} групп")
+        partials = await asyncio.gather(*(
+            _summarise_cached(_MERGE_PROMPT.format(text=m, format_hint=""), semaphore) for m in merged
+        ))
+
+
+async def generate_summary_timecodes(segments: Transcript | list[dict]) -> str:
+    lines = _timecode_lines(segments)
     try:
-        return _call_openrouter_with_key_rotation(messages, model="z-ai/glm-4.5-air:free", temperature=0.2)
+        return await summarise_hierarchically(lines)
     except Exception as e:
         logger.error(f"OpenRouter API failed: {str(e)}")
         # Fallback to raw timestamps
-        fallback_result = "Тайм-коды\n\n"
-        for i, seg in enumerate(segments):
-            start_minute = i * SEGMENT_DURATION // 60
-            start_second = i * SEGMENT_DURATION % 60
-            start_code = f"{start_minute:02}:{start_second:02}"
-            fallback_result += f"{start_code} - {seg['text'][:50]}...\n"
-        return fallback_result
+        return "Тайм-коды\n\n" + "".join(
+            f"{format_clock(start)} - {text[:50]}...\n" for _, start, _, text in as_transcript(segments).rows()
+        )
 
 
-async def convert_to_mp3(input_path: str) -> str:
-    output_path = tempfile.NamedTemporaryFile(delete=False, suffix=".mp3").name
-    command = [
-        FFMPEG_PATH,
-        "-i", input_path,
-        "-acodec", "libmp3lame",
-        "-q:a", "2",
-        "-y",
-        output_path
-    ]
+# Речевой профиль выхода: моно 16 кГц — больше AssemblyAI для распознавания не нужно
+def _speech_encoder_args(audio_format: str | None = None) -> tuple[list[str], str]:
+    audio_format = audio_format or SPEECH_AUDIO_FORMAT
+    common = ["-vn", "-ac", "1", "-ar", str(SPEECH_SAMPLE_RATE), "-b:a", SPEECH_AUDIO_BITRATE]
+    if audio_format == "opus":
+        return ["-c:a", "libopus", "-application", "voip", *common], ".ogg"
+    return ["-c:a", "libmp3lame", *common], ".mp3"
+
+
+# Контейнеры, у которых индекс (moov) может лежать в конце файла: из pipe их не прочитать
+_SEEKABLE_MIME_TYPES = ("audio/mp4", "audio/x-m4a", "audio/m4a", "audio/aac", "video/mp4", "video/quicktime", "video/3gpp")
+_SEEKABLE_EXTENSIONS = (".m4a", ".mp4", ".m4b", ".mov", ".3gp", ".aac")
+
+
+def needs_seekable_input(mime_type: str | None, file_name: str | None) -> bool:
+    if mime_type and mime_type.lower() in _SEEKABLE_MIME_TYPES:
+        return True
+    return bool(file_name) and file_name.lower().endswith(_SEEKABLE_EXTENSIONS)
+
+
+# Форматы, которые обычно уходят в AssemblyAI без перекодирования: их выгоднее
+# сохранить на диск как есть и проверить probe_audio, чем гнать через энкодер
+_PASSTHROUGH_MIME_TYPES = ("audio/mpeg", "audio/mp3", "audio/ogg", "audio/opus")
+_PASSTHROUGH_EXTENSIONS = (".mp3", ".ogg", ".oga", ".opus")
+
+
+def likely_passthrough(mime_type: str | None, file_name: str | None) -> bool:
+    if mime_type and mime_type.lower() in _PASSTHROUGH_MIME_TYPES:
+        return True
+    return bool(file_name) and file_name.lower().endswith(_PASSTHROUGH_EXTENSIONS)
+
+
+async def transcode_stream(chunks, audio_format: str | None = None) -> str:
+    """Пропускает поток байтов (например, скачивание из Telegram) через ffmpeg.
+
+    Байты идут прямо в stdin ffmpeg, на диск пишется только сжатый
+    речевой результат. Возвращает путь к нему.
+    """
+    codec_args, ext = _speech_encoder_args(audio_format)
+    output_path = tempfile.NamedTemporaryFile(delete=False, suffix=ext).name
+    command = [FFMPEG_PATH, "-hide_banner", "-i", "pipe:0", *codec_args, "-y", output_path]
+    started = time.perf_counter()
+    received = 0
+    process = await asyncio.create_subprocess_exec(
+        *command,
+        stdin=asyncio.subprocess.PIPE,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    stderr_task = asyncio.create_task(process.stderr.read())
+    try:
+        try:
+            async for chunk in chunks:
+                received += len(chunk)
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # ffmpeg завершился раньше — причину покажет код возврата
+        finally:
+            if not process.stdin.is_closing():
+                process.stdin.close()
+        await process.wait()
+        stderr = (await stderr_task).decode(errors="replace")
+        if process.returncode != 0:
+            logger.error(f"Ошибка потоковой конвертации: {stderr}")
+            raise RuntimeError(f"Ошибка конвертации файла: {stderr[-500:]}")
+        if not os.path.exists(output_path) or os.path.getsize(output_path) == 0:
+            raise RuntimeError("Конвертация не удалась: выходной файл не создан")
+    except BaseException:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        stderr_task.cancel()
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
+        raise
+    logger.info(
+        f"Потоковая конвертация: {received} байт -> {os.path.getsize(output_path)} байт "
+        f"за {time.perf_counter() - started:.1f} с ({output_path})"
+    )
+    return output_path
+
+
+# =============================
+#   Анализ входного аудио (probe)
+# =============================
+# Родной контейнер и расширение для кодеков, которые можно не перекодировать
+_PASSTHROUGH_CONTAINERS = {
+    "mp3": ({"mp3"}, ".mp3"),
+    "opus": ({"ogg"}, ".ogg"),
+    "vorbis": ({"ogg"}, ".ogg"),
+    "aac": ({"mov", "mp4", "m4a"}, ".m4a"),
+    "flac": ({"flac"}, ".flac"),
+}
+_PROBE_INPUT_RE = re.compile(r"Input #0, (.+?), from ")
+_PROBE_AUDIO_RE = re.compile(r"Stream #0:\d+.*?: Audio: (\w+)[^,]*, (\d+) Hz, ([^,]+)")
+_CHANNEL_LAYOUTS = {"mono": 1, "stereo": 2, "2.1": 3, "quad": 4, "5.0": 5, "5.1": 6, "7.1": 8}
+
+
+def _parse_channels(layout: str) -> int | None:
+    layout = layout.strip().split("(")[0]
+    if (m := re.match(r"(\d+) channels", layout)):
+        return int(m.group(1))
+    return _CHANNEL_LAYOUTS.get(layout)
+
+
+def _parse_ffmpeg_probe(ffmpeg_stderr: str) -> dict:
+    """Разбор заголовка ffmpeg -i — запасной вариант, если ffprobe не установлен."""
+    info = {"format_name": None, "codec": None, "sample_rate": None, "channels": None,
+            "duration": _parse_duration(ffmpeg_stderr),
+            "has_video": any("Video:" in line and "attached pic" not in line for line in ffmpeg_stderr.splitlines())}
+    if (m := _PROBE_INPUT_RE.search(ffmpeg_stderr)):
+        info["format_name"] = m.group(1)
+    if (m := _PROBE_AUDIO_RE.search(ffmpeg_stderr)):
+        info["codec"] = m.group(1)
+        info["sample_rate"] = int(m.group(2))
+        info["channels"] = _parse_channels(m.group(3))
+    return info
+
+
+def _parse_ffprobe_json(data: dict) -> dict:
+    streams = data.get("streams") or []
+    audio = next((st for st in streams if st.get("codec_type") == "audio"), {})
+    fmt = data.get("format") or {}
+    duration = fmt.get("duration") or audio.get("duration")
+    return {
+        "format_name": fmt.get("format_name"),
+        "codec": audio.get("codec_name"),
+        "sample_rate": int(audio["sample_rate"]) if audio.get("sample_rate") else None,
+        "channels": audio.get("channels"),
+        "duration": float(duration) if duration else None,
+        "has_video": any(
+            st.get("codec_type") == "video" and not (st.get("disposition") or {}).get("attached_pic")
+            for st in streams
+        ),
+    }
+
+
+async def probe_audio(file_path: str) -> dict:
+    """Контейнер, кодек, частота, каналы и длительность входного файла."""
+    try:
+        process = await asyncio.create_subprocess_exec(
+            FFPROBE_PATH, "-v", "error", "-show_format", "-show_streams", "-of", "json", file_path,
+            stdout=asyncio.subprocess.PIPE,
+            stderr=asyncio.subprocess.PIPE
+        )
+        stdout, stderr = await process.communicate()
+        if process.returncode == 0:
+            return _parse_ffprobe_json(json.loads(stdout or b"{}"))
+        logger.warning(f"ffprobe не смог прочитать {file_path}: {stderr.decode(errors='replace').strip()}")
+    except (OSError, ValueError) as e:
+        logger.debug(f"ffprobe недоступен ({e}), читаю заголовок через ffmpeg -i")
+    process = await asyncio.create_subprocess_exec(
+        FFMPEG_PATH, "-hide_banner", "-i", file_path,
+        stdout=asyncio.subprocess.DEVNULL,
+        stderr=asyncio.subprocess.PIPE
+    )
+    _, stderr = await process.communicate()
+    return _parse_ffmpeg_probe(stderr.decode(errors="replace"))
+
+
+def plan_audio_preparation(info: dict, file_path: str) -> tuple[str, str | None]:
+    """Решает, что делать с файлом: ("passthrough", ext), ("copy", ext) или ("transcode", None).
+
+    passthrough — файл уходит в AssemblyAI как есть, copy — только перепаковка
+    аудиопотока без декодирования (-c:a copy), transcode — полное перекодирование.
+    """
+    codec = info.get("codec")
+    if codec not in AUDIO_PASSTHROUGH_CODECS or codec not in _PASSTHROUGH_CONTAINERS:
+        return "transcode", None
+    if (info.get("channels") or 0) > AUDIO_PASSTHROUGH_MAX_CHANNELS:
+        return "transcode", None
+    if (info.get("sample_rate") or 0) > AUDIO_PASSTHROUGH_MAX_SAMPLE_RATE:
+        return "transcode", None
+    containers, ext = _PASSTHROUGH_CONTAINERS[codec]
+    formats = set((info.get("format_name") or "").split(","))
+    if info.get("has_video") or not formats & containers or os.path.splitext(file_path)[1].lower() != ext:
+        return "copy", ext
+    return "passthrough", ext
+
+
+async def _run_ffmpeg_to_file(command: list[str], input_path: str, output_path: str) -> str:
     try:
         process = await asyncio.create_subprocess_exec(
             *command,
@@ -456,18 +1225,82 @@ async def convert_to_mp3(input_path: str) -> str:
         return output_path
     except Exception as e:
         logger.error(f"Ошибка конвертации {input_path}: {str(e)}")
+        try:
+            os.remove(output_path)
+        except OSError:
+            pass
         raise RuntimeError(f"Ошибка конвертации: {str(e)}") from e
 
 
-async def process_audio_file(file_path: str, user_id: int, progress_callback=None) -> list[dict]:
+async def transcode_audio(input_path: str, audio_format: str | None = None) -> str:
+    codec_args, ext = _speech_encoder_args(audio_format)
+    output_path = tempfile.NamedTemporaryFile(delete=False, suffix=ext).name
+    command = [FFMPEG_PATH, "-i", input_path, *codec_args, "-y", output_path]
+    return await _run_ffmpeg_to_file(command, input_path, output_path)
+
+
+async def remux_audio(input_path: str, ext: str) -> str:
+    """Перепаковывает аудиопоток в контейнер ext без перекодирования (видео отбрасывается)."""
+    output_path = tempfile.NamedTemporaryFile(delete=False, suffix=ext).name
+    command = [FFMPEG_PATH, "-i", input_path, "-map", "0:a:0", "-vn", "-c:a", "copy", "-y", output_path]
+    return await _run_ffmpeg_to_file(command, input_path, output_path)
+
+
+async def convert_to_mp3(input_path: str) -> str:
+    return await transcode_audio(input_path, "mp3")
+
+
+async def prepare_audio(input_path: str) -> str:
+    """Готовит загруженный файл к отправке в AssemblyAI с минимальной работой CPU.
+
+    Может вернуть сам input_path (файл уже подходит) — вызывающий код
+    удаляет исходник, только если получил другой путь.
+    """
+    info = await probe_audio(input_path)
+    action, ext = plan_audio_preparation(info, input_path)
+    logger.info(
+        f"Входной файл {input_path}: {info.get('format_name')}/{info.get('codec')}, "
+        f"{info.get('sample_rate')} Гц, каналов {info.get('channels')} -> {action}"
+    )
+    if action == "passthrough":
+        return input_path
+    if action == "copy":
+        try:
+            return await remux_audio(input_path, ext)
+        except RuntimeError as e:
+            logger.warning(f"Копирование потока не удалось, перекодирую: {e}")
+    return await transcode_audio(input_path)
+
+
+async def process_audio_file(file_path: str, user_id: int, progress_callback=None,
+                             cache_key: str | None = None) -> Transcript:
     try:
         logger.info(f"Обработка аудиофайла: {file_path}")
-        if progress_callback:
-            await progress_callback(0.01, "Загружаю файл для обработки...")
-        audio_url = await upload_to_assemblyai(file_path)
-        if progress_callback:
-            await progress_callback(0.30, "Запускаю транскрибацию...")
-        result = await transcribe_with_assemblyai(audio_url)
+        if transcript_cache is not None:
+            # Обработчики передают ключ по исходнику; хэш самого файла совпадёт
+            # только если он не перекодировался (passthrough)
+            cache_key = cache_key or await audio_cache_key(file_path)
+            cached = await transcript_cache.get(cache_key)
+            if cached is not None:
+                if progress_callback:
+                    await progress_callback(1.0, "Обработка завершена!")
+                return cached
+        duration = await get_audio_duration(file_path) if TRANSCRIBE_CHUNKED else None
+        if duration and duration > TRANSCRIBE_CHUNK_THRESHOLD:
+            if progress_callback:
+                await progress_callback(0.01, "Разбиваю запись на фрагменты...")
+            result = await transcribe_in_chunks(file_path, progress_callback)
+        else:
+            upload_progress = None
+            if progress_callback:
+                await progress_callback(0.01, "Загружаю файл для обработки...")
+
+                async def upload_progress(fraction: float):
+                    await progress_callback(0.01 + 0.29 * fraction)
+            audio_url = await upload_to_assemblyai(file_path, progress_callback=upload_progress)
+            if progress_callback:
+                await progress_callback(0.30, "Запускаю транскрибацию...")
+            result = await transcribe_with_assemblyai(audio_url, audio_duration=duration)
         if progress_callback:
             await progress_callback(0.90, "Формирую результаты...")
 
@@ -476,25 +1309,22 @@ async def process_audio_file(file_path: str, user_id: int, progress_callback=Non
         if "language_code" in result:
             logger.info(f"Detected language: {result['language_code']}")
 
-        segments = []
-        if "utterances" in result and result["utterances"]:
-            for utt in result["utterances"]:
-                text = (utt.get("text") or "").strip()
-                # Ensure proper UTF-8 encoding
-                if isinstance(text, str):
-                    text = text.encode('utf-8').decode('utf-8')
-                segments.append({
-                    "speaker": utt.get("speaker", "?"),
-                    "text": text
-                })
-                logger.debug(f"Segment: speaker={utt.get('speaker')}, text_length={len(text)}")
+        if result.get("utterances"):
+            segments = Transcript.from_segments(result["utterances"])
         elif "text" in result:
-            text = (result["text"] or "").strip()
-            # Ensure proper UTF-8 encoding
-            if isinstance(text, str):
-                text = text.encode('utf-8').decode('utf-8')
-            segments.append({"speaker": "?", "text": text})
-            logger.debug(f"Full text length: {len(text)}")
+            words = result.get("words") or []
+            segments = Transcript.from_segments([{
+                "speaker": "?",
+                "text": result["text"] or "",
+                "end": None if words else int((result.get("audio_duration") or 0) * 1000),
+                "words": words
+            }])
+        else:
+            segments = Transcript()
+        logger.debug(f"Реплик {len(segments)}, слов {len(segments.word_starts)}, символов {len(segments.text)}")
+
+        if transcript_cache is not None and segments:
+            await transcript_cache.put(cache_key, segments)
 
         if progress_callback:
             await progress_callback(1.0, "Обработка завершена!")
@@ -514,6 +1344,7 @@ def create_custom_thumbnail(thumbnail_path: str = None):
         thumbnail_bytes = io.BytesIO(THUMBNAIL_CACHE[cache_key])
         thumbnail_bytes.seek(0)
         return thumbnail_bytes
+    from PIL import Image, ImageDraw, ImageFont
     try:
         if thumbnail_path and os.path.exists(thumbnail_path):
             with Image.open(thumbnail_path) as img:
@@ -0,0 +1,287 @@
+import asyncio
+import bisect
+import contextlib
+import contextvars
+import itertools
+import logging
+import time
+
+from aiogram.client.session.middlewares.base import BaseRequestMiddleware
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import (
+    DeleteMessage, EditMessageCaption, EditMessageReplyMarkup, EditMessageText, SendAudio, SendDocument, SendPhoto,
+    SendVideo,
+)
+
+from .config import (
+    TELEGRAM_GLOBAL_RATE, TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST, TELEGRAM_GROUP_RATE, TELEGRAM_PROGRESS_MAX_AGE,
+    TELEGRAM_MAX_RETRIES,
+)
+
+logger = logging.getLogger(__name__)
+
+PRIORITY_RESULT = 0
+PRIORITY_NORMAL = 1
+PRIORITY_PROGRESS = 2
+
+_RESULT_METHODS = (SendDocument, SendAudio, SendVideo, SendPhoto)
+_MESSAGE_METHODS = (EditMessageText, EditMessageCaption, EditMessageReplyMarkup, DeleteMessage)
+_IDLE_BUCKETS_SWEEP = 1024
+
+_progress = contextvars.ContextVar("telegram_progress", default=False)
+
+
+class ProgressEditDropped(Exception):
+    """Правка прогресса устарела в очереди и не отправлялась."""
+
+
+@contextlib.contextmanager
+def progress_edits():
+    """Запросы внутри блока — правки прогресса: идут последними и могут быть выброшены."""
+    token = _progress.set(True)
+    try:
+        yield
+    finally:
+        _progress.reset(token)
+
+
+class TokenBucket:
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.tokens = self.burst
+        self.updated = time.monotonic()
+        self.paused_until = 0.0
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def delay(self, now: float) -> float:
+        """Сколько секунд ждать до свободного токена (0 — можно сейчас)."""
+        self._refill(now)
+        wait = max(0.0, self.paused_until - now)
+        if self.tokens < 1:
+            wait = max(wait, (1 - self.tokens) / self.rate)
+        return wait
+
+    def take(self, now: float):
+        self._refill(now)
+        self.tokens -= 1
+
+    def pause(self, seconds: float, now: float):
+        self.paused_until = max(self.paused_until, now + seconds)
+
+    def idle(self, now: float) -> bool:
+        self._refill(now)
+        return self.tokens >= self.burst and self.paused_until <= now
+
+
+class _Request:
+    def __init__(self, make_request, bot, method, chat_id, priority: int):
+        self.make_request = make_request
+        self.bot = bot
+        self.method = method
+        self.chat_id = chat_id
+        self.priority = priority
+        self.message_key = (chat_id, method.message_id) if isinstance(method, _MESSAGE_METHODS) else None
+        self.created = time.monotonic()
+        self.attempts = 0
+        self.future = asyncio.get_running_loop().create_future()
+
+    @property
+    def progress(self) -> bool:
+        return self.priority == PRIORITY_PROGRESS
+
+
+# =============================
+#    Очередь исходящих запросов
+# =============================
+class TelegramOutbox(BaseRequestMiddleware):
+    """Планировщик исходящих запросов к Bot API (middleware сессии aiogram).
+
+    Все запросы, адресованные чату, проходят через общий token bucket бота и
+    bucket своего чата, поэтому message.answer / edit_text / send_document
+    в обработчиках не упираются в 429. Внутри лимитов первыми уходят готовые
+    файлы, затем обычные запросы, последними — правки прогресса (progress_edits).
+    Правка прогресса выбрасывается (ProgressEditDropped), если для того же
+    сообщения пришёл более новый запрос или она пролежала в очереди дольше
+    progress_max_age. На 429 чат ставится на паузу retry_after и запрос
+    повторяется. Запросы без чата (getUpdates, getFile, ...) идут напрямую.
+    """
+
+    def __init__(self, global_rate: float = TELEGRAM_GLOBAL_RATE, chat_rate: float = TELEGRAM_CHAT_RATE,
+                 chat_burst: int = TELEGRAM_CHAT_BURST, group_rate: float = TELEGRAM_GROUP_RATE,
+                 progress_max_age: float = TELEGRAM_PROGRESS_MAX_AGE, max_retries: int = TELEGRAM_MAX_RETRIES):
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.group_rate = group_rate
+        self.progress_max_age = progress_max_age
+        self.max_retries = max_retries
+        self._global = TokenBucket(global_rate, global_rate)
+        self._chats: dict[int | str, TokenBucket] = {}
+        self._queue: list[tuple[int, int, _Request]] = []
+        self._seq = itertools.count()
+        self._wake: asyncio.Event | None = None
+        self._dispatcher: asyncio.Task | None = None
+        self._inflight: set[asyncio.Task] = set()
+        self.sent = 0
+        self.dropped = 0
+        self.retried = 0
+
+    @property
+    def queued(self) -> int:
+        return len(self._queue)
+
+    def stats(self) -> dict:
+        return {"queued": self.queued, "in_flight": len(self._inflight), "sent": self.sent,
+                "dropped": self.dropped, "retried": self.retried, "chats": len(self._chats)}
+
+    async def __call__(self, make_request, bot, method):
+        chat_id = getattr(method, "chat_id", None)
+        if chat_id is None:
+            return await make_request(bot, method)
+        if _progress.get():
+            priority = PRIORITY_PROGRESS
+        elif isinstance(method, _RESULT_METHODS):
+            priority = PRIORITY_RESULT
+        else:
+            priority = PRIORITY_NORMAL
+        request = _Request(make_request, bot, method, chat_id, priority)
+        if request.message_key is not None:
+            self._supersede(request.message_key)
+        self._enqueue(request)
+        try:
+            return await request.future
+        finally:
+            # Отменённый вызывающим запрос просто пропускается диспетчером
+            request.future.cancel()
+
+    # ---------- очередь ----------
+    def _enqueue(self, request: _Request, seq: int | None = None):
+        bisect.insort(self._queue, (request.priority, next(self._seq) if seq is None else seq, request),
+                      key=lambda entry: entry[:2])
+        if self._dispatcher is None or self._dispatcher.done():
+            self._wake = asyncio.Event()
+            self._dispatcher = asyncio.create_task(self._dispatch())
+        self._wake.set()
+
+    def _drop(self, request: _Request, reason: str):
+        if not request.future.done():
+            request.future.set_exception(ProgressEditDropped(reason))
+            self.dropped += 1
+
+    def _supersede(self, message_key):
+        kept = []
+        for entry in self._queue:
+            request = entry[2]
+            if request.progress and request.message_key == message_key:
+                self._drop(request, "есть более новый запрос к сообщению")
+            else:
+                kept.append(entry)
+        self._queue[:] = kept
+
+    def _bucket(self, chat_id) -> TokenBucket:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            is_group = isinstance(chat_id, str) or chat_id < 0
+            rate = self.group_rate if is_group else self.chat_rate
+            bucket = self._chats[chat_id] = TokenBucket(rate, self.chat_burst)
+        return bucket
+
+    def _sweep_buckets(self, now: float):
+        waiting = {entry[2].chat_id for entry in self._queue}
+        for chat_id in [c for c, bucket in self._chats.items() if c not in waiting and bucket.idle(now)]:
+            del self._chats[chat_id]
+
+    def _next_ready(self, now: float) -> tuple[int | None, float | None]:
+        """Индекс первого запроса, который можно отправить, или время ожидания."""
+        wait = None
+        for index, (_, _, request) in enumerate(self._queue):
+            delay = self._bucket(request.chat_id).delay(now)
+            if delay <= 0:
+                return index, None
+            wait = delay if wait is None else min(wait, delay)
+        return None, wait
+
+    async def _dispatch(self):
+        while True:
+            self._wake.clear()
+            now = time.monotonic()
+            kept = []
+            for entry in self._queue:
+                request = entry[2]
+                if request.future.done():
+                    continue
+                if request.progress and now - request.created > self.progress_max_age:
+                    self._drop(request, "правка прогресса устарела")
+                    continue
+                kept.append(entry)
+            self._queue[:] = kept
+
+            wait = None
+            if self._queue:
+                wait = self._global.delay(now)
+                if wait <= 0:
+                    index, wait = self._next_ready(now)
+                    if index is not None:
+                        request = self._queue.pop(index)[2]
+                        self._global.take(now)
+                        self._bucket(request.chat_id).take(now)
+                        task = asyncio.create_task(self._send(request))
+                        self._inflight.add(task)
+                        task.add_done_callback(self._inflight.discard)
+                        if len(self._chats) > _IDLE_BUCKETS_SWEEP:
+                            self._sweep_buckets(now)
+                        continue
+            try:
+                await asyncio.wait_for(self._wake.wait(), wait)
+            except asyncio.TimeoutError:
+                pass
+
+    async def _send(self, request: _Request):
+        request.attempts += 1
+        try:
+            result = await request.make_request(request.bot, request.method)
+        except TelegramRetryAfter as e:
+            self._bucket(request.chat_id).pause(e.retry_after, time.monotonic())
+            logger.warning(f"Telegram 429 для чата {request.chat_id}: пауза {e.retry_after} с "
+                           f"({type(request.method).__name__}, попытка {request.attempts})")
+            if request.progress:
+                self._drop(request, "лимит Telegram, правка прогресса пропущена")
+            elif request.attempts > self.max_retries:
+                if not request.future.done():
+                    request.future.set_exception(e)
+            elif not request.future.done():
+                self.retried += 1
+                self._enqueue(request, seq=-request.attempts)  # повтор — раньше новых того же приоритета
+            return
+        except asyncio.CancelledError:
+            request.future.cancel()
+            raise
+        except Exception as e:
+            if not request.future.done():
+                request.future.set_exception(e)
+            return
+        self.sent += 1
+        if not request.future.done():
+            request.future.set_result(result)
+
+    async def aclose(self, timeout: float = 10.0):
+        """Досылает очередь (не дольше timeout), затем отменяет оставшееся."""
+        deadline = time.monotonic() + timeout
+        while (self._queue or self._inflight) and time.monotonic() < deadline:
+            await asyncio.sleep(0.05)
+        if self._dispatcher is not None:
+            self._dispatcher.cancel()
+            await asyncio.gather(self._dispatcher, return_exceptions=True)
+            self._dispatcher = None
+        for task in list(self._inflight):
+            task.cancel()
+        await asyncio.gather(*self._inflight, return_exceptions=True)
+        for _, _, request in self._queue:
+            request.future.cancel()
+        self._queue.clear()
+
+
+outbox = TelegramOutbox()
@@ -0,0 +1,127 @@
+import asyncio
+import hmac
+import logging
+import time
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.types import Update
+from pydantic import ValidationError
+
+from .config import (
+    TELEGRAM_WEBHOOK_URL, TELEGRAM_WEBHOOK_HOST, TELEGRAM_WEBHOOK_PORT, TELEGRAM_WEBHOOK_SECRET,
+    TELEGRAM_WEBHOOK_WORKERS, TELEGRAM_WEBHOOK_QUEUE
+)
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = "/telegram/webhook"
+SECRET_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class TelegramWebhook:
+    """Приём обновлений Telegram через webhook вместо long polling.
+
+    handle() проверяет секрет, кладёт обновление в ограниченную очередь и сразу
+    отвечает 200; обработку ведут workers задач через dp.feed_update. При
+    переполнении очереди и во время drain() отвечает 503 — Telegram повторит
+    доставку (в горизонтальном развёртывании — на другой экземпляр).
+    Обработчики не должны держать воркер долго: скачивание и перекодирование
+    файлов идут в фоновых задачах (handlers.universal_handler, submit_when_downloaded).
+    """
+
+    def __init__(self, bot: Bot, dp: Dispatcher, public_url: str = TELEGRAM_WEBHOOK_URL,
+                 host: str = TELEGRAM_WEBHOOK_HOST, port: int = TELEGRAM_WEBHOOK_PORT,
+                 secret: str = TELEGRAM_WEBHOOK_SECRET, workers: int = TELEGRAM_WEBHOOK_WORKERS,
+                 max_queue: int = TELEGRAM_WEBHOOK_QUEUE):
+        self.bot = bot
+        self.dp = dp
+        self.public_url = public_url.rstrip("/")
+        self.host = host
+        self.port = port
+        if not secret:
+            raise ValueError("Для webhook Telegram нужен TELEGRAM_WEBHOOK_SECRET, общий для всех экземпляров")
+        self.secret = secret
+        self.workers = max(1, workers)
+        self._queue: asyncio.Queue[Update] = asyncio.Queue(max_queue)
+        self._tasks: list[asyncio.Task] = []
+        self._busy = 0
+        self._draining = False
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def url(self) -> str:
+        return f"{self.public_url}{WEBHOOK_PATH}"
+
+    @property
+    def pending(self) -> int:
+        """Обновления в очереди и в обработке."""
+        return self._queue.qsize() + self._busy
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(SECRET_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        if self._draining:
+            return web.Response(status=503)
+        try:
+            update = Update.model_validate(await request.json(), context={"bot": self.bot})
+        except (ValueError, ValidationError):
+            return web.Response(status=400)
+        try:
+            self._queue.put_nowait(update)
+        except asyncio.QueueFull:
+            logger.warning(f"Очередь обновлений переполнена, update {update.update_id} отклонён")
+            return web.Response(status=503)
+        return web.Response(text="ok")
+
+    async def _worker(self):
+        while True:
+            update = await self._queue.get()
+            self._busy += 1
+            try:
+                await self.dp.feed_update(self.bot, update)
+            except Exception as e:
+                logger.exception(f"Ошибка обработки update {update.update_id}: {e}")
+            finally:
+                self._busy -= 1
+                self._queue.task_done()
+
+    def start_workers(self):
+        if not self._tasks:
+            self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        return app
+
+    async def start(self):
+        self.start_workers()
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        await self.bot.set_webhook(
+            self.url, secret_token=self.secret, max_connections=self.workers,
+            allowed_updates=self.dp.resolve_used_update_types()
+        )
+        logger.info(f"Webhook Telegram слушает {self.host}:{self.port}, публичный адрес {self.url}, "
+                    f"воркеров {self.workers}")
+
+    async def drain(self, timeout: float | None = None):
+        """Перестаёт принимать обновления, дообрабатывает принятые (не дольше timeout) и останавливается.
+
+        Webhook у Telegram не удаляется: остальные экземпляры продолжают работу.
+        """
+        self._draining = True
+        logger.info(f"Webhook Telegram: завершение, в очереди и в обработке {self.pending}")
+        deadline = time.monotonic() + timeout if timeout else None
+        while self.pending and (deadline is None or time.monotonic() < deadline):
+            await asyncio.sleep(0.1)
+        if self.pending:
+            logger.warning(f"Webhook Telegram: не дождались {self.pending} обновлений")
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
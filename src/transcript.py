@@ -0,0 +1,213 @@
+from array import array
+
+
+# =============================
+#   Колоночное хранение транскрипта
+# =============================
+class Transcript:
+    """Результат транскрибации в виде колонок вместо списка словарей.
+
+    Реплики: массивы начала/конца (мс) и id спикера, имена спикеров
+    интернированы в speakers. Тексты всех реплик лежат в одной строке,
+    реплика i — это срез text_offsets[i]:text_offsets[i + 1]. Слова хранятся
+    так же: массивы начала/конца, общий текстовый буфер и границы слов
+    каждой реплики в word_index. Для многочасовых записей со словами это
+    на порядок компактнее словарей AssemblyAI.
+
+    Итерация возвращает SegmentView, который читается как прежний словарь
+    сегмента (seg["text"], seg.get("start")), так что старый код работает
+    без изменений; форматтеры используют rows() и обходятся без объектов.
+    """
+
+    __slots__ = ("speakers", "speaker_ids", "starts", "ends", "text", "text_offsets",
+                 "word_starts", "word_ends", "word_text", "word_text_offsets", "word_index")
+
+    def __init__(self):
+        self.speakers: list[str] = []
+        self.speaker_ids = array("H")
+        self.starts = array("i")
+        self.ends = array("i")
+        self.text = ""
+        self.text_offsets = array("I", [0])
+        self.word_starts = array("i")
+        self.word_ends = array("i")
+        self.word_text = ""
+        self.word_text_offsets = array("I", [0])
+        self.word_index = array("I", [0])
+
+    # ---------- построение ----------
+    @classmethod
+    def from_segments(cls, segments) -> "Transcript":
+        """Из реплик AssemblyAI (utterances) или сегментов-словарей.
+
+        words принимаются и как словари API, и как тройки [start, end, text].
+        """
+        transcript = cls()
+        speaker_lookup: dict[str, int] = {}
+        texts: list[str] = []
+        word_texts: list[str] = []
+        text_len = 0
+        word_text_len = 0
+        for seg in segments:
+            speaker = seg.get("speaker") or "?"
+            speaker_id = speaker_lookup.get(speaker)
+            if speaker_id is None:
+                speaker_id = speaker_lookup[speaker] = len(transcript.speakers)
+                transcript.speakers.append(speaker)
+            words = seg.get("words") or []
+            for word in words:
+                if isinstance(word, dict):
+                    if word.get("start") is None:
+                        continue
+                    w_start, w_end, w_text = word["start"], word["end"], word.get("text") or ""
+                else:
+                    w_start, w_end, w_text = word
+                transcript.word_starts.append(int(w_start))
+                transcript.word_ends.append(int(w_end))
+                word_texts.append(w_text)
+                word_text_len += len(w_text)
+                transcript.word_text_offsets.append(word_text_len)
+            transcript.word_index.append(len(transcript.word_starts))
+
+            first_word = transcript.word_index[-2]
+            has_words = len(transcript.word_starts) > first_word
+            start = seg.get("start")
+            if start is None:
+                start = transcript.word_starts[first_word] if has_words else 0
+            end = seg.get("end")
+            if end is None:
+                end = transcript.word_ends[-1] if has_words else start
+            text = (seg.get("text") or "").strip()
+            transcript.speaker_ids.append(speaker_id)
+            transcript.starts.append(int(start))
+            transcript.ends.append(int(end))
+            texts.append(text)
+            text_len += len(text)
+            transcript.text_offsets.append(text_len)
+        transcript.text = "".join(texts)
+        transcript.word_text = "".join(word_texts)
+        return transcript
+
+    # ---------- доступ ----------
+    def __len__(self) -> int:
+        return len(self.starts)
+
+    def __bool__(self) -> bool:
+        return len(self.starts) > 0
+
+    def __getitem__(self, index: int) -> "SegmentView":
+        if index < 0:
+            index += len(self)
+        if not 0 <= index < len(self):
+            raise IndexError(index)
+        return SegmentView(self, index)
+
+    def __iter__(self):
+        for index in range(len(self)):
+            yield SegmentView(self, index)
+
+    def __eq__(self, other) -> bool:
+        if isinstance(other, Transcript):
+            return self.to_dict() == other.to_dict()
+        if isinstance(other, list):
+            return self.to_segments() == other
+        return NotImplemented
+
+    def segment_text(self, index: int) -> str:
+        return self.text[self.text_offsets[index]:self.text_offsets[index + 1]]
+
+    def speaker(self, index: int) -> str:
+        return self.speakers[self.speaker_ids[index]]
+
+    def words(self, index: int):
+        """Слова реплики как тройки (start, end, text)."""
+        offsets = self.word_text_offsets
+        for w in range(self.word_index[index], self.word_index[index + 1]):
+            yield self.word_starts[w], self.word_ends[w], self.word_text[offsets[w]:offsets[w + 1]]
+
+    def rows(self):
+        """(speaker, start, end, text) по порядку — основной путь для форматтеров."""
+        speakers, speaker_ids, starts, ends = self.speakers, self.speaker_ids, self.starts, self.ends
+        text, offsets = self.text, self.text_offsets
+        for i in range(len(starts)):
+            yield speakers[speaker_ids[i]], starts[i], ends[i], text[offsets[i]:offsets[i + 1]]
+
+    def has_text(self) -> bool:
+        return any(not ch.isspace() for ch in self.text)
+
+    # ---------- сериализация (кэш транскриптов) ----------
+    def to_dict(self) -> dict:
+        return {
+            "speakers": self.speakers,
+            "speaker_ids": self.speaker_ids.tolist(),
+            "starts": self.starts.tolist(),
+            "ends": self.ends.tolist(),
+            "text": self.text,
+            "text_offsets": self.text_offsets.tolist(),
+            "word_starts": self.word_starts.tolist(),
+            "word_ends": self.word_ends.tolist(),
+            "word_text": self.word_text,
+            "word_text_offsets": self.word_text_offsets.tolist(),
+            "word_index": self.word_index.tolist(),
+        }
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "Transcript":
+        transcript = cls()
+        transcript.speakers = list(data["speakers"])
+        transcript.text = data["text"]
+        transcript.word_text = data["word_text"]
+        for name in ("speaker_ids", "starts", "ends", "text_offsets", "word_starts", "word_ends",
+                     "word_text_offsets", "word_index"):
+            getattr(transcript, name)[:] = array(getattr(transcript, name).typecode, data[name])
+        return transcript
+
+    def to_segments(self) -> list[dict]:
+        """Список словарей прежнего формата — для отладки и сравнения."""
+        return [view.to_dict() for view in self]
+
+
+class SegmentView:
+    """Реплика транскрипта, читаемая как словарь {"speaker", "text", "start", "end", "words"}."""
+
+    __slots__ = ("_transcript", "_index")
+
+    _KEYS = ("speaker", "text", "start", "end", "words")
+
+    def __init__(self, transcript: Transcript, index: int):
+        self._transcript = transcript
+        self._index = index
+
+    def __getitem__(self, key: str):
+        t, i = self._transcript, self._index
+        if key == "text":
+            return t.segment_text(i)
+        if key == "speaker":
+            return t.speaker(i)
+        if key == "start":
+            return t.starts[i]
+        if key == "end":
+            return t.ends[i]
+        if key == "words":
+            return [list(word) for word in t.words(i)]
+        raise KeyError(key)
+
+    def get(self, key: str, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
+    def keys(self):
+        return self._KEYS
+
+    def to_dict(self) -> dict:
+        return {key: self[key] for key in self._KEYS}
+
+    def __repr__(self) -> str:
+        return f"SegmentView({self.to_dict()!r})"
+
+
+def as_transcript(segments) -> Transcript:
+    """Transcript как есть; список сегментов-словарей (старый формат) — конвертируется."""
+    return segments if isinstance(segments, Transcript) else Transcript.from_segments(segments)
@@ -0,0 +1,193 @@
+import asyncio
+import hashlib
+import json
+import logging
+import re
+import sqlite3
+import time
+import zlib
+from urllib.parse import urlparse, parse_qs
+
+from .config import TRANSCRIPT_CACHE_PATH, TRANSCRIPT_CACHE_MAX_MB
+from .database import Database
+from .transcript import Transcript
+
+logger = logging.getLogger(__name__)
+
+# Меняется, когда меняется формат сегментов или параметры транскрибации —
+# старые записи тогда просто перестают находиться и вытесняются.
+CACHE_VERSION = 3
+HASH_CHUNK_SIZE = 1024 * 1024
+
+CREATE_TRANSCRIPTS_SQL = '''
+            CREATE TABLE IF NOT EXISTS transcripts (
+                cache_key TEXT PRIMARY KEY,
+                segments BLOB NOT NULL,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL,
+                last_used REAL NOT NULL
+            )
+        '''
+CREATE_LAST_USED_INDEX_SQL = 'CREATE INDEX IF NOT EXISTS transcripts_last_used ON transcripts (last_used)'
+SELECT_TRANSCRIPT_SQL = 'SELECT segments FROM transcripts WHERE cache_key = ?'
+TOUCH_TRANSCRIPT_SQL = 'UPDATE transcripts SET last_used = ? WHERE cache_key = ?'
+UPSERT_TRANSCRIPT_SQL = 'INSERT OR REPLACE INTO transcripts (cache_key, segments, size, created_at, last_used) VALUES (?, ?, ?, ?, ?)'
+TOTAL_SIZE_SQL = 'SELECT COALESCE(SUM(size), 0) FROM transcripts'
+OLDEST_SQL = 'SELECT cache_key, size FROM transcripts ORDER BY last_used LIMIT ?'
+DELETE_TRANSCRIPT_SQL = 'DELETE FROM transcripts WHERE cache_key = ?'
+
+
+# =============================
+#        Ключи кэша
+# =============================
+_YOUTUBE_ID_RE = re.compile(r"^[A-Za-z0-9_-]{11}$")
+_YOUTUBE_HOSTS = ("youtube.com", "www.youtube.com", "m.youtube.com", "music.youtube.com", "youtube-nocookie.com",
+                  "www.youtube-nocookie.com")
+
+
+def youtube_video_id(url: str) -> str | None:
+    """ID видео из любой формы ссылки: watch?v=, youtu.be/, shorts/, embed/, live/."""
+    try:
+        parsed = urlparse(url.strip())
+    except ValueError:
+        return None
+    host = (parsed.hostname or "").lower()
+    candidate = None
+    if host in ("youtu.be", "www.youtu.be"):
+        candidate = parsed.path.lstrip("/").split("/")[0]
+    elif host in _YOUTUBE_HOSTS:
+        if parsed.path == "/watch":
+            candidate = (parse_qs(parsed.query).get("v") or [None])[0]
+        else:
+            parts = parsed.path.strip("/").split("/")
+            if len(parts) >= 2 and parts[0] in ("shorts", "embed", "live", "v"):
+                candidate = parts[1]
+    if candidate and _YOUTUBE_ID_RE.match(candidate):
+        return candidate
+    return None
+
+
+def youtube_cache_key(url: str) -> str | None:
+    video_id = youtube_video_id(url)
+    return f"v{CACHE_VERSION}:youtube:{video_id}" if video_id else None
+
+
+def _hash_file(file_path: str) -> str:
+    digest = hashlib.sha256()
+    with open(file_path, "rb") as f:
+        while chunk := f.read(HASH_CHUNK_SIZE):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+async def audio_cache_key(file_path: str) -> str:
+    """Ключ по SHA-256 исходного файла.
+
+    Хэшировать нужно источник, а не результат prepare_audio / transcode_stream:
+    Ogg/Opus от ffmpeg не совпадает побайтно между запусками (случайный
+    serial потока), и ключ по нему никогда бы не находился.
+    """
+    digest = await asyncio.to_thread(_hash_file, file_path)
+    return f"v{CACHE_VERSION}:sha256:{digest}"
+
+
+class SourceHasher:
+    """SHA-256 исходных байтов, пока они идут из сети прямо в ffmpeg."""
+
+    def __init__(self):
+        self._digest = hashlib.sha256()
+
+    async def wrap(self, chunks):
+        async for chunk in chunks:
+            self._digest.update(chunk)
+            yield chunk
+
+    @property
+    def cache_key(self) -> str:
+        return f"v{CACHE_VERSION}:sha256:{self._digest.hexdigest()}"
+
+
+# =============================
+#     Кэш транскриптов на диске
+# =============================
+class TranscriptCache:
+    """Постоянный кэш транскриптов (Transcript), которые возвращает services.process_audio_file.
+
+    Хранится в отдельном файле SQLite (тот же движок Database, что и для
+    пользователей). Размер ограничен max_bytes: при переполнении удаляются
+    записи, к которым дольше всего не обращались (LRU по last_used).
+    """
+
+    def __init__(self, path: str = TRANSCRIPT_CACHE_PATH, max_bytes: int = int(TRANSCRIPT_CACHE_MAX_MB * 1024 * 1024)):
+        self.max_bytes = max_bytes
+        self.engine = Database(path, read_pool_size=2)
+        self.hits = 0
+        self.misses = 0
+
+    async def open(self):
+        def create(conn: sqlite3.Connection):
+            conn.execute(CREATE_TRANSCRIPTS_SQL)
+            conn.execute(CREATE_LAST_USED_INDEX_SQL)
+
+        await self.engine.write(create)
+
+    async def get(self, key: str) -> Transcript | None:
+        try:
+            row = await self.engine.fetchone(SELECT_TRANSCRIPT_SQL, (key,))
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка чтения кэша транскриптов: {e}")
+            return None
+        if row is None:
+            self.misses += 1
+            return None
+        try:
+            transcript = Transcript.from_dict(json.loads(zlib.decompress(row[0])))
+        except (zlib.error, ValueError, KeyError, TypeError, OverflowError) as e:
+            logger.warning(f"Повреждённая запись кэша {key}, удаляю: {e}")
+            await self.engine.execute(DELETE_TRANSCRIPT_SQL, (key,))
+            self.misses += 1
+            return None
+        await self.engine.execute(TOUCH_TRANSCRIPT_SQL, (time.time(), key))
+        self.hits += 1
+        logger.info(f"Транскрипт найден в кэше: {key} (попаданий {self.hits}, промахов {self.misses})")
+        return transcript
+
+    async def put(self, key: str, transcript: Transcript):
+        blob = zlib.compress(json.dumps(transcript.to_dict(), ensure_ascii=False).encode("utf-8"))
+        if len(blob) > self.max_bytes:
+            logger.info(f"Транскрипт {key} больше лимита кэша ({len(blob)} байт), не сохраняю")
+            return
+        now = time.time()
+
+        def store(conn: sqlite3.Connection) -> int:
+            conn.execute(UPSERT_TRANSCRIPT_SQL, (key, blob, len(blob), now, now))
+            return self._evict(conn)
+
+        try:
+            evicted = await self.engine.write(store)
+        except sqlite3.Error as e:
+            logger.warning(f"Ошибка записи в кэш транскриптов: {e}")
+            return
+        if evicted:
+            logger.info(f"Кэш транскриптов: вытеснено записей {evicted}")
+
+    def _evict(self, conn: sqlite3.Connection) -> int:
+        total = conn.execute(TOTAL_SIZE_SQL).fetchone()[0]
+        evicted = 0
+        while total > self.max_bytes:
+            oldest = conn.execute(OLDEST_SQL, (32,)).fetchall()
+            if not oldest:
+                break
+            for key, size in oldest:
+                conn.execute(DELETE_TRANSCRIPT_SQL, (key,))
+                total -= size
+                evicted += 1
+                if total <= self.max_bytes:
+                    break
+        return evicted
+
+    async def total_size(self) -> int:
+        return (await self.engine.fetchone(TOTAL_SIZE_SQL))[0]
+
+    def close(self):
+        self.engine.close()
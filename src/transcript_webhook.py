@@ -0,0 +1,112 @@
+import asyncio
+import hmac
+import logging
+import time
+import uuid
+from collections import OrderedDict
+from aiohttp import web
+
+from .config import (
+    ASSEMBLYAI_WEBHOOK_URL, ASSEMBLYAI_WEBHOOK_HOST, ASSEMBLYAI_WEBHOOK_PORT,
+    ASSEMBLYAI_WEBHOOK_SECRET
+)
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_PATH = "/assemblyai/webhook"
+AUTH_HEADER = "X-WiseVoice-Webhook-Secret"
+EARLY_NOTIFICATIONS_MAX = 1024
+EARLY_NOTIFICATION_TTL = 600  # секунд
+
+
+class TranscriptWebhook:
+    """Локальный HTTP-эндпоинт для уведомлений AssemblyAI о готовности транскрипта.
+
+    transcribe_with_assemblyai передаёт webhook_url при создании задания и ждёт
+    future из expect(); опрос API при этом остаётся редкой страховкой.
+    id транскрипта известен только из ответа на создание, а уведомление о
+    быстром задании может прийти раньше этого ответа — такие уведомления
+    запоминаются, и expect() сразу возвращает готовый future.
+    """
+
+    def __init__(self, public_url: str = ASSEMBLYAI_WEBHOOK_URL, host: str = ASSEMBLYAI_WEBHOOK_HOST,
+                 port: int = ASSEMBLYAI_WEBHOOK_PORT, secret: str = ASSEMBLYAI_WEBHOOK_SECRET):
+        self.public_url = public_url.rstrip("/")
+        self.host = host
+        self.port = port
+        self.secret = secret or uuid.uuid4().hex
+        self._waiters: dict[str, asyncio.Future] = {}
+        self._early: OrderedDict[str, tuple[float, str | None]] = OrderedDict()
+        self._runner: web.AppRunner | None = None
+
+    @property
+    def url(self) -> str:
+        return f"{self.public_url}{WEBHOOK_PATH}"
+
+    def request_params(self) -> dict:
+        """Поля для POST /v2/transcript, включающие уведомление."""
+        return {
+            "webhook_url": self.url,
+            "webhook_auth_header_name": AUTH_HEADER,
+            "webhook_auth_header_value": self.secret,
+        }
+
+    def expect(self, transcript_id: str) -> asyncio.Future:
+        waiter = self._waiters.get(transcript_id)
+        if waiter is None or waiter.done():
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters[transcript_id] = waiter
+            early = self._early.pop(transcript_id, None)
+            if early is not None:
+                waiter.set_result(early[1])
+        return waiter
+
+    def forget(self, transcript_id: str):
+        self._early.pop(transcript_id, None)
+        waiter = self._waiters.pop(transcript_id, None)
+        if waiter is not None and not waiter.done():
+            waiter.cancel()
+
+    def _remember(self, transcript_id: str, status: str | None):
+        now = time.monotonic()
+        self._early[transcript_id] = (now, status)
+        self._early.move_to_end(transcript_id)
+        while self._early:
+            oldest_id, (received, _) = next(iter(self._early.items()))
+            if len(self._early) <= EARLY_NOTIFICATIONS_MAX and now - received <= EARLY_NOTIFICATION_TTL:
+                break
+            del self._early[oldest_id]
+
+    async def handle(self, request: web.Request) -> web.Response:
+        if not hmac.compare_digest(request.headers.get(AUTH_HEADER, ""), self.secret):
+            return web.Response(status=401)
+        try:
+            data = await request.json()
+            transcript_id = data["transcript_id"]
+        except (ValueError, KeyError):
+            return web.Response(status=400)
+        waiter = self._waiters.get(transcript_id)
+        if waiter is None:
+            self._remember(transcript_id, data.get("status"))
+        elif not waiter.done():
+            waiter.set_result(data.get("status"))
+        return web.Response(text="ok")
+
+    def app(self) -> web.Application:
+        app = web.Application()
+        app.router.add_post(WEBHOOK_PATH, self.handle)
+        return app
+
+    async def start(self):
+        self._runner = web.AppRunner(self.app())
+        await self._runner.setup()
+        await web.TCPSite(self._runner, self.host, self.port).start()
+        logger.info(f"Webhook AssemblyAI слушает {self.host}:{self.port}, публичный адрес {self.url}")
+
+    async def stop(self):
+        for transcript_id in list(self._waiters):
+            self.forget(transcript_id)
+        self._early.clear()
+        if self._runner is not None:
+            await self._runner.cleanup()
+            self._runner = None
@@ -1,10 +1,14 @@
+import asyncio
 import time
 import logging
 from aiogram import types
 from aiogram.types import InlineKeyboardMarkup, InlineKeyboardButton
 
 from .localization import get_string
-from .config import SUPPORTED_FORMATS, DEFAULT_FORMAT
+from .telegram_outbox import progress_edits, ProgressEditDropped
+from .config import (
+    SUPPORTED_FORMATS, DEFAULT_FORMAT, PROGRESS_MIN_INTERVAL, PROGRESS_EDITS_PER_SECOND, PROGRESS_IDLE_TIMEOUT
+)
 
 logger = logging.getLogger(__name__)
 
@@ -16,59 +20,166 @@ user_selections = {}
 user_settings = {}
 
 
-class ProgressManager:
-    """Менеджер для управления прогрессом"""
+def render_progress(progress: float, lang: str = 'ru') -> str:
+    progress = max(0.0, min(1.0, float(progress)))
+    bar_length = 10
+    filled = int(progress * bar_length)
+    bar = '🟪' * filled + '⬜' * (bar_length - filled)
+    percent = int(progress * 100)
+
+    if progress < 0.3:
+        emoji = "📥"
+        return f"{emoji} {get_string('downloading_video', lang, bar=bar, percent=percent)}"
+    elif progress < 0.7:
+        emoji = "⚙️"
+        return f"{emoji} {get_string('processing_audio', lang, bar=bar, percent=percent)}"
+    else:
+        emoji = "📊"
+        return f"{emoji} Форматирование...\n{bar} {percent}%"
+
+
+class _EditRateLimiter:
+    """Общий на весь бот лимит правок сообщений: не больше per_second в секунду."""
+
+    def __init__(self, per_second: float):
+        self.interval = 1.0 / per_second if per_second > 0 else 0.0
+        self._next = 0.0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            now = time.monotonic()
+            if self._next > now:
+                await asyncio.sleep(self._next - now)
+                now = time.monotonic()
+            self._next = max(now, self._next) + self.interval
+
+
+class _ProgressActor:
+    """Очередь правок одного сообщения: хранит только последнее состояние.
+
+    События складываются в pending без ожидания; задача-актор раз в
+    min_interval (финальные значения — сразу) берёт последнее и правит
+    сообщение, если текст изменился. Без событий дольше idle_timeout
+    актор завершается и забывает сообщение.
+    """
+
+    def __init__(self, manager: "ProgressManager", key, message):
+        self.manager = manager
+        self.key = key
+        self.message = message
+        self.pending: str | None = None
+        self.urgent = False
+        self.sent_text: str | None = None
+        self.last_edit = 0.0
+        self.closed = False
+        self._wake = asyncio.Event()
+        self._stop = asyncio.Event()
+        self.task = asyncio.create_task(self._run())
+
+    def push(self, text: str, urgent: bool = False):
+        self.pending = text
+        self.urgent = self.urgent or urgent
+        self._wake.set()
+
+    async def _sleep_unless_stopped(self, delay: float) -> bool:
+        try:
+            await asyncio.wait_for(self._stop.wait(), delay)
+            return False
+        except asyncio.TimeoutError:
+            return True
 
-    def __init__(self):
-        self.last_update_times = {}
-        self.last_progress_values = {}
-        self.min_update_interval = 3.0
-        self.min_progress_change = 0.05
+    async def _run(self):
+        try:
+            while not self.closed:
+                try:
+                    await asyncio.wait_for(self._wake.wait(), self.manager.idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                self._wake.clear()
+                delay = self.last_edit + self.manager.min_interval - time.monotonic()
+                if delay > 0 and not self.urgent and not await self._sleep_unless_stopped(delay):
+                    break
+                text, self.pending, self.urgent = self.pending, None, False
+                if self.closed or text is None or text == self.sent_text:
+                    continue
+                await self.manager.limiter.acquire()
+                if self.closed:
+                    break
+                try:
+                    with progress_edits():
+                        await self.message.edit_text(text)
+                    self.sent_text = text
+                except ProgressEditDropped:
+                    pass
+                except Exception as e:
+                    if "message is not modified" not in str(e):
+                        logger.warning(f"Не удалось обновить прогресс: {str(e)}")
+                self.last_edit = time.monotonic()
+        finally:
+            self.manager._forget(self)
+
+    async def close(self):
+        self.closed = True
+        self._stop.set()
+        self._wake.set()
+        await self.task
+
+
+class ProgressManager:
+    """Менеджер для управления прогрессом.
+
+    update_progress никогда не ждёт Telegram: событие отдаётся актору
+    сообщения, промежуточные значения схлопываются. Правки ограничены
+    min_interval на сообщение и общим лимитом правок в секунду на все чаты.
+    finish() вызывается, когда прогресс больше не нужен — до финальной правки
+    или удаления сообщения, чтобы запоздалая правка её не перезаписала.
+    """
+
+    def __init__(self, min_interval: float = PROGRESS_MIN_INTERVAL, edits_per_second: float = PROGRESS_EDITS_PER_SECOND,
+                 idle_timeout: float = PROGRESS_IDLE_TIMEOUT):
+        self.min_interval = min_interval
+        self.idle_timeout = idle_timeout
+        self.limiter = _EditRateLimiter(edits_per_second)
+        self._actors: dict[tuple, _ProgressActor] = {}
+
+    @staticmethod
+    def _key(message) -> tuple:
+        return getattr(message.chat, "id", None), message.message_id
+
+    def _forget(self, actor: _ProgressActor):
+        if self._actors.get(actor.key) is actor:
+            del self._actors[actor.key]
+
+    @property
+    def tracked(self) -> int:
+        return len(self._actors)
 
     async def update_progress(self, progress, message, lang='ru'):
-        """Обновление прогресса отображаемого пользователю"""
+        """Обновление прогресса отображаемого пользователю (строка — готовый текст)"""
         try:
-            message_id = message.message_id
-            current_time = time.time()
-            last_update = self.last_update_times.get(message_id, 0)
-            last_progress = self.last_progress_values.get(message_id, -1)
-
             if isinstance(progress, str):
-                await message.edit_text(progress)
-                self.last_update_times[message_id] = current_time
-                return
-
-            if (current_time - last_update < self.min_update_interval and
-                    progress < 0.99 and
-                    abs(progress - last_progress) < self.min_progress_change):
-                return
-
-            progress = max(0.0, min(1.0, float(progress)))
-            bar_length = 10
-            filled = int(progress * bar_length)
-            bar = '🟪' * filled + '⬜' * (bar_length - filled)
-            percent = int(progress * 100)
-
-            if progress < 0.3:
-                emoji = "📥"
-                text = f"{emoji} {get_string('downloading_video', lang, bar=bar, percent=percent)}"
-            elif progress < 0.7:
-                emoji = "⚙️"
-                text = f"{emoji} {get_string('processing_audio', lang, bar=bar, percent=percent)}"
+                text, urgent = progress, True
             else:
-                emoji = "📊"
-                text = f"{emoji} Форматирование...\n{bar} {percent}%"
-
-            try:
-                await message.edit_text(text)
-                self.last_update_times[message_id] = current_time
-                self.last_progress_values[message_id] = progress
-            except Exception as e:
-                if "message is not modified" not in str(e):
-                    logger.warning(f"Не удалось обновить прогресс: {str(e)}")
+                text, urgent = render_progress(progress, lang), progress >= 0.99
+            key = self._key(message)
+            actor = self._actors.get(key)
+            if actor is None or actor.closed:
+                actor = self._actors[key] = _ProgressActor(self, key, message)
+            actor.push(text, urgent)
         except Exception as e:
             logger.warning(f"Ошибка обновления прогресса: {str(e)}")
 
+    async def finish(self, message):
+        """Останавливает правки сообщения и забывает его; идущая правка дожидается завершения."""
+        actor = self._actors.pop(self._key(message), None)
+        if actor is not None:
+            await actor.close()
+
+    async def aclose(self):
+        await asyncio.gather(*(actor.close() for actor in list(self._actors.values())), return_exceptions=True)
+        self._actors.clear()
+
 
 progress_manager = ProgressManager()
 
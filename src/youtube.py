@@ -0,0 +1,400 @@
+import asyncio
+import logging
+import os
+import shutil
+import threading
+import time
+import uuid
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from .config import (
+    FFMPEG_PATH, YOUTUBE_AUDIO_PASSTHROUGH, YOUTUBE_AUDIO_MIN_ABR, YOUTUBE_CONCURRENT_FRAGMENTS,
+    YOUTUBE_METADATA_TTL, YOUTUBE_METADATA_CACHE_SIZE, YOUTUBE_PROBE_WORKERS, YOUTUBE_DOWNLOAD_WORKERS,
+    YOUTUBE_DOWNLOAD_QUEUE
+)
+from .transcript_cache import youtube_video_id
+
+logger = logging.getLogger(__name__)
+
+
+class YoutubeProbeError(RuntimeError):
+    """Не удалось получить метаданные видео (недоступно, приватное, плейлист)."""
+
+
+# =============================
+#     Параметры yt-dlp
+# =============================
+_YOUTUBE_HEADERS = {
+    "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36",
+}
+
+
+def youtube_download_options(outtmpl: str, progress_hook=None, passthrough: bool = YOUTUBE_AUDIO_PASSTHROUGH) -> dict:
+    """Параметры yt-dlp для скачивания звука.
+
+    passthrough: берётся самая лёгкая аудиодорожка не хуже YOUTUBE_AUDIO_MIN_ABR
+    (обычно opus ~50 кбит/с или aac ~48 кбит/с) и сохраняется как есть —
+    без FFmpegExtractAudio, то есть без полного декодирования и кодирования
+    в MP3. Иначе — прежний путь: bestaudio и перекодирование в MP3.
+    """
+    options = {
+        "outtmpl": outtmpl,
+        "ffmpeg_location": FFMPEG_PATH,
+        "progress_hooks": [progress_hook] if progress_hook else [],
+        "quiet": True,
+        "no_warnings": False,
+        "extract_flat": False,
+        "noplaylist": True,
+        "http_headers": _YOUTUBE_HEADERS,
+    }
+    if passthrough:
+        options.update({
+            "format": f"bestaudio[vcodec=none][abr>={YOUTUBE_AUDIO_MIN_ABR}]/bestaudio[vcodec=none]/bestaudio/best",
+            # bestaudio по этой сортировке — дорожка с наименьшим битрейтом, при равенстве — меньший файл
+            "format_sort": ["+abr", "+size"],
+            "concurrent_fragment_downloads": max(1, YOUTUBE_CONCURRENT_FRAGMENTS),
+        })
+    else:
+        options.update({
+            "format": "bestaudio/best",
+            "postprocessors": [{
+                "key": "FFmpegExtractAudio",
+                "preferredcodec": "mp3",
+            }],
+        })
+    return options
+
+
+# =============================
+#     Метаданные видео
+# =============================
+class YoutubeMetadata:
+    """То, что нужно знать о видео до скачивания: длительность, эфир ли это,
+    аудиоформаты и ожидаемый размер дорожки, которую выберет youtube_download_options.
+
+    info — полный ответ yt-dlp: download_youtube_audio скачивает по нему, не
+    запрашивая страницу видео второй раз.
+    """
+
+    def __init__(self, info: dict):
+        self.info = info
+        self.video_id: str | None = info.get("id")
+        self.title: str = info.get("title") or ""
+        self.duration: float | None = info.get("duration")
+        self.is_live: bool = bool(info.get("is_live")) or info.get("live_status") in ("is_live", "is_upcoming")
+        self.format_id: str | None = info.get("format_id")
+        self.audio_formats = [
+            {
+                "format_id": f.get("format_id"),
+                "ext": f.get("ext"),
+                "acodec": f.get("acodec"),
+                "abr": f.get("abr"),
+                "filesize": f.get("filesize") or f.get("filesize_approx"),
+            }
+            for f in info.get("formats") or []
+            if f.get("vcodec") == "none" and f.get("acodec") not in (None, "none")
+        ]
+        self.estimated_size = self._estimate_size(info)
+
+    def _estimate_size(self, info: dict) -> int | None:
+        """Байты выбранного формата: точный размер, приблизительный или битрейт × длительность."""
+        chosen = info.get("requested_formats") or [info]
+        total = 0
+        for f in chosen:
+            size = f.get("filesize") or f.get("filesize_approx")
+            if not size:
+                bitrate = f.get("tbr") or f.get("abr")
+                if not bitrate or not self.duration:
+                    return None
+                size = bitrate * 1000 / 8 * self.duration
+            total += size
+        return int(total)
+
+
+def _extract_info(url: str) -> dict:
+    import yt_dlp  # тяжёлый импорт — только когда действительно нужен
+
+    options = youtube_download_options("%(id)s.%(ext)s")
+    options["skip_download"] = True
+    try:
+        with yt_dlp.YoutubeDL(options) as ydl:
+            info = ydl.extract_info(url, download=False)
+    except Exception as e:
+        raise YoutubeProbeError(str(e)) from e
+    if not info:
+        raise YoutubeProbeError("yt-dlp не вернул информацию о видео")
+    if info.get("_type") == "playlist":
+        raise YoutubeProbeError("Плейлисты не поддерживаются — отправьте ссылку на одно видео")
+    return info
+
+
+def video_key(url: str) -> str:
+    return youtube_video_id(url) or url.strip()
+
+
+class YoutubeProbe:
+    """Метаданные видео с TTL-кэшем по ID видео.
+
+    Повторная ссылка на то же видео (другая форма URL, таймкод) в пределах ttl
+    не ходит в YouTube; одновременные запросы одного видео ждут одно
+    извлечение. Ошибки не кэшируются. yt-dlp работает в небольшом
+    собственном пуле потоков, а не в общем executor'е и не за скачиваниями.
+    """
+
+    def __init__(self, ttl: float = YOUTUBE_METADATA_TTL, max_entries: int = YOUTUBE_METADATA_CACHE_SIZE,
+                 extract=_extract_info, workers: int = YOUTUBE_PROBE_WORKERS):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.workers = max(1, workers)
+        self._extract = extract
+        self._executor: ThreadPoolExecutor | None = None
+        self._cache: OrderedDict[str, tuple[float, YoutubeMetadata]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="yt-dlp-probe")
+        return self._executor
+
+    @staticmethod
+    def cache_key(url: str) -> str:
+        return video_key(url)
+
+    def get_cached(self, url: str) -> YoutubeMetadata | None:
+        key = self.cache_key(url)
+        entry = self._cache.get(key)
+        if entry is None:
+            return None
+        expires_at, metadata = entry
+        if time.monotonic() >= expires_at:
+            del self._cache[key]
+            return None
+        self._cache.move_to_end(key)
+        return metadata
+
+    async def probe(self, url: str) -> YoutubeMetadata:
+        cached = self.get_cached(url)
+        if cached is not None:
+            return cached
+        key = self.cache_key(url)
+        pending = self._inflight.get(key)
+        if pending is not None:
+            return await asyncio.shield(pending)
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            started = time.perf_counter()
+            loop = asyncio.get_running_loop()
+            metadata = YoutubeMetadata(await loop.run_in_executor(self.executor, self._extract, url))
+            logger.info(
+                f"Метаданные {key}: {metadata.duration} с, формат {metadata.format_id}, "
+                f"~{metadata.estimated_size} байт, эфир: {metadata.is_live} ({time.perf_counter() - started:.1f} с)"
+            )
+            self._cache[key] = (time.monotonic() + self.ttl, metadata)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.max_entries:
+                self._cache.popitem(last=False)
+            future.set_result(metadata)
+            return metadata
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+        except Exception as e:
+            future.set_exception(e)
+            future.exception()  # ожидающих может не быть — не логировать "never retrieved"
+            raise
+        finally:
+            del self._inflight[key]
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+metadata_probe = YoutubeProbe()
+
+
+# =============================
+#     Менеджер скачиваний
+# =============================
+class DownloadQueueFull(Exception):
+    """Очередь скачиваний заполнена — новая ссылка не принята."""
+
+
+class DownloadCancelled(Exception):
+    """Скачивание отменено: все, кто его ждал, ушли."""
+
+
+class _Download:
+    def __init__(self, key: str):
+        self.key = key
+        self.task: asyncio.Task | None = None
+        self.subscribers = 0
+        self.listeners: list = []
+        self.cancelled = threading.Event()
+        self.queued_at = time.monotonic()
+        self.started_at: float | None = None
+
+
+class DownloadManager:
+    """Скачивания yt-dlp в собственном пуле потоков вместо общего executor'а.
+
+    Одновременно качается не больше workers видео, ещё max_queue ждут своей
+    очереди. Одинаковые ссылки (по ID видео) качаются один раз: каждый
+    ожидающий получает свою жёсткую ссылку на готовый файл и удаляет её сам.
+    Когда уходит последний ожидающий, скачивание отменяется — и в очереди,
+    и на ходу (через флаг, который проверяет progress hook yt-dlp).
+    """
+
+    def __init__(self, workers: int = YOUTUBE_DOWNLOAD_WORKERS, max_queue: int = YOUTUBE_DOWNLOAD_QUEUE):
+        self.workers = max(1, workers)
+        self.max_queue = max_queue
+        self._executor: ThreadPoolExecutor | None = None
+        self._slots: asyncio.Semaphore | None = None
+        self._inflight: dict[str, _Download] = {}
+        self._running = 0
+        self.completed = 0
+        self.failed = 0
+        self.cancelled = 0
+        self.deduplicated = 0
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        if self._executor is None:
+            self._executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="yt-dlp")
+        return self._executor
+
+    @property
+    def queued(self) -> int:
+        # Первые workers скачиваний идут сразу, остальные ждут слота
+        return max(0, len(self._inflight) - self.workers)
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def stats(self) -> dict:
+        return {
+            "queued": self.queued,
+            "running": self._running,
+            "subscribers": sum(d.subscribers for d in self._inflight.values()),
+            "completed": self.completed,
+            "failed": self.failed,
+            "cancelled": self.cancelled,
+            "deduplicated": self.deduplicated,
+        }
+
+    async def download(self, url: str, fetch, progress_callback=None) -> str:
+        """Скачивает url (или присоединяется к уже идущему скачиванию того же видео).
+
+        fetch(progress, cancelled, executor) — корутина, которая качает в executor,
+        передаёт проценты в progress, прерывается, когда выставлен cancelled
+        (threading.Event), и возвращает путь к файлу. Возвращается путь к
+        собственной копии файла — её удаляет вызывающий.
+        """
+        key = video_key(url)
+        download = self._inflight.get(key)
+        if download is None:
+            if len(self._inflight) >= self.workers + self.max_queue:
+                raise DownloadQueueFull(f"Очередь скачиваний заполнена ({self.queued})")
+            download = self._inflight[key] = _Download(key)
+            download.task = asyncio.create_task(self._run(download, fetch))
+        else:
+            self.deduplicated += 1
+            logger.info(f"Скачивание {key} уже идёт — присоединяюсь ({download.subscribers + 1} ожидающих)")
+        download.subscribers += 1
+        if progress_callback is not None:
+            download.listeners.append(progress_callback)
+        try:
+            path = await asyncio.shield(download.task)
+            claim = asyncio.ensure_future(asyncio.to_thread(self._claim, path))
+            try:
+                return await asyncio.shield(claim)
+            except BaseException:
+                # Отменили, пока поток делал ссылку: он всё равно её создаст — убираем за ним
+                claim.add_done_callback(lambda f: f.cancelled() or f.exception() or _remove_quietly(f.result()))
+                raise
+        finally:
+            if progress_callback is not None:
+                download.listeners.remove(progress_callback)
+            download.subscribers -= 1
+            if not download.subscribers:
+                if not download.task.done():
+                    logger.info(f"Скачивание {key} никому не нужно — отменяю")
+                    download.cancelled.set()
+                    download.task.cancel()
+                elif not download.task.cancelled() and download.task.exception() is None:
+                    _remove_quietly(download.task.result())
+
+    async def _run(self, download: _Download, fetch) -> str:
+        async def progress(percent: float):
+            for listener in list(download.listeners):
+                try:
+                    await listener(percent)
+                except Exception as e:
+                    logger.warning(f"Ошибка обработки прогресса загрузки {download.key}: {e}")
+
+        if self._slots is None:
+            self._slots = asyncio.Semaphore(self.workers)
+        try:
+            async with self._slots:
+                download.started_at = time.monotonic()
+                self._running += 1
+                logger.info(
+                    f"Скачивание {download.key}: старт после {download.started_at - download.queued_at:.1f} с "
+                    f"в очереди (качается {self._running}/{self.workers}, ждут {self.queued})"
+                )
+                try:
+                    path = await fetch(progress, download.cancelled, self.executor)
+                finally:
+                    self._running -= 1
+            self.completed += 1
+            logger.info(f"Скачивание {download.key} заняло {time.monotonic() - download.started_at:.1f} с")
+            return path
+        except (asyncio.CancelledError, DownloadCancelled):
+            self.cancelled += 1
+            raise
+        except Exception:
+            self.failed += 1
+            raise
+        finally:
+            if self._inflight.get(download.key) is download:
+                del self._inflight[download.key]
+
+    @staticmethod
+    def _claim(path: str) -> str:
+        """Своя копия файла для ожидающего: жёсткая ссылка, а если ФС не умеет — копия."""
+        base, ext = os.path.splitext(path)
+        claimed = f"{base}-{uuid.uuid4().hex[:8]}{ext}"
+        try:
+            os.link(path, claimed)
+        except OSError:
+            try:
+                shutil.copyfile(path, claimed)
+            except BaseException:
+                _remove_quietly(claimed)
+                raise
+        return claimed
+
+    async def shutdown(self):
+        for download in list(self._inflight.values()):
+            download.cancelled.set()
+            download.task.cancel()
+        await asyncio.gather(*(d.task for d in list(self._inflight.values())), return_exceptions=True)
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+
+def _remove_quietly(path: str):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
+
+
+download_manager = DownloadManager()
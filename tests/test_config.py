@@ -46,3 +46,25 @@ def test_config_raises_error_on_missing_env_var(monkeypatch, mocker):
     with pytest.raises(ValueError, match="Не все обязательные переменные окружения установлены"):
         from src import config
         importlib.reload(config)
+
+def test_webhook_mode_requires_shared_secret(monkeypatch, mocker):
+    """
+    Webhook mode needs a fixed TELEGRAM_WEBHOOK_SECRET: every instance
+    registers it with Telegram, so a per-process random one would break scaling.
+    """
+    mocker.patch('dotenv.load_dotenv')
+    monkeypatch.setenv('TELEGRAM_BOT_TOKEN', 'dummy')
+    monkeypatch.setenv('ASSEMBLYAI_API_KEY', 'dummy')
+    monkeypatch.setenv('BOT_MODE', 'webhook')
+    monkeypatch.setenv('TELEGRAM_WEBHOOK_URL', 'https://bot.example')
+    monkeypatch.delenv('TELEGRAM_WEBHOOK_SECRET', raising=False)
+
+    from src import config
+    with pytest.raises(ValueError, match="TELEGRAM_WEBHOOK_SECRET"):
+        importlib.reload(config)
+
+    monkeypatch.setenv('TELEGRAM_WEBHOOK_SECRET', 's3cret')
+    importlib.reload(config)
+    assert config.TELEGRAM_WEBHOOK_SECRET == 's3cret'
+    monkeypatch.setenv('BOT_MODE', 'polling')
+    importlib.reload(config)
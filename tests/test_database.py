@@ -1,209 +1,174 @@
 import pytest
+import pytest_asyncio
 import sqlite3
 import time
 import asyncio
-from unittest.mock import MagicMock, patch, call, AsyncMock
+from unittest.mock import MagicMock
 
 from src import database
 from src.config import SUBSCRIPTION_DURATION_DAYS, ADMIN_USER_IDS
 
-# Mocking the database connection and cursor
-@pytest.fixture
-def mock_db_cursor():
-    """Provides a mock for sqlite3 cursor and connection."""
-    mock_conn = MagicMock(spec=sqlite3.Connection)
-    mock_cursor = MagicMock(spec=sqlite3.Cursor)
-    mock_conn.cursor.return_value = mock_cursor
-    
-    # Mock commit and close methods
-    mock_conn.commit = MagicMock()
-    mock_conn.close = MagicMock()
-    
-    # Mock fetchone to return None initially, simulating a new user
-    mock_cursor.fetchone.return_value = None
-    
-    # Mock execute to capture calls
-    mock_cursor.execute = MagicMock()
-    
-    # Mock sqlite3.connect to return our mock connection
-    with patch('sqlite3.connect', return_value=mock_conn) as mock_connect:
-        yield mock_conn, mock_cursor, mock_connect
-
-@pytest.mark.asyncio
-async def test_init_db(mock_db_cursor):
-    """Tests the initialization of the database."""
-    mock_conn, mock_cursor, mock_connect = mock_db_cursor
-    
+
+@pytest_asyncio.fixture
+async def db_engine(tmp_path, monkeypatch):
+    """Provides a fresh WAL-mode database in a temporary directory."""
+    engine = database.Database(str(tmp_path / "users.db"), read_pool_size=4)
+    monkeypatch.setattr(database, "engine", engine)
+    cache = database.EntitlementCache(maxsize=1000, ttl=60)
+    monkeypatch.setattr(database, "entitlements", cache)
+    monkeypatch.setattr(database, "writes", database.WriteBehindQueue(engine, cache, flush_interval=0.05))
     await database.init_db()
-    
-    # Check if connect was called
-    mock_connect.assert_called_once_with('users.db')
-    
-    # Check if cursor was obtained
-    mock_conn.cursor.assert_called_once()
-    
-    # Check if execute was called with the correct CREATE TABLE statement
-    expected_create_table_sql = '''
-            CREATE TABLE IF NOT EXISTS users (
-                user_id INTEGER PRIMARY KEY,
-                trials_used INTEGER DEFAULT 0,
-                is_paid BOOLEAN DEFAULT FALSE,
-                subscription_expiry INTEGER DEFAULT 0
-            )
-        '''
-    mock_cursor.execute.assert_any_call(expected_create_table_sql)
-    
-    # Check if commit and close were called
-    mock_conn.commit.assert_called_once()
-    mock_conn.close.assert_called_once()
-
-@pytest.mark.asyncio
-async def test_check_user_trials_admin(mock_db_cursor):
+    yield engine
+    await database.close_db()
+
+
+def _fetch_user(engine, user_id):
+    conn = sqlite3.connect(engine.path)
+    try:
+        return conn.execute(database.SELECT_USER_SQL, (user_id,)).fetchone()
+    finally:
+        conn.close()
+
+
+def _insert_user(engine, user_id, trials_used, is_paid, expiry):
+    conn = sqlite3.connect(engine.path)
+    try:
+        conn.execute(
+            'INSERT INTO users (user_id, trials_used, is_paid, subscription_expiry) VALUES (?, ?, ?, ?)',
+            (user_id, trials_used, is_paid, expiry)
+        )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+@pytest.mark.asyncio
+async def test_init_db(db_engine):
+    """Tests the initialization of the database."""
+    conn = sqlite3.connect(db_engine.path)
+    try:
+        tables = [r[0] for r in conn.execute("SELECT name FROM sqlite_master WHERE type='table'")]
+        journal_mode = conn.execute("PRAGMA journal_mode").fetchone()[0]
+    finally:
+        conn.close()
+    assert "users" in tables
+    assert journal_mode == "wal"
+
+
+@pytest.mark.asyncio
+async def test_check_user_trials_admin(db_engine, mocker):
     """Tests check_user_trials for an admin user."""
-    mock_conn, mock_cursor, mock_connect = mock_db_cursor
-    
+    read_spy = mocker.spy(db_engine, "read")
+    write_spy = mocker.spy(db_engine, "write")
+
     admin_id = ADMIN_USER_IDS[0] if ADMIN_USER_IDS else 9999
-    
+
     can_use, is_paid = await database.check_user_trials(admin_id)
-    
+
     assert can_use is True
     assert is_paid is True
-    
+
     # Ensure no DB operations were performed for admin
-    mock_connect.assert_not_called()
-    mock_cursor.execute.assert_not_called()
-    mock_conn.commit.assert_not_called()
-    mock_conn.close.assert_not_called()
+    read_spy.assert_not_called()
+    write_spy.assert_not_called()
+
 
 @pytest.mark.asyncio
-async def test_check_user_trials_new_user(mock_db_cursor):
+async def test_check_user_trials_new_user(db_engine):
     """Tests check_user_trials for a new user."""
-    mock_conn, mock_cursor, mock_connect = mock_db_cursor
     user_id = 1001
-    
-    # Mock fetchone to return None (new user)
-    mock_cursor.fetchone.return_value = None
-    
+
     can_use, is_paid = await database.check_user_trials(user_id)
-    
+
     assert can_use is True  # New users get 2 free trials
     assert is_paid is False
-    
-    # Check DB operations: INSERT for new user
-    mock_connect.assert_called_once_with('users.db')
-    mock_conn.cursor.assert_called_once()
-    
-    expected_insert_sql = 'INSERT INTO users (user_id, trials_used, is_paid, subscription_expiry) VALUES (?, 0, FALSE, 0)'
-    mock_cursor.execute.assert_any_call(expected_insert_sql, (user_id,))
-    mock_conn.commit.assert_called_once()
-    mock_conn.close.assert_called_once()
-
-@pytest.mark.asyncio
-async def test_check_user_trials_with_trials(mock_db_cursor, monkeypatch):
+    await database.flush_db()
+    assert _fetch_user(db_engine, user_id) == (0, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_check_user_trials_with_trials(db_engine, mocker):
     """Tests check_user_trials for a user with trials remaining."""
-    mock_conn, mock_cursor, mock_connect = mock_db_cursor
     user_id = 1002
-    
-    # Mock fetchone to return data for a user with trials
-    mock_cursor.fetchone.return_value = (1, False, 0) # trials_used=1, is_paid=False, expiry=0
-    
-    # Mock time.time() to control subscription expiry
-    mock_time = MagicMock()
-    monkeypatch.setattr(time, 'time', mock_time)
-    mock_time.return_value = 1678886400 # Some arbitrary time
-    
+    _insert_user(db_engine, user_id, 1, False, 0)
+    write_spy = mocker.spy(db_engine, "write")
+
     can_use, is_paid = await database.check_user_trials(user_id)
-    
+
     assert can_use is True
     assert is_paid is False
-    
-    mock_connect.assert_called_once_with('users.db')
-    mock_conn.cursor.assert_called_once()
-    expected_select_sql = 'SELECT trials_used, is_paid, subscription_expiry FROM users WHERE user_id = ?'
-    mock_cursor.execute.assert_any_call(expected_select_sql, (user_id,))
-    mock_conn.close.assert_called_once()
     # No UPDATE or INSERT should happen here, only SELECT
-    assert mock_cursor.execute.call_count == 1 # Only the SELECT call
+    write_spy.assert_not_called()
+
 
 @pytest.mark.asyncio
-async def test_check_user_trials_expired_subscription(mock_db_cursor, monkeypatch):
+async def test_check_user_trials_no_trials_left(db_engine):
+    """Tests check_user_trials for a user who used both free trials."""
+    user_id = 1005
+    _insert_user(db_engine, user_id, 2, False, 0)
+
+    can_use, is_paid = await database.check_user_trials(user_id)
+
+    assert can_use is False
+    assert is_paid is False
+
+
+@pytest.mark.asyncio
+async def test_check_user_trials_expired_subscription(db_engine, monkeypatch):
     """Tests check_user_trials for a user with an expired subscription."""
-    mock_conn, mock_cursor, mock_connect = mock_db_cursor
     user_id = 1003
-    
+
     # Mock time.time() to control current time
-    mock_time = MagicMock()
-    mock_time.return_value = 1678886400 + 2000  # Ensure it's after expired_time
+    mock_time = MagicMock(return_value=1678886400 + 2000)
     monkeypatch.setattr(time, 'time', mock_time)
 
-    # Mock fetchone to return data for a user with an expired subscription
-    expired_time = int(time.time()) - 1000 # Expired 1000 seconds ago
-    mock_cursor.fetchone.return_value = (0, True, expired_time) # trials_used=0, is_paid=True, expiry=expired_time
-    
+    expired_time = int(time.time()) - 1000  # Expired 1000 seconds ago
+    _insert_user(db_engine, user_id, 0, True, expired_time)
+
     can_use, is_paid = await database.check_user_trials(user_id)
-    
-    assert can_use is True # Should revert to trials if subscription expired
-    assert is_paid is False # is_paid should be updated to False
-    
-    mock_connect.assert_called_once_with('users.db')
-    mock_conn.cursor.assert_called_once()
-    expected_select_sql = 'SELECT trials_used, is_paid, subscription_expiry FROM users WHERE user_id = ?'
-    mock_cursor.execute.assert_any_call(expected_select_sql, (user_id,))
-    
-    # Check that the subscription was reset
-    expected_update_sql = 'UPDATE users SET is_paid = FALSE, subscription_expiry = 0 WHERE user_id = ?'
-    mock_cursor.execute.assert_any_call(expected_update_sql, (user_id,))
-    mock_conn.commit.assert_called_once()
-    mock_conn.close.assert_called_once()
-
-@pytest.mark.asyncio
-async def test_check_user_trials_active_subscription(mock_db_cursor, monkeypatch):
+
+    assert can_use is True  # Should revert to trials if subscription expired
+    assert is_paid is False  # is_paid should be updated to False
+    await database.flush_db()
+    assert _fetch_user(db_engine, user_id) == (0, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_check_user_trials_active_subscription(db_engine, monkeypatch, mocker):
     """Tests check_user_trials for a user with an active subscription."""
-    mock_conn, mock_cursor, mock_connect = mock_db_cursor
     user_id = 1004
-    
-    # Mock fetchone to return data for a user with an active subscription
-    active_expiry_time = int(time.time()) + 1000 # Active for another 1000 seconds
-    mock_cursor.fetchone.return_value = (0, True, active_expiry_time) # trials_used=0, is_paid=True, expiry=active_expiry_time
-    
-    # Mock time.time() to control current time
-    # Set it to a fixed value that is guaranteed to be after the expired_time
-    mock_time = MagicMock(return_value=1678886400 + 2000) # Ensure it's after expired_time
+    mock_time = MagicMock(return_value=1678886400 + 2000)
     monkeypatch.setattr(time, 'time', mock_time)
-    
+    _insert_user(db_engine, user_id, 0, True, int(time.time()) + 1000)
+    write_spy = mocker.spy(db_engine, "write")
+
     can_use, is_paid = await database.check_user_trials(user_id)
-    
+
     assert can_use is True
     assert is_paid is True
-    
-    mock_connect.assert_called_once_with('users.db')
-    mock_conn.cursor.assert_called_once()
-    expected_select_sql = 'SELECT trials_used, is_paid, subscription_expiry FROM users WHERE user_id = ?'
-    mock_cursor.execute.assert_any_call(expected_select_sql, (user_id,))
-    mock_conn.close.assert_called_once()
-    # No UPDATE or INSERT should happen here, only SELECT
-    assert mock_cursor.execute.call_count == 1 # Only the SELECT call
+    write_spy.assert_not_called()
+
 
 @pytest.mark.asyncio
-async def test_increment_trials(mock_db_cursor):
+async def test_increment_trials(db_engine):
     """Tests the increment_trials function."""
-    mock_conn, mock_cursor, mock_connect = mock_db_cursor
     user_id = 2001
+    await database.check_user_trials(user_id)
 
     await database.increment_trials(user_id)
+    await database.increment_trials(user_id)
+    await database.flush_db()
+
+    assert _fetch_user(db_engine, user_id)[0] == 2
+    can_use, _ = await database.check_user_trials(user_id)
+    assert can_use is False
 
-    mock_connect.assert_called_once_with('users.db')
-    mock_conn.cursor.assert_called_once()
-    expected_update_sql = 'UPDATE users SET trials_used = trials_used + 1 WHERE user_id = ?'
-    mock_cursor.execute.assert_called_once_with(expected_update_sql, (user_id,))
-    mock_conn.commit.assert_called_once()
-    mock_conn.close.assert_called_once()
 
 @pytest.mark.asyncio
-async def test_activate_subscription(mock_db_cursor, monkeypatch):
+async def test_activate_subscription(db_engine, monkeypatch):
     """Tests the activate_subscription function."""
-    mock_conn, mock_cursor, mock_connect = mock_db_cursor
     user_id = 2002
+    await database.check_user_trials(user_id)
 
     # Mock time.time() to control the expiry time
     mock_time = MagicMock(return_value=1678886400)
@@ -213,9 +178,262 @@ async def test_activate_subscription(mock_db_cursor, monkeypatch):
     expiry_time = await database.activate_subscription(user_id)
 
     assert expiry_time == expected_expiry_time
-    mock_connect.assert_called_once_with('users.db')
-    mock_conn.cursor.assert_called_once()
-    expected_update_sql = 'UPDATE users SET is_paid = TRUE, subscription_expiry = ? WHERE user_id = ?'
-    mock_cursor.execute.assert_called_once_with(expected_update_sql, (expected_expiry_time, user_id))
-    mock_conn.commit.assert_called_once()
-    mock_conn.close.assert_called_once()
+    assert _fetch_user(db_engine, user_id) == (0, 1, expected_expiry_time)
+
+
+@pytest.mark.asyncio
+async def test_engine_reopens_after_close(db_engine):
+    """The engine lazily recreates its threads and connections after close()."""
+    await database.check_user_trials(3001)
+    await database.flush_db()
+    db_engine.close()
+    database.entitlements.invalidate()
+    can_use, is_paid = await database.check_user_trials(3001)
+    assert (can_use, is_paid) == (True, False)
+
+
+@pytest.mark.asyncio
+async def test_queries_do_not_block_event_loop(db_engine):
+    """Database work runs in worker threads, so the loop keeps ticking."""
+    def slow_query(conn):
+        time.sleep(0.3)
+        return conn.execute("SELECT 1").fetchone()
+
+    ticks = 0
+
+    async def ticker():
+        nonlocal ticks
+        while True:
+            await asyncio.sleep(0.01)
+            ticks += 1
+
+    ticker_task = asyncio.create_task(ticker())
+    try:
+        assert await db_engine.read(slow_query) == (1,)
+    finally:
+        ticker_task.cancel()
+    assert ticks >= 10
+
+
+@pytest.mark.asyncio
+async def test_hot_user_served_from_cache(db_engine, mocker):
+    """Repeated checks for the same user do not touch SQLite."""
+    user_id = 4001
+    await database.check_user_trials(user_id)
+    read_spy = mocker.spy(db_engine, "read")
+    write_spy = mocker.spy(db_engine, "write")
+
+    for _ in range(5):
+        assert await database.check_user_trials(user_id) == (True, False)
+
+    read_spy.assert_not_called()
+    write_spy.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_cache_write_through_on_increment_and_activate(db_engine, mocker):
+    """increment_trials and activate_subscription keep the cached row current."""
+    user_id = 4002
+    await database.check_user_trials(user_id)
+    await database.increment_trials(user_id)
+    await database.increment_trials(user_id)
+    read_spy = mocker.spy(db_engine, "read")
+
+    assert await database.check_user_trials(user_id) == (False, False)
+
+    expiry_time = await database.activate_subscription(user_id)
+    assert await database.check_user_trials(user_id) == (True, True)
+    assert database.entitlements.get(user_id) == (2, True, expiry_time)
+    read_spy.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_cached_subscription_expiry_is_exact(db_engine, monkeypatch, mocker):
+    """The cached expiry timestamp is checked locally on every call."""
+    user_id = 4003
+    mock_time = MagicMock(return_value=1678886400)
+    monkeypatch.setattr(time, 'time', mock_time)
+    await database.check_user_trials(user_id)
+    expiry_time = await database.activate_subscription(user_id)
+    read_spy = mocker.spy(db_engine, "read")
+
+    mock_time.return_value = expiry_time
+    assert await database.check_user_trials(user_id) == (True, True)
+
+    mock_time.return_value = expiry_time + 1
+    assert await database.check_user_trials(user_id) == (True, False)
+    await database.flush_db()
+    assert _fetch_user(db_engine, user_id) == (0, 0, 0)
+    read_spy.assert_not_called()
+
+
+@pytest.mark.asyncio
+async def test_cache_ttl_and_lru_eviction(db_engine, monkeypatch):
+    """Entries expire after the TTL and the least recently used user is evicted."""
+    cache = database.EntitlementCache(maxsize=2, ttl=10)
+    now = 1000.0
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+
+    cache.put(1, (0, False, 0))
+    cache.put(2, (1, False, 0))
+    assert cache.get(1) == (0, False, 0)
+    cache.put(3, (2, False, 0))
+    assert cache.get(2) is None  # least recently used
+    assert len(cache) == 2
+
+    now += 11
+    assert cache.get(1) is None
+    assert cache.get(3) is None
+
+
+def test_cache_rejects_rows_read_before_a_write():
+    """A row read before a concurrent write must not overwrite the fresh state."""
+    cache = database.EntitlementCache(maxsize=10, ttl=60)
+    generation = cache.generation
+    cache.pin(5, (1, False, 0))
+    cache.put(5, (0, False, 0), generation)
+    assert cache.get(5) == (1, False, 0)
+
+
+def test_pinned_rows_are_not_evicted(monkeypatch):
+    """Rows with unflushed writes survive both LRU pressure and the TTL."""
+    cache = database.EntitlementCache(maxsize=1, ttl=10)
+    now = 1000.0
+    monkeypatch.setattr(time, 'monotonic', lambda: now)
+    cache.pin(1, (1, False, 0))
+    cache.put(2, (0, False, 0))
+    now += 100
+    assert cache.get(1) == (1, False, 0)
+    assert cache.get(2) is None
+
+    cache.unpin(1)
+    now += 11
+    assert cache.get(1) is None
+
+
+@pytest.mark.asyncio
+async def test_write_behind_coalesces_into_one_transaction(db_engine, mocker):
+    """Many first-time users and increments are flushed in a single write."""
+    await database.writes.stop()  # flush manually
+    write_spy = mocker.spy(db_engine, "write")
+
+    for user_id in range(5000, 5100):
+        await database.check_user_trials(user_id)
+        await database.increment_trials(user_id)
+    await database.increment_trials(5000)
+
+    assert write_spy.call_count == 0
+    assert len(database.writes) == 100
+    assert await database.writes.flush() == 100
+    assert write_spy.call_count == 1
+    assert _fetch_user(db_engine, 5000) == (2, 0, 0)
+    assert _fetch_user(db_engine, 5099) == (1, 0, 0)
+    assert len(database.writes) == 0
+
+
+@pytest.mark.asyncio
+async def test_write_behind_flushes_on_timer_and_row_limit(db_engine):
+    """The background flusher writes after flush_interval or once max_rows users are queued."""
+    await database.check_user_trials(6001)
+    await asyncio.sleep(0.2)
+    assert _fetch_user(db_engine, 6001) == (0, 0, 0)
+
+    database.writes.flush_interval = 60
+    database.writes.max_rows = 3
+    await database.writes.stop()
+    database.writes.start()
+    for user_id in (6002, 6003, 6004):
+        await database.check_user_trials(user_id)
+    await asyncio.sleep(0.1)
+    assert _fetch_user(db_engine, 6004) == (0, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_close_db_flushes_pending_writes(db_engine):
+    """close_db (called from bot.main on shutdown) drains the queue."""
+    database.writes.flush_interval = 60
+    await database.check_user_trials(7001)
+    await database.increment_trials(7001)
+
+    await database.close_db()
+
+    assert _fetch_user(db_engine, 7001) == (1, 0, 0)
+
+
+@pytest.mark.asyncio
+async def test_activate_subscription_is_durable_on_return(db_engine):
+    """A paid subscription is committed before activate_subscription returns."""
+    database.writes.flush_interval = 60
+    await database.check_user_trials(7002)
+    expiry_time = await database.activate_subscription(7002)
+    assert _fetch_user(db_engine, 7002) == (0, 1, expiry_time)
+
+
+@pytest.mark.asyncio
+async def test_failed_flush_keeps_changes_queued(db_engine, mocker):
+    """If the transaction fails, the batch is merged back and retried later."""
+    await database.writes.stop()
+    await database.check_user_trials(8001)
+    mocker.patch.object(db_engine, "write", side_effect=sqlite3.OperationalError("disk I/O error"))
+
+    with pytest.raises(sqlite3.OperationalError):
+        await database.writes.flush()
+    await database.increment_trials(8001)
+    assert database.entitlements.get(8001) == (1, False, 0)
+
+    mocker.stopall()
+    await database.writes.flush()
+    assert _fetch_user(db_engine, 8001) == (1, 0, 0)
+
+
+# =============================
+#          Бенчмарк
+# =============================
+async def _legacy_check_user_trials(path: str, lock: asyncio.Lock, user_id: int):
+    """Previous implementation: a fresh connection per call under one global lock."""
+    async with lock:
+        conn = sqlite3.connect(path)
+        cursor = conn.cursor()
+        cursor.execute(database.SELECT_USER_SQL, (user_id,))
+        row = cursor.fetchone()
+        if row is None:
+            cursor.execute(database.INSERT_USER_SQL, (user_id,))
+            conn.commit()
+        conn.close()
+
+
+@pytest.mark.asyncio
+async def test_benchmark_concurrent_check_user_trials(db_engine, tmp_path, capsys):
+    """Concurrent check_user_trials throughput: per-call connections vs the pooled engine."""
+    users = list(range(10_000, 10_200))
+    calls = users * 5
+    legacy_path = str(tmp_path / "legacy.db")
+    conn = sqlite3.connect(legacy_path)
+    conn.execute(database.CREATE_USERS_SQL)
+    conn.commit()
+    conn.close()
+    lock = asyncio.Lock()
+    for user_id in users:
+        await database.check_user_trials(user_id)
+        await _legacy_check_user_trials(legacy_path, lock, user_id)
+    # Measure the WAL engine itself: with the entitlement cache off every call reads SQLite
+    database.entitlements.maxsize = 0
+    await database.flush_db()
+    assert len(database.entitlements) == 0
+
+    started = time.perf_counter()
+    await asyncio.gather(*(_legacy_check_user_trials(legacy_path, lock, u) for u in calls))
+    legacy_elapsed = time.perf_counter() - started
+
+    started = time.perf_counter()
+    await asyncio.gather(*(database.check_user_trials(u) for u in calls))
+    pooled_elapsed = time.perf_counter() - started
+
+    with capsys.disabled():
+        print(
+            f"\ncheck_user_trials x{len(calls)}: "
+            f"legacy {len(calls) / legacy_elapsed:,.0f} ops/s, "
+            f"pooled {len(calls) / pooled_elapsed:,.0f} ops/s"
+        )
+    assert len(database.entitlements) == 0
+    assert len(calls) / pooled_elapsed >= len(calls) / legacy_elapsed
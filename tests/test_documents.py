@@ -0,0 +1,139 @@
+import asyncio
+import os
+import subprocess
+import sys
+import time
+import pytest
+
+from src import documents
+
+
+@pytest.fixture
+def render_pool(monkeypatch):
+    monkeypatch.setattr(documents, "RENDER_PROCESSES", 1)
+    yield
+    documents.shutdown_render_pool()
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("ext, magic", [(".pdf", b"%PDF"), (".docx", b"PK"), (".txt", "Привет".encode())])
+async def test_render_document_writes_file(render_pool, tmp_path, ext, magic):
+    output = tmp_path / f"out{ext}"
+    await documents.render_document(ext, "Привет, мир\n\nВторой абзац", str(output))
+    assert output.read_bytes().startswith(magic)
+
+
+@pytest.mark.asyncio
+async def test_pdf_rendering_does_not_block_event_loop(render_pool, tmp_path):
+    text = "\n\n".join(f"Спикер {i % 3}: " + "длинная фраза транскрипта " * 40 for i in range(1500))
+    await documents.render_document(".pdf", "warm-up", str(tmp_path / "warm.pdf"))
+
+    ticks = []
+
+    async def heartbeat():
+        while True:
+            ticks.append(time.perf_counter())
+            await asyncio.sleep(0.01)
+
+    beat = asyncio.create_task(heartbeat())
+    started = time.perf_counter()
+    await documents.render_document(".pdf", text, str(tmp_path / "long.pdf"))
+    elapsed = time.perf_counter() - started
+    beat.cancel()
+
+    gaps = [b - a for a, b in zip(ticks, ticks[1:])]
+    assert elapsed > 0.2  # the render itself is substantial
+    assert max(gaps) < 0.2  # ...but the loop kept ticking all the way through
+
+
+def _transcript(utterances: int):
+    from src.transcript import Transcript
+    return Transcript.from_segments(
+        {"speaker": "AB"[i % 2], "text": f"Реплика {i}: " + "слова & <знаки> " * 20, "start": i * 1000, "end": i * 1000 + 900}
+        for i in range(utterances)
+    )
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("ext", [".txt", ".docx", ".pdf"])
+async def test_render_blocks_streams_transcript_in_worker(render_pool, tmp_path, ext):
+    from src import services
+    transcript = _transcript(50)
+    output = tmp_path / f"out{ext}"
+    await documents.render_blocks(ext, services.iter_blocks_with_speakers, transcript, str(output))
+
+    if ext == ".txt":
+        assert output.read_text(encoding="utf-8") == services.format_results_with_speakers(transcript)
+    elif ext == ".docx":
+        from docx import Document
+        lines = [p.text for p in Document(str(output)).paragraphs]
+        assert lines[:3] == ["Спикер A:", transcript[0]["text"], ""]
+        assert len(lines) == 50 * 3
+    else:
+        assert output.read_bytes().startswith(b"%PDF")
+
+
+def test_pdf_writer_keeps_bounded_flowable_buffer(tmp_path, monkeypatch):
+    seen = []
+    from reportlab.platypus import BaseDocTemplate
+    original = BaseDocTemplate.handle_flowable
+
+    def spy(self, flowables):
+        seen.append(list.__len__(flowables))
+        return original(self, flowables)
+
+    monkeypatch.setattr(BaseDocTemplate, "handle_flowable", spy)
+    blocks = (f"Абзац {i} " + "текст " * 30 for i in range(400))
+    documents.write_pdf_blocks(blocks, str(tmp_path / "big.pdf"), buffer_size=8)
+
+    assert len(seen) >= 800  # every paragraph and spacer went through the template
+    assert max(seen) <= 16 + 1  # one buffer of paragraphs+spacers, plus a split remainder
+
+
+def test_incremental_pdf_build_matches_reportlab_build(tmp_path):
+    # _build_incrementally mirrors BaseDocTemplate.build; guard against reportlab changing it
+    from reportlab.platypus import BaseDocTemplate, Paragraph, Spacer
+    context = documents.get_pdf_context()
+
+    def flowables():
+        for i in range(300):
+            yield Paragraph(f"Абзац {i} " + "текст " * 40, context.style)
+            yield Spacer(1, 12)
+
+    def make_doc(path):
+        return BaseDocTemplate(str(path), pagesize=context.page_size, pageTemplates=[documents._pdf_page_template()])
+
+    streamed, built = make_doc(tmp_path / "streamed.pdf"), make_doc(tmp_path / "built.pdf")
+    documents._build_incrementally(streamed, flowables(), buffer_size=8)
+    built.build(list(flowables()))
+
+    assert streamed.page > 10
+    assert streamed.page == built.page
+
+
+def test_docx_writer_matches_python_docx_layout(tmp_path):
+    from docx import Document
+    path = tmp_path / "doc.docx"
+    documents.save_text_to_docx("Первая строка\nвторая & <третья>\n\nАбзац\x01 два", str(path))
+    assert [p.text for p in Document(str(path)).paragraphs] == [
+        "Первая строка", "вторая & <третья>", "", "Абзац два", ""
+    ]
+
+
+def test_importing_services_does_not_load_reportlab():
+    code = "import sys, src.services; print('reportlab' in sys.modules)"
+    env = {**os.environ, "TELEGRAM_BOT_TOKEN": "x", "ASSEMBLYAI_API_KEY": "x"}
+    out = subprocess.run([sys.executable, "-c", code], capture_output=True, text=True, env=env, check=True)
+    assert out.stdout.strip() == "False"
+
+
+def test_pdf_context_is_built_once_and_shared(tmp_path):
+    documents.save_text_to_pdf("Первый", str(tmp_path / "a.pdf"))
+    context = documents.get_pdf_context()
+    documents.save_text_to_pdf("Второй", str(tmp_path / "b.pdf"))
+
+    assert documents.get_pdf_context() is context
+    assert documents.get_pdf_context.cache_info().misses == 1
+    assert (context.style.fontSize, context.style.leading) == (12, 15)
+    from reportlab.lib.styles import getSampleStyleSheet
+    assert getSampleStyleSheet()['Normal'].fontSize == 10  # the shared sample style is left alone
@@ -59,3 +59,179 @@ async def test_start_handler(mock_answer, mock_create_keyboard):
     # Assert the text and parse_mode
     assert call_args.args[0] == expected_text
     assert call_args.kwargs['parse_mode'] == 'Markdown'
+
+
+@pytest.mark.asyncio
+async def test_outputs_are_sent_as_soon_as_each_is_ready(mocker, tmp_path):
+    """Transcripts and subtitles go out while the slow LLM outline is still running."""
+    import asyncio
+    from unittest.mock import MagicMock
+    from src import handlers
+
+    llm_release = asyncio.Event()
+    sent = []
+    all_sent = asyncio.Event()
+
+    async def slow_summary(segments):
+        await asyncio.wait_for(llm_release.wait(), 5)
+        return "Тайм-коды\n00:00 - Начало"
+
+    async def fake_render(ext, text, path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+
+    async def fake_render_blocks(ext, make_blocks, source, path):
+        with open(path, "w", encoding="utf-8") as f:
+            f.write("\n\n".join(make_blocks(source)))
+
+    async def fake_send_document(chat_id, document, caption, thumbnail=None):
+        sent.append(caption)
+        if len(sent) == 4:
+            llm_release.set()  # only now let the outline finish
+        if len(sent) == 5:
+            all_sent.set()
+
+    mocker.patch.object(handlers.services, "generate_summary_timecodes", side_effect=slow_summary)
+    mocker.patch.object(handlers.services, "create_custom_thumbnail", return_value=None)
+    mocker.patch.object(handlers.documents, "render_document", side_effect=fake_render)
+    mocker.patch.object(handlers.documents, "render_blocks", side_effect=fake_render_blocks)
+    mocker.patch.object(handlers.db, "check_user_trials", AsyncMock(return_value=(True, True)))
+    bot = MagicMock()
+    bot.send_document = AsyncMock(side_effect=fake_send_document)
+    progress_message = MagicMock(edit_text=AsyncMock())
+    message = MagicMock(chat=MagicMock(id=42), answer=AsyncMock(return_value=progress_message))
+    selections = {
+        'speakers': True, 'plain': True, 'timecodes': True,
+        'segments': [
+            {"speaker": "A", "text": "Привет", "start": 0, "end": 800, "words": [[0, 800, "Привет"]]},
+            {"speaker": "B", "text": "Здравствуйте", "start": 1000, "end": 2000, "words": [[1000, 2000, "Здравствуйте"]]},
+        ],
+    }
+
+    await handlers.process_audio_file_for_user(bot, message, 555, selections, None)
+
+    assert all_sent.is_set()
+    assert sent[4] == "⏱️ Оглавление"
+    assert set(sent[:4]) == {"👥 Транскрипция со спикерами", "📝 Транскрипция без спикеров",
+                             "⏱️ Транскрипт с тайм-кодами", "⏱️ Субтитры"}
+
+
+@pytest.mark.asyncio
+async def test_long_video_is_rejected_before_download(mocker):
+    from unittest.mock import MagicMock
+    from src import handlers
+    from src.youtube import YoutubeMetadata
+
+    metadata = YoutubeMetadata({"id": "dQw4w9WgXcQ", "duration": 10 * 3600, "abr": 50.0, "formats": []})
+    mocker.patch.object(handlers.db, "check_user_trials", AsyncMock(return_value=(True, False)))
+    mocker.patch.object(handlers.youtube.metadata_probe, "probe", AsyncMock(return_value=metadata))
+    mocker.patch.object(handlers.services, "transcript_cache", None)
+    mocker.patch.object(handlers.ui, "create_menu_keyboard", return_value=None)
+    download = mocker.patch.object(handlers.services, "download_youtube_audio", AsyncMock())
+    message = MagicMock(text="https://youtu.be/dQw4w9WgXcQ", audio=None, document=None,
+                        from_user=MagicMock(id=777), answer=AsyncMock())
+
+    await handlers.universal_handler(message, MagicMock())
+
+    download.assert_not_awaited()
+    assert "10:00:00" in message.answer.await_args.args[0]
+    assert 777 not in handlers.ui.user_selections
+
+
+@pytest.mark.asyncio
+async def test_new_link_cancels_unconfirmed_download(mocker):
+    import asyncio
+    from unittest.mock import MagicMock
+    from src import handlers
+
+    pending = asyncio.get_running_loop().create_future()
+    previous_download = asyncio.ensure_future(pending)
+    handlers.ui.user_selections[888] = {'speakers': False, 'plain': False, 'timecodes': False,
+                                        'file_path': None, 'download': previous_download}
+    handlers.abandon_pending_selection(888)
+    await asyncio.sleep(0)
+
+    assert previous_download.cancelled()
+    assert 888 not in handlers.ui.user_selections
+
+    confirmed_download = asyncio.ensure_future(asyncio.get_running_loop().create_future())
+    handlers.ui.user_selections[888] = {'confirmed': True, 'download': confirmed_download}
+    handlers.abandon_pending_selection(888)
+    assert not confirmed_download.cancelled()  # a confirmed job owns its download
+    confirmed_download.cancel()
+    del handlers.ui.user_selections[888]
+
+
+@pytest.mark.asyncio
+@pytest.mark.parametrize("kind", ["audio", "document"])
+async def test_telegram_upload_is_transcribed(mocker, kind):
+    from unittest.mock import MagicMock
+    from src import handlers
+
+    user_id = 901 if kind == "audio" else 902
+    upload = MagicMock(file_size=1024, file_id="file", file_unique_id="unique", mime_type="audio/ogg",
+                       file_name="voice.ogg")
+    message = MagicMock(text=None, audio=upload if kind == "audio" else None,
+                        document=upload if kind == "document" else None,
+                        from_user=MagicMock(id=user_id), answer=AsyncMock())
+    mocker.patch.object(handlers.db, "check_user_trials", AsyncMock(return_value=(True, True)))
+    ingest = mocker.patch.object(handlers, "ingest_telegram_file", AsyncMock(return_value=("/tmp/voice.ogg", "v3:sha256:abc")))
+    submit = mocker.patch.object(handlers.scheduler, "submit")
+
+    await handlers.universal_handler(message, MagicMock())
+    await handlers.ui.user_selections[user_id]['download']  # ingest runs outside the handler
+
+    ingest.assert_awaited_once()
+    assert ingest.await_args.args[1] is upload
+    assert handlers.ui.user_selections[user_id]['file_path'] == "/tmp/voice.ogg"
+    assert handlers.ui.user_selections[user_id]['cache_key'] == "v3:sha256:abc"
+
+    callback = MagicMock(from_user=MagicMock(id=user_id), data="select_speakers")
+    callback.message.edit_text = AsyncMock()
+    callback.message.delete = AsyncMock()
+    callback.answer = AsyncMock()
+    await handlers.callback_handler(callback, MagicMock())
+    callback.data = "confirm_selection"
+    await handlers.callback_handler(callback, MagicMock())
+
+    submit.assert_called_once()
+    assert submit.call_args.args[0] == user_id
+    assert user_id not in handlers.ui.user_selections
+
+
+@pytest.mark.asyncio
+async def test_confirm_during_download_returns_and_submits_once(mocker):
+    import asyncio
+    from unittest.mock import MagicMock
+    from src import handlers
+
+    user_id = 903
+    release = asyncio.Event()
+
+    async def download():
+        await release.wait()
+        handlers.ui.user_selections[user_id]['file_path'] = "/tmp/video.m4a"
+        return "/tmp/video.m4a"
+
+    handlers.ui.user_selections[user_id] = {'speakers': True, 'plain': False, 'timecodes': False,
+                                            'file_path': None, 'segments': None, 'download': None}
+    handlers.ui.user_selections[user_id]['download'] = asyncio.create_task(download())
+    mocker.patch.object(handlers.db, "check_user_trials", AsyncMock(return_value=(True, False)))
+    submit = mocker.patch.object(handlers.scheduler, "submit")
+
+    def press():
+        callback = MagicMock(from_user=MagicMock(id=user_id), data="confirm_selection")
+        callback.message.edit_text = AsyncMock()
+        callback.message.delete = AsyncMock()
+        callback.answer = AsyncMock()
+        return handlers.callback_handler(callback, MagicMock())
+
+    # The handler does not wait for the download (it would hold a webhook worker)
+    await asyncio.wait_for(press(), 1)
+    await asyncio.wait_for(press(), 1)  # answered right away, no second job
+    submit.assert_not_called()
+    release.set()
+    await asyncio.gather(*handlers._waiting_for_download)
+
+    submit.assert_called_once()
+    assert user_id not in handlers.ui.user_selections
@@ -0,0 +1,66 @@
+import asyncio
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from src.http_clients import HttpClients
+
+
+@pytest.mark.asyncio
+async def test_get_returns_one_client_per_service():
+    """Each upstream gets a single long-lived client instead of one per call."""
+    clients = HttpClients(max_connections=10, max_keepalive_connections=5, http2=False)
+    try:
+        assert clients.get("assemblyai") is clients.get("assemblyai")
+        assert clients.get("assemblyai") is not clients.get("yoomoney")
+    finally:
+        await clients.aclose()
+    assert clients.stats() == {}
+
+
+@pytest.mark.asyncio
+async def test_pool_metrics_and_keepalive_reuse():
+    """Requests are counted while in flight and reuse the same keep-alive connection."""
+    release = asyncio.Event()
+
+    async def slow(request):
+        await release.wait()
+        return web.Response(text="ok")
+
+    async def fast(request):
+        return web.Response(text="ok")
+
+    app = web.Application()
+    app.router.add_get("/slow", slow)
+    app.router.add_get("/fast", fast)
+    server = TestServer(app)
+    await server.start_server()
+    clients = HttpClients(max_connections=4, max_keepalive_connections=4, http2=False)
+    client = clients.get("test")
+    try:
+        pending = [asyncio.create_task(client.get(str(server.make_url("/slow")))) for _ in range(3)]
+        await asyncio.sleep(0.1)
+        stats = clients.stats()["test"]
+        assert stats["in_flight"] == 3
+        assert stats["utilisation"] == 0.75
+
+        release.set()
+        await asyncio.gather(*pending)
+        for _ in range(5):
+            (await client.get(str(server.make_url("/fast")))).raise_for_status()
+
+        stats = clients.stats()["test"]
+        assert stats["in_flight"] == 0
+        assert stats["peak_in_flight"] == 3
+        assert stats["requests"] == 8
+        assert stats["connections"] == 3  # sequential requests reused idle connections
+        assert stats["idle_connections"] == 3
+    finally:
+        await clients.aclose()
+        await server.close()
+
+
+def test_http2_falls_back_without_h2(monkeypatch):
+    from src import http_clients
+    monkeypatch.setattr(http_clients, "HTTP2_AVAILABLE", False)
+    assert HttpClients(http2=True).http2 is False
@@ -0,0 +1,162 @@
+import asyncio
+import pytest
+
+from src.jobs import JobScheduler, JobQueueFull, UserJobLimit
+
+
+async def _settle():
+    for _ in range(5):
+        await asyncio.sleep(0)
+
+
+@pytest.mark.asyncio
+async def test_worker_count_bounds_concurrency():
+    scheduler = JobScheduler(workers=2, max_queue=10, per_user_limit=10)
+    running = 0
+    peak = 0
+    release = asyncio.Event()
+
+    async def job():
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await release.wait()
+        running -= 1
+
+    try:
+        jobs = [scheduler.submit(user_id=i, run=job) for i in range(5)]
+        await _settle()
+        assert (scheduler.running, scheduler.queued) == (2, 3)
+        release.set()
+        await asyncio.gather(*(j.done for j in jobs))
+        assert peak == 2
+    finally:
+        await scheduler.stop()
+
+
+@pytest.mark.asyncio
+async def test_admission_limits():
+    scheduler = JobScheduler(workers=1, max_queue=2, per_user_limit=2)
+    release = asyncio.Event()
+
+    async def job():
+        await release.wait()
+
+    try:
+        scheduler.submit(1, job)
+        scheduler.submit(1, job)
+        with pytest.raises(UserJobLimit):
+            scheduler.submit(1, job)
+        await _settle()  # first job is running, one queued
+        scheduler.submit(2, job)
+        with pytest.raises(JobQueueFull):
+            scheduler.submit(3, job)
+        release.set()
+        while scheduler.running or scheduler.queued:
+            await asyncio.sleep(0.01)
+        assert scheduler.active_for(1) == 0
+        scheduler.submit(1, job)  # limits are released once jobs finish
+    finally:
+        await scheduler.stop()
+
+
+@pytest.mark.asyncio
+async def test_paid_users_first_and_position_feedback():
+    scheduler = JobScheduler(workers=1, max_queue=10, per_user_limit=5)
+    order = []
+    positions = {}
+    gate = asyncio.Event()
+
+    def job(name):
+        async def run():
+            if name == "blocker":
+                await gate.wait()
+            order.append(name)
+        return run
+
+    def tracker(name):
+        async def on_position(position):
+            positions.setdefault(name, []).append(position)
+        return on_position
+
+    try:
+        scheduler.submit(0, job("blocker"), on_position=tracker("blocker"))
+        await _settle()
+        free_a = scheduler.submit(1, job("free-a"), on_position=tracker("free-a"))
+        free_b = scheduler.submit(2, job("free-b"), on_position=tracker("free-b"))
+        paid = scheduler.submit(3, job("paid"), paid=True, on_position=tracker("paid"))
+        await _settle()
+        assert (paid.position, free_a.position, free_b.position) == (1, 2, 3)
+        gate.set()
+        await asyncio.gather(paid.done, free_a.done, free_b.done)
+        await _settle()
+    finally:
+        await scheduler.stop()
+
+    assert order == ["blocker", "paid", "free-a", "free-b"]
+    assert "blocker" not in positions  # started straight away, nothing to report
+    assert positions["paid"] == [1, 0]
+    assert positions["free-a"] == [1, 2, 1, 0]
+    assert positions["free-b"] == [2, 3, 2, 1, 0]
+
+
+@pytest.mark.asyncio
+async def test_failed_job_frees_slot_and_surfaces_error():
+    scheduler = JobScheduler(workers=1, max_queue=5, per_user_limit=1)
+
+    async def boom():
+        raise RuntimeError("ffmpeg exploded")
+
+    try:
+        job = scheduler.submit(7, boom)
+        with pytest.raises(RuntimeError):
+            await job.done
+        await _settle()
+        assert scheduler.active_for(7) == 0
+    finally:
+        await scheduler.stop()
+
+
+@pytest.mark.asyncio
+async def test_stop_drains_queue_within_timeout():
+    scheduler = JobScheduler(workers=1, max_queue=10, per_user_limit=10)
+    finished = []
+
+    def job(name):
+        async def run():
+            await asyncio.sleep(0.05)
+            finished.append(name)
+        return run
+
+    for name in ("a", "b", "c"):
+        scheduler.submit(1, job(name))
+    await scheduler.stop(timeout=5)
+    assert finished == ["a", "b", "c"]
+
+
+@pytest.mark.asyncio
+async def test_stop_runs_cleanup_for_jobs_that_never_ran(tmp_path):
+    scheduler = JobScheduler(workers=1, max_queue=10, per_user_limit=10)
+    files = [tmp_path / f"{name}.ogg" for name in ("running", "queued1", "queued2")]
+    cancelled = []
+
+    async def stuck():
+        await asyncio.Event().wait()
+
+    def cleanup(path):
+        async def on_cancel():
+            path.unlink()
+            cancelled.append(path.stem)
+        return on_cancel
+
+    for path in files:
+        path.write_bytes(b"audio")
+        scheduler.submit(1, stuck, on_cancel=cleanup(path))
+    await _settle()
+    assert (scheduler.running, scheduler.queued) == (1, 2)
+
+    await scheduler.stop(timeout=0.2)
+
+    assert sorted(cancelled) == ["queued1", "queued2", "running"]
+    assert not any(path.exists() for path in files)
+    assert scheduler.queued == 0
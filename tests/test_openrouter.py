@@ -0,0 +1,149 @@
+import asyncio
+import random
+import time
+import pytest
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from src.openrouter import OpenRouterClient, OpenRouterError, KeyBreaker
+
+
+class FakeOpenRouter:
+    """Each key gets a scripted behaviour: ok, slow, 429, 401, 500, hang or bad-request."""
+
+    def __init__(self, behaviours: dict[str, str]):
+        self.behaviours = behaviours
+        self.calls: list[str] = []
+
+    async def handle(self, request: web.Request) -> web.Response:
+        key = request.headers["Authorization"].removeprefix("Bearer ")
+        self.calls.append(key)
+        behaviour = self.behaviours[key]
+        if behaviour == "hang":
+            await asyncio.sleep(30)
+        if behaviour == "slow":
+            await asyncio.sleep(0.3)
+        if behaviour == "429":
+            return web.Response(status=429, headers={"Retry-After": "120"})
+        if behaviour in ("401", "500", "400"):
+            return web.Response(status=int(behaviour), text="nope")
+        return web.json_response({"choices": [{"message": {"content": f" answer from {key} "}}]})
+
+
+@pytest_asyncio.fixture
+async def fake_openrouter():
+    servers = []
+
+    async def make(behaviours):
+        fake = FakeOpenRouter(behaviours)
+        app = web.Application()
+        app.router.add_post("/api/v1/chat/completions", fake.handle)
+        server = TestServer(app)
+        await server.start_server()
+        servers.append(server)
+        return fake, str(server.make_url("/api/v1"))
+
+    yield make
+    for server in servers:
+        await server.close()
+
+
+def _client(base_url, keys, **kwargs):
+    return OpenRouterClient(keys=keys, base_url=base_url, rng=random.Random(1), **kwargs)
+
+
+@pytest.mark.asyncio
+async def test_failover_is_immediate_and_breaker_opens(fake_openrouter):
+    fake, url = await fake_openrouter({"dead-key-000": "500", "good-key-000": "ok"})
+    client = _client(url, ["dead-key-000", "good-key-000"], timeout=5)
+    try:
+        for _ in range(50):
+            if client.breakers[0].state == "open":
+                break
+            started = time.monotonic()
+            assert await client.chat([{"role": "user", "content": "hi"}], model="m") == "answer from good-key-000"
+            assert time.monotonic() - started < 1.0
+        dead = client.breakers[0]
+        assert dead.state == "open"
+        assert fake.calls.count("dead-key-000") == 3
+        assert dead.weight() < client.breakers[1].weight()
+        calls_to_dead = fake.calls.count("dead-key-000")
+        await client.chat([{"role": "user", "content": "hi"}], model="m")
+        assert fake.calls.count("dead-key-000") == calls_to_dead  # open breaker is skipped
+    finally:
+        await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_rate_limit_and_revoked_keys_are_parked(fake_openrouter):
+    fake, url = await fake_openrouter({"limited-000": "429", "revoked-000": "401", "good-key-000": "ok"})
+    client = _client(url, ["limited-000", "revoked-000", "good-key-000"])
+    try:
+        for _ in range(3):
+            await client.chat([{"role": "user", "content": "hi"}], model="m")
+        assert fake.calls.count("limited-000") <= 1
+        assert fake.calls.count("revoked-000") <= 1
+        limited, revoked, _ = client.breakers
+        assert limited.rate_limited_until - time.monotonic() > 100
+        assert revoked.state == "open"
+    finally:
+        await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_bad_request_is_not_retried_on_other_keys(fake_openrouter):
+    fake, url = await fake_openrouter({"k1-0000000": "400", "k2-0000000": "400"})
+    client = _client(url, ["k1-0000000", "k2-0000000"])
+    try:
+        with pytest.raises(OpenRouterError):
+            await client.chat([{"role": "user", "content": "hi"}], model="m")
+        assert len(fake.calls) == 1
+        assert all(b.state == "closed" for b in client.breakers)
+    finally:
+        await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_hedged_request_beats_hanging_key(fake_openrouter):
+    fake, url = await fake_openrouter({"hang-key-000": "hang", "fast-key-000": "ok"})
+    client = _client(url, ["hang-key-000", "fast-key-000"], timeout=30, hedge_delay=0.1)
+    client.breakers[1].latency = 100.0  # make the hanging key the preferred first pick
+    try:
+        started = time.monotonic()
+        assert await client.chat([{"role": "user", "content": "hi"}], model="m") == "answer from fast-key-000"
+        assert time.monotonic() - started < 2
+        assert client.breakers[0].probing is False
+    finally:
+        await client.aclose()
+
+
+@pytest.mark.asyncio
+async def test_all_keys_failing_raises(fake_openrouter):
+    _, url = await fake_openrouter({"a-key-00000": "500", "b-key-00000": "500"})
+    client = _client(url, ["a-key-00000", "b-key-00000"])
+    try:
+        with pytest.raises(OpenRouterError, match="Все ключи"):
+            await client.chat([{"role": "user", "content": "hi"}], model="m")
+    finally:
+        await client.aclose()
+
+
+def test_breaker_half_open_probe_and_backoff():
+    breaker = KeyBreaker("key-0000000", failure_threshold=2, cooldown=10)
+    breaker.record_failure()
+    assert breaker.available()
+    breaker.record_failure()
+    assert breaker.state == "open" and not breaker.available()
+
+    breaker.open_until = time.monotonic() - 1  # cooldown elapsed
+    assert breaker.state == "half_open" and breaker.available()
+    breaker.acquire()
+    assert not breaker.available()  # only one probe at a time
+    breaker.record_failure()
+    assert breaker.cooldown == 20 and breaker.state == "open"
+
+    breaker.open_until = time.monotonic() - 1
+    breaker.acquire()
+    breaker.record_success(0.5)
+    assert breaker.state == "closed" and breaker.cooldown == 10
@@ -30,12 +30,10 @@ def test_format_results_plain():
 @pytest.mark.asyncio
 async def test_create_yoomoney_payment(mocker):
     """Tests the YooMoney payment link creation."""
-    # Mock the httpx.AsyncClient
-    mock_async_client = mocker.patch('httpx.AsyncClient', autospec=True)
-    
-    # We need to mock the async context manager (__aenter__ and __aexit__)
-    mock_instance = mock_async_client.return_value
-    mock_instance.__aenter__.return_value.post = AsyncMock()
+    # Mock the shared client from the HTTP client registry
+    mock_client = mocker.Mock()
+    mock_client.post = AsyncMock()
+    mock_http = mocker.patch.object(services, '_http', return_value=mock_client)
 
     user_id = 12345
     amount = 100
@@ -52,7 +50,8 @@ async def test_create_yoomoney_payment(mocker):
     assert "targets=Test+Subscription" in payment_url
 
     # Check that the post method was called (for validation)
-    mock_instance.__aenter__.return_value.post.assert_called_once()
+    mock_http.assert_called_once_with("yoomoney")
+    mock_client.post.assert_called_once()
 
 def test_create_custom_thumbnail():
     """Tests creating a custom thumbnail."""
@@ -79,3 +78,714 @@ def test_create_custom_thumbnail_default():
     assert isinstance(result, BytesIO)
     data = result.read()
     assert len(data) > 0
+
+
+# =============================
+#   Фрагментная транскрибация
+# =============================
+import asyncio
+import os
+import shutil
+import subprocess
+
+import httpx
+import pytest_asyncio
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from src.http_clients import HttpClients
+from src.transcript_webhook import TranscriptWebhook
+
+
+class FakeAssemblyAI:
+    """Minimal local stand-in for the AssemblyAI /upload and /transcript endpoints."""
+
+    def __init__(self):
+        self.uploads = {}
+        self.transcripts = {}
+        self.in_flight = 0
+        self.max_in_flight = 0
+        self.upload_delay = 0.05
+        self.upload_headers = []
+        self.processing_polls = 0   # "processing" answers before "completed"
+        self.poll_failures = []     # HTTP statuses (or "disconnect") returned before any JSON answer
+        self.polls = 0
+        self.webhook_delay = 0.05
+        self.notify_before_response = False  # уведомление приходит раньше ответа на создание
+        self._background = set()
+
+    async def upload(self, request):
+        self.in_flight += 1
+        self.max_in_flight = max(self.max_in_flight, self.in_flight)
+        self.upload_headers.append(dict(request.headers))
+        try:
+            body = await request.read()
+            await asyncio.sleep(self.upload_delay)
+        finally:
+            self.in_flight -= 1
+        url = f"fake://upload/{len(self.uploads)}"
+        self.uploads[url] = body
+        return web.json_response({"upload_url": url})
+
+    async def create_transcript(self, request):
+        payload = await request.json()
+        transcript_id = f"t{len(self.transcripts)}"
+        self.transcripts[transcript_id] = payload["audio_url"]
+        if payload.get("webhook_url") and self.notify_before_response:
+            await self.notify(payload, transcript_id)
+        elif payload.get("webhook_url"):
+            task = asyncio.create_task(self.notify(payload, transcript_id))
+            self._background.add(task)
+            task.add_done_callback(self._background.discard)
+        return web.json_response({"id": transcript_id, "status": "queued"})
+
+    async def notify(self, payload, transcript_id):
+        await asyncio.sleep(self.webhook_delay)
+        self.processing_polls = 0
+        async with httpx.AsyncClient() as client:
+            await client.post(
+                payload["webhook_url"],
+                headers={payload["webhook_auth_header_name"]: payload["webhook_auth_header_value"]},
+                json={"transcript_id": transcript_id, "status": "completed"},
+            )
+
+    async def get_transcript(self, request):
+        self.polls += 1
+        if self.poll_failures:
+            failure = self.poll_failures.pop(0)
+            if failure == "disconnect":
+                request.transport.close()
+                return web.Response(status=500)
+            return web.Response(status=failure, headers={"Retry-After": "0"})
+        if self.processing_polls > 0:
+            self.processing_polls -= 1
+            return web.json_response({"status": "processing"})
+        audio_url = self.transcripts[request.match_info["transcript_id"]]
+        return web.json_response(self.result_for(self.uploads[audio_url]))
+
+    @staticmethod
+    def result_for(body: bytes) -> dict:
+        # Each fake chunk file contains lines "<speaker>|<start_ms>|<end_ms>|<text>"
+        utterances = []
+        for line in body.decode(errors="ignore").splitlines():
+            parts = line.split("|")
+            if len(parts) != 4:
+                continue
+            speaker, start, end, text = parts
+            utterances.append({
+                "speaker": speaker, "start": int(start), "end": int(end), "text": text,
+                "words": [{"text": text, "start": int(start), "end": int(end), "speaker": speaker}],
+            })
+        return {"status": "completed", "utterances": utterances,
+                "text": " ".join(u["text"] for u in utterances)}
+
+    def app(self):
+        app = web.Application(client_max_size=64 * 1024 * 1024)
+        app.router.add_post("/v2/upload", self.upload)
+        app.router.add_post("/v2/transcript", self.create_transcript)
+        app.router.add_get("/v2/transcript/{transcript_id}", self.get_transcript)
+        return app
+
+
+@pytest_asyncio.fixture
+async def fake_assemblyai(monkeypatch):
+    fake = FakeAssemblyAI()
+    server = TestServer(fake.app())
+    await server.start_server()
+    monkeypatch.setattr(services, "ASSEMBLYAI_BASE_URL", str(server.make_url("/v2")))
+    monkeypatch.setattr(services, "POLL_INITIAL_DELAY", 0.01)
+    monkeypatch.setattr(services, "POLL_MAX_DELAY", 0.05)
+    monkeypatch.setattr(services, "TRANSCRIBE_SPEED_RATIO", 0.0001)
+    clients = HttpClients()
+    monkeypatch.setattr(services, "http_clients", clients)
+    yield fake
+    await clients.aclose()
+    await server.close()
+
+
+def test_parse_silencedetect():
+    stderr = (
+        "  Duration: 01:00:05.50, start: 0.000000, bitrate: 128 kb/s\n"
+        "[silencedetect @ 0x1] silence_start: 598.2\n"
+        "[silencedetect @ 0x1] silence_end: 599.8 | silence_duration: 1.6\n"
+        "[silencedetect @ 0x1] silence_start: 3600.1\n"
+    )
+    duration, silences = services._parse_silencedetect(stderr)
+    assert duration == 3605.5
+    assert silences == [(598.2, 599.8), (3600.1, 3605.5)]
+
+
+def test_choose_split_points_prefers_nearby_silence():
+    silences = [(590.0, 592.0), (1260.0, 1262.0)]
+    points = services.choose_split_points(1900, silences, chunk_duration=600, search_window=60)
+    # First cut snaps to the pause at 591, second has no pause near 1191 and is exact
+    assert points == [591.0, 1191.0]
+    assert services.choose_split_points(700, silences, chunk_duration=600) == []
+
+
+def test_merge_chunk_transcripts_offsets_and_speakers():
+    first = {"text": "a b", "utterances": [
+        {"speaker": "A", "start": 0, "end": 1000, "text": "a", "words": [{"text": "a", "start": 0, "end": 1000}]},
+        {"speaker": "B", "start": 1000, "end": 9000, "text": "b", "words": []},
+    ]}
+    second = {"text": "c", "utterances": [
+        {"speaker": "A", "start": 500, "end": 9500, "text": "c", "words": [{"text": "c", "start": 500, "end": 900}]},
+    ]}
+    merged = services.merge_chunk_transcripts([(600.0, second, 0.0), (0.0, first, 0.0)])
+    assert [u["text"] for u in merged["utterances"]] == ["a", "b", "c"]
+    # Without overlap there is nothing to match on: each chunk gets its own labels
+    assert [u["speaker"] for u in merged["utterances"]] == ["B", "A", "C"]
+    assert merged["utterances"][2]["start"] == 600_500
+    assert merged["utterances"][2]["words"][0] == {"text": "c", "start": 600_500, "end": 600_900, "speaker": "C"}
+    assert merged["text"] == "a b c"
+
+
+def test_merge_chunk_transcripts_matches_speakers_across_overlap():
+    # X dominates chunk 1, Y dominates chunk 2, and AssemblyAI swapped the labels
+    first = {"text": "", "utterances": [
+        {"speaker": "A", "start": 0, "end": 52_000, "text": "x1"},
+        {"speaker": "B", "start": 52_000, "end": 58_000, "text": "y1"},
+        {"speaker": "A", "start": 58_000, "end": 60_000, "text": "x2"},
+    ]}
+    # Chunk 2 starts 10 s before its cut at 60 s and repeats the end of chunk 1
+    second = {"text": "", "utterances": [
+        {"speaker": "B", "start": 0, "end": 2_000, "text": "x1 tail"},
+        {"speaker": "A", "start": 2_000, "end": 8_000, "text": "y1 again"},
+        {"speaker": "B", "start": 8_000, "end": 10_000, "text": "x2 again"},
+        {"speaker": "B", "start": 10_000, "end": 15_000, "text": "x3"},
+        {"speaker": "A", "start": 15_000, "end": 100_000, "text": "y2"},
+        {"speaker": "C", "start": 100_000, "end": 101_000, "text": "z1"},
+    ]}
+    merged = services.merge_chunk_transcripts([(0.0, first, 0.0), (50.0, second, 10.0)])
+
+    assert [(u["text"], u["speaker"]) for u in merged["utterances"]] == [
+        ("x1", "A"), ("y1", "B"), ("x2", "A"), ("x3", "A"), ("y2", "B"), ("z1", "C"),
+    ]
+    assert merged["utterances"][3]["start"] == 60_000
+    assert merged["text"] == "x1 y1 x2 x3 y2 z1"
+
+
+def test_merge_chunk_transcripts_trims_utterance_crossing_the_cut():
+    def words(*items):
+        return [{"text": text, "start": start, "end": start + 500} for text, start in items]
+
+    first = {"text": "", "utterances": [
+        {"speaker": "A", "start": 0, "end": 60_000, "text": "one two", "words": words(("one", 0), ("two", 59_000))},
+    ]}
+    # One speaker talks straight through the cut at 60 s, from 50 s to 350 s
+    second = {"text": "", "utterances": [
+        {"speaker": "A", "start": 0, "end": 300_000, "text": "two three four",
+         "words": words(("two", 9_000), ("three", 10_000), ("four", 299_000))},
+    ]}
+    merged = services.merge_chunk_transcripts([(0.0, first, 0.0), (50.0, second, 10.0)])
+
+    assert [(u["text"], u["speaker"]) for u in merged["utterances"]] == [("one two", "A"), ("three four", "A")]
+    assert merged["utterances"][1]["start"] == 60_000
+    assert merged["utterances"][1]["end"] == 350_000
+    assert [w["start"] for w in merged["utterances"][1]["words"]] == [60_000, 349_000]
+    assert merged["text"] == "one two three four"
+
+
+@pytest.mark.asyncio
+async def test_transcribe_chunks_against_fake_assemblyai(fake_assemblyai, tmp_path):
+    chunks = []
+    for i in range(6):
+        path = tmp_path / f"chunk_{i}.mp3"
+        path.write_text(f"X|0|2000|chunk {i} main\nY|2000|2500|chunk {i} aside\n")
+        chunks.append((str(path), i * 600.0, 0.0))
+    progress = []
+
+    async def on_progress(value, *args):
+        progress.append(value)
+
+    result = await services.transcribe_chunks(chunks, on_progress, concurrency=2)
+
+    assert fake_assemblyai.max_in_flight <= 2
+    assert len(fake_assemblyai.uploads) == 6
+    texts = [u["text"] for u in result["utterances"]]
+    assert texts[:2] == ["chunk 0 main", "chunk 0 aside"]
+    assert texts[-1] == "chunk 5 aside"
+    assert [u["speaker"] for u in result["utterances"][:2]] == ["A", "B"]
+    assert result["utterances"][-1]["start"] == 5 * 600_000 + 2000
+    assert progress[-1] == pytest.approx(0.90)
+
+
+@pytest.mark.asyncio
+async def test_failed_chunk_cancels_the_others_before_cleanup(monkeypatch):
+    events = []
+
+    async def upload(path):
+        if path.endswith("bad.mp3"):
+            await asyncio.sleep(0.01)
+            raise RuntimeError("upload failed")
+        try:
+            await asyncio.sleep(60)
+        except asyncio.CancelledError:
+            events.append(f"cancelled {path}")
+            raise
+
+    monkeypatch.setattr(services, "upload_to_assemblyai", upload)
+    monkeypatch.setattr(services.AudioProcessor, "cleanup", lambda paths: events.append("cleanup"))
+    chunks = [("/tmp/fragment_1/a.mp3", 0.0, 0.0), ("/tmp/fragment_1/bad.mp3", 600.0, 0.0),
+              ("/tmp/fragment_1/c.mp3", 1200.0, 0.0)]
+
+    with pytest.raises(RuntimeError, match="upload failed"):
+        await asyncio.wait_for(services.transcribe_chunks(chunks, concurrency=3), 5)
+    assert sorted(events[:2]) == ["cancelled /tmp/fragment_1/a.mp3", "cancelled /tmp/fragment_1/c.mp3"]
+    assert events[2:] == ["cleanup"]
+
+
+@pytest.mark.asyncio
+async def test_split_on_silence_with_ffmpeg(tmp_path, monkeypatch):
+    imageio_ffmpeg = pytest.importorskip("imageio_ffmpeg")
+    ffmpeg = shutil.which("ffmpeg") or imageio_ffmpeg.get_ffmpeg_exe()
+    monkeypatch.setattr(services, "FFMPEG_PATH", ffmpeg)
+    source = tmp_path / "speech.mp3"
+    # 8 s tone, 1 s silence, 8 s tone
+    subprocess.run([
+        ffmpeg, "-f", "lavfi", "-i", "sine=frequency=440:duration=8",
+        "-f", "lavfi", "-i", "anullsrc=r=44100:cl=mono:d=1",
+        "-f", "lavfi", "-i", "sine=frequency=440:duration=8",
+        "-filter_complex", "[0][1][2]concat=n=3:v=0:a=1", "-y", str(source)
+    ], check=True, capture_output=True)
+
+    chunks = services.AudioProcessor.split_on_silence(str(source), chunk_duration=8)
+    try:
+        assert len(chunks) == 2
+        assert chunks[0][1:] == (0.0, 0.0)
+        # The second fragment starts overlap (chunk_duration / 4) before its cut in the pause
+        start, overlap = chunks[1][1:]
+        assert overlap == pytest.approx(2.0, abs=0.1)
+        assert 8.0 <= start + overlap <= 9.1
+        assert all(os.path.getsize(path) > 0 for path, *_ in chunks)
+        assert services._parse_duration(subprocess.run([ffmpeg, "-i", chunks[1][0]], capture_output=True,
+                                                       text=True).stderr) == pytest.approx(17 - start, abs=0.2)
+    finally:
+        services.AudioProcessor.cleanup([os.path.dirname(chunks[0][0])])
+
+
+@pytest.mark.asyncio
+async def test_upload_streams_raw_body_with_byte_progress(fake_assemblyai, tmp_path, monkeypatch):
+    monkeypatch.setattr(services, "UPLOAD_CHUNK_SIZE", 64 * 1024)
+    payload = os.urandom(1024 * 1024 + 123)
+    path = tmp_path / "audio.mp3"
+    path.write_bytes(payload)
+    progress = []
+
+    async def on_progress(fraction):
+        progress.append(fraction)
+
+    upload_url = await services.upload_to_assemblyai(str(path), progress_callback=on_progress)
+
+    # Raw binary body, not multipart/form-data
+    assert fake_assemblyai.uploads[upload_url] == payload
+    headers = fake_assemblyai.upload_headers[0]
+    assert headers["Content-Type"] == "application/octet-stream"
+    assert headers["Content-Length"] == str(len(payload))
+    assert progress == sorted(progress)
+    assert progress[-1] == 1.0
+    assert len(progress) > 1
+
+
+# =============================
+#     Опрос статуса транскрипта
+# =============================
+def test_polling_delays_scale_with_duration_and_back_off(monkeypatch):
+    monkeypatch.setattr(services, "POLL_INITIAL_DELAY", 2.0)
+    monkeypatch.setattr(services, "POLL_MAX_DELAY", 10.0)
+    monkeypatch.setattr(services, "POLL_BACKOFF_FACTOR", 2.0)
+    monkeypatch.setattr(services, "TRANSCRIBE_SPEED_RATIO", 0.05)
+    no_jitter = lambda: 0.5
+
+    delays = services.polling_delays(3600, rng=no_jitter)
+    assert [next(delays) for _ in range(6)] == [144.0, 2.0, 4.0, 8.0, 10.0, 10.0]
+
+    short = services.polling_delays(None, rng=no_jitter)
+    assert next(short) == 2.0
+
+    jittered = services.polling_delays(None, rng=lambda: 1.0)
+    assert next(jittered) == pytest.approx(2.0 * (1 + services.POLL_JITTER))
+
+
+@pytest.mark.asyncio
+async def test_transcribe_polls_until_completed_and_survives_5xx(fake_assemblyai, tmp_path):
+    path = tmp_path / "a.mp3"
+    path.write_text("A|0|1000|hello\n")
+    audio_url = await services.upload_to_assemblyai(str(path))
+    fake_assemblyai.poll_failures = [503, 429]
+    fake_assemblyai.processing_polls = 2
+
+    result = await services.transcribe_with_assemblyai(audio_url, audio_duration=1)
+
+    assert result["utterances"][0]["text"] == "hello"
+    assert fake_assemblyai.polls == 5
+    assert len(fake_assemblyai.transcripts) == 1  # transient errors did not resubmit the job
+
+
+@pytest.mark.asyncio
+async def test_transcribe_poll_errors_keep_the_same_transcript(fake_assemblyai, tmp_path):
+    path = tmp_path / "a.mp3"
+    path.write_text("A|0|1000|hello\n")
+    audio_url = await services.upload_to_assemblyai(str(path))
+    fake_assemblyai.poll_failures = ["disconnect", 408]
+
+    result = await services.transcribe_with_assemblyai(audio_url, audio_duration=1)
+    assert result["utterances"][0]["text"] == "hello"
+    assert len(fake_assemblyai.transcripts) == 1
+
+    fake_assemblyai.poll_failures = [404]
+    with pytest.raises(httpx.HTTPStatusError):
+        await services.transcribe_with_assemblyai(audio_url, audio_duration=1)
+    assert len(fake_assemblyai.transcripts) == 2  # no resubmission after a permanent poll error
+
+
+@pytest.mark.asyncio
+async def test_transcribe_hard_timeout(fake_assemblyai, tmp_path, monkeypatch):
+    path = tmp_path / "a.mp3"
+    path.write_text("A|0|1000|hello\n")
+    audio_url = await services.upload_to_assemblyai(str(path))
+    fake_assemblyai.processing_polls = 10_000
+    monkeypatch.setattr(services, "TRANSCRIBE_TIMEOUT", 0.3)
+
+    with pytest.raises(TimeoutError):
+        await services.transcribe_with_assemblyai(audio_url)
+    assert len(fake_assemblyai.transcripts) == 1  # timeouts are not retried
+
+
+@pytest.mark.asyncio
+async def test_transcribe_waits_for_webhook_instead_of_polling(fake_assemblyai, tmp_path, monkeypatch):
+    webhook = TranscriptWebhook(public_url="", secret="s3cret")
+    server = TestServer(webhook.app())
+    await server.start_server()
+    webhook.public_url = str(server.make_url("")).rstrip("/")
+    monkeypatch.setattr(services, "transcript_webhook", webhook)
+    monkeypatch.setattr(services, "POLL_WEBHOOK_FALLBACK_DELAY", 30)
+    path = tmp_path / "a.mp3"
+    path.write_text("A|0|1000|hello\n")
+    audio_url = await services.upload_to_assemblyai(str(path))
+    fake_assemblyai.processing_polls = 10_000  # polling alone would never finish
+
+    try:
+        result = await asyncio.wait_for(services.transcribe_with_assemblyai(audio_url), timeout=5)
+    finally:
+        await server.close()
+
+    assert result["utterances"][0]["text"] == "hello"
+    assert fake_assemblyai.polls == 1
+
+
+@pytest.mark.asyncio
+async def test_webhook_arriving_before_waiter_is_not_lost(fake_assemblyai, tmp_path, monkeypatch):
+    webhook = TranscriptWebhook(public_url="", secret="s3cret")
+    server = TestServer(webhook.app())
+    await server.start_server()
+    webhook.public_url = str(server.make_url("")).rstrip("/")
+    monkeypatch.setattr(services, "transcript_webhook", webhook)
+    monkeypatch.setattr(services, "POLL_WEBHOOK_FALLBACK_DELAY", 30)
+    path = tmp_path / "a.mp3"
+    path.write_text("A|0|1000|hello\n")
+    audio_url = await services.upload_to_assemblyai(str(path))
+    fake_assemblyai.processing_polls = 10_000
+    fake_assemblyai.notify_before_response = True
+    fake_assemblyai.webhook_delay = 0
+
+    try:
+        result = await asyncio.wait_for(services.transcribe_with_assemblyai(audio_url), timeout=5)
+    finally:
+        await server.close()
+
+    assert result["utterances"][0]["text"] == "hello"
+    assert fake_assemblyai.polls == 1
+    assert not webhook._early  # the buffered notification was consumed
+
+
+@pytest.mark.asyncio
+async def test_webhook_rejects_wrong_secret():
+    webhook = TranscriptWebhook(public_url="http://example", secret="s3cret")
+    server = TestServer(webhook.app())
+    await server.start_server()
+    waiter = webhook.expect("t1")
+    try:
+        async with httpx.AsyncClient() as client:
+            url = str(server.make_url("/assemblyai/webhook"))
+            bad = await client.post(url, headers={"X-WiseVoice-Webhook-Secret": "nope"}, json={"transcript_id": "t1"})
+            good = await client.post(url, headers={"X-WiseVoice-Webhook-Secret": "s3cret"},
+                                     json={"transcript_id": "t1", "status": "completed"})
+    finally:
+        await server.close()
+    assert bad.status_code == 401
+    assert good.status_code == 200
+    assert waiter.result() == "completed"
+
+
+def test_needs_seekable_input():
+    assert services.needs_seekable_input("audio/mp4", None)
+    assert services.needs_seekable_input(None, "Lecture.M4A")
+    assert not services.needs_seekable_input("audio/ogg", "voice.ogg")
+    assert not services.needs_seekable_input(None, None)
+
+
+@pytest.mark.asyncio
+async def test_transcode_stream_from_pipe(tmp_path, monkeypatch):
+    imageio_ffmpeg = pytest.importorskip("imageio_ffmpeg")
+    ffmpeg = shutil.which("ffmpeg") or imageio_ffmpeg.get_ffmpeg_exe()
+    monkeypatch.setattr(services, "FFMPEG_PATH", ffmpeg)
+    source = tmp_path / "stereo.wav"
+    subprocess.run([
+        ffmpeg, "-f", "lavfi", "-i", "sine=frequency=440:duration=3",
+        "-ac", "2", "-ar", "44100", "-y", str(source)
+    ], check=True, capture_output=True)
+    data = source.read_bytes()
+
+    async def chunks():
+        for start in range(0, len(data), 16 * 1024):
+            yield data[start:start + 16 * 1024]
+
+    output = await services.transcode_stream(chunks(), audio_format="opus")
+    try:
+        assert output.endswith(".ogg")
+        assert 0 < os.path.getsize(output) < len(data) / 10
+        probe = subprocess.run([ffmpeg, "-i", output], capture_output=True, text=True).stderr
+        # Opus всегда декодируется в 48 кГц, проверяем кодек и моно
+        assert "Audio: opus" in probe and "mono" in probe
+    finally:
+        os.remove(output)
+
+
+@pytest.mark.asyncio
+async def test_transcode_stream_rejects_garbage(monkeypatch):
+    imageio_ffmpeg = pytest.importorskip("imageio_ffmpeg")
+    monkeypatch.setattr(services, "FFMPEG_PATH", shutil.which("ffmpeg") or imageio_ffmpeg.get_ffmpeg_exe())
+    created = []
+    original = services.tempfile.NamedTemporaryFile
+
+    def tracking(*args, **kwargs):
+        handle = original(*args, **kwargs)
+        created.append(handle.name)
+        return handle
+
+    monkeypatch.setattr(services.tempfile, "NamedTemporaryFile", tracking)
+
+    async def chunks():
+        yield b"definitely not audio" * 100
+
+    with pytest.raises(RuntimeError):
+        await services.transcode_stream(chunks(), audio_format="mp3")
+    assert created and not os.path.exists(created[0])
+
+
+def test_parse_ffmpeg_probe_header():
+    stderr = (
+        "Input #0, mov,mp4,m4a,3gp,3g2,mj2, from 'clip.mp4':\n"
+        "  Duration: 00:01:02.50, start: 0.000000, bitrate: 900 kb/s\n"
+        "  Stream #0:0[0x1](und): Video: h264 (High) (avc1 / 0x31637661), yuv420p, 640x360\n"
+        "  Stream #0:1[0x2](und): Audio: aac (LC) (mp4a / 0x6134706D), 44100 Hz, stereo, fltp, 128 kb/s\n"
+    )
+    info = services._parse_ffmpeg_probe(stderr)
+    assert info == {
+        "format_name": "mov,mp4,m4a,3gp,3g2,mj2", "codec": "aac", "sample_rate": 44100,
+        "channels": 2, "duration": 62.5, "has_video": True,
+    }
+    cover = "Input #0, mp3, from 'a.mp3':\n  Stream #0:0: Audio: mp3 (mp3float), 44100 Hz, mono, fltp\n" \
+            "  Stream #0:1: Video: mjpeg (Baseline), yuvj420p, 500x500 (attached pic)\n"
+    assert services._parse_ffmpeg_probe(cover)["has_video"] is False
+
+
+@pytest.mark.parametrize("info, path, expected", [
+    ({"format_name": "mp3", "codec": "mp3", "sample_rate": 44100, "channels": 2}, "a.mp3", ("passthrough", ".mp3")),
+    ({"format_name": "ogg", "codec": "opus", "sample_rate": 48000, "channels": 1}, "voice.ogg", ("passthrough", ".ogg")),
+    ({"format_name": "mp3", "codec": "mp3", "sample_rate": 44100, "channels": 2}, "a.temp", ("copy", ".mp3")),
+    ({"format_name": "mov,mp4,m4a", "codec": "aac", "sample_rate": 44100, "channels": 2, "has_video": True},
+     "clip.mp4", ("copy", ".m4a")),
+    ({"format_name": "matroska,webm", "codec": "opus", "sample_rate": 48000, "channels": 2}, "a.webm", ("copy", ".ogg")),
+    ({"format_name": "wav", "codec": "pcm_s16le", "sample_rate": 44100, "channels": 2}, "a.wav", ("transcode", None)),
+    ({"format_name": "mp3", "codec": "mp3", "sample_rate": 44100, "channels": 6}, "a.mp3", ("transcode", None)),
+    ({"format_name": "ogg", "codec": "opus", "sample_rate": 96000, "channels": 1}, "a.ogg", ("transcode", None)),
+])
+def test_plan_audio_preparation(info, path, expected):
+    assert services.plan_audio_preparation(info, path) == expected
+
+
+@pytest.mark.asyncio
+async def test_prepare_audio_with_ffmpeg(tmp_path, monkeypatch):
+    imageio_ffmpeg = pytest.importorskip("imageio_ffmpeg")
+    ffmpeg = shutil.which("ffmpeg") or imageio_ffmpeg.get_ffmpeg_exe()
+    monkeypatch.setattr(services, "FFMPEG_PATH", ffmpeg)
+    monkeypatch.setattr(services, "FFPROBE_PATH", str(tmp_path / "missing-ffprobe"))
+
+    def make(name, *codec):
+        path = tmp_path / name
+        subprocess.run([ffmpeg, "-f", "lavfi", "-i", "sine=frequency=440:duration=2", *codec, "-y", str(path)],
+                       check=True, capture_output=True)
+        return str(path)
+
+    mp3 = make("voice.mp3", "-c:a", "libmp3lame")
+    assert await services.prepare_audio(mp3) == mp3
+
+    aac = make("clip.mp4", "-c:a", "aac")
+    copied = await services.prepare_audio(aac)
+    wav = make("raw.wav")
+    transcoded = await services.prepare_audio(wav)
+    try:
+        assert copied.endswith(".m4a")
+        assert (await services.probe_audio(copied))["codec"] == "aac"
+        assert transcoded != wav
+        assert (await services.probe_audio(transcoded))["channels"] == 1
+    finally:
+        os.remove(copied)
+        os.remove(transcoded)
+
+
+def test_chunk_by_token_budget_keeps_order_and_budget():
+    lines = [f"[{i:02}:00] " + "слово " * 50 for i in range(40)] + ["x" * 5000]
+    chunks = services.chunk_by_token_budget(lines, budget=400)
+    assert len(chunks) > 1
+    assert all(services.estimate_tokens(c) <= 400 for c in chunks)
+    joined = "\n\n".join(chunks)
+    assert joined.index("[00:00]") < joined.index("[39:00]") < joined.index("xxxx")
+    assert joined.count("x") == 5000
+
+
+@pytest.mark.asyncio
+async def test_summary_map_reduce_runs_chunks_concurrently_and_caches(monkeypatch):
+    monkeypatch.setattr(services, "_summary_cache", services.OrderedDict())
+    prompts = []
+    in_flight = 0
+    peak = 0
+
+    async def fake_llm(messages, model=None, temperature=0.2):
+        nonlocal in_flight, peak
+        prompt = messages[0]["content"]
+        prompts.append(prompt)
+        in_flight += 1
+        peak = max(peak, in_flight)
+        await asyncio.sleep(0.01)
+        in_flight -= 1
+        if "Тайм-коды\n00:00" in prompt:
+            return "Тайм-коды\n00:00 - Итог"
+        return f"00:00 - часть {prompt[60:80]}"
+
+    monkeypatch.setattr(services, "call_openrouter", fake_llm)
+    segments = [{"speaker": "A", "text": "много слов " * 100, "start": i * 60_000} for i in range(30)]
+    lines = services._timecode_lines(segments)
+
+    result = await services.summarise_hierarchically(lines, budget=1000, concurrency=3)
+    map_calls = [p for p in prompts if "фрагмент длинной расшифровки" in p]
+    assert result == "Тайм-коды\n00:00 - Итог"
+    assert len(map_calls) == len(services.chunk_by_token_budget(lines, 1000)) > 3
+    assert peak == 3
+    assert "Объедини" in prompts[-1]
+
+    calls = len(prompts)
+    assert await services.summarise_hierarchically(lines, budget=1000, concurrency=3) == result
+    assert len(prompts) == calls  # every chunk and the merge came from the cache
+
+
+@pytest.mark.asyncio
+async def test_short_transcript_uses_single_prompt(monkeypatch):
+    monkeypatch.setattr(services, "_summary_cache", services.OrderedDict())
+    llm = AsyncMock(return_value="Тайм-коды\n00:00 - Всё")
+    monkeypatch.setattr(services, "call_openrouter", llm)
+    result = await services.generate_summary_timecodes([{"speaker": "A", "text": "Коротко"}])
+    assert result == "Тайм-коды\n00:00 - Всё"
+    assert llm.await_count == 1
+    assert "[00:00] Коротко" in llm.await_args.args[0][0]["content"]
+
+
+def _assemblyai_words(text, start, step=400):
+    return [{"text": w, "start": start + i * step, "end": start + i * step + step - 50, "confidence": 0.9,
+             "speaker": "A"} for i, w in enumerate(text.split())]
+
+
+@pytest.mark.asyncio
+async def test_process_audio_file_keeps_real_offsets(monkeypatch, mocker):
+    monkeypatch.setattr(services, "TRANSCRIBE_CHUNKED", False)
+    monkeypatch.setattr(services, "transcript_cache", None)
+    mocker.patch("src.services.upload_to_assemblyai", return_value="https://cdn/a")
+    mocker.patch("src.services.transcribe_with_assemblyai", return_value={"utterances": [
+        {"speaker": "A", "text": "Добрый день", "start": 1200, "end": 2000, "words": _assemblyai_words("Добрый день", 1200)},
+        {"speaker": "B", "text": "Здравствуйте", "start": 3_725_000, "end": 3_726_000,
+         "words": _assemblyai_words("Здравствуйте", 3_725_000)},
+    ]})
+    segments = await services.process_audio_file("/tmp/x.ogg", user_id=1)
+    assert segments[0]["start"] == 1200 and segments[1]["end"] == 3_726_000
+    assert segments[0]["words"] == [[1200, 1550, "Добрый"], [1600, 1950, "день"]]
+    assert services.format_results_with_timecodes(segments) == (
+        "[00:01] Спикер A:\nДобрый день\n\n[1:02:05] Спикер B:\nЗдравствуйте"
+    )
+    assert services._timecode_lines(segments) == ["[00:01] Добрый день", "[1:02:05] Здравствуйте"]
+
+
+def test_subtitles_split_on_word_boundaries():
+    text = " ".join(f"слово{i}" for i in range(30))
+    segment = {"speaker": "A", "text": text, "start": 61_000, "end": 73_000,
+               "words": _assemblyai_words(text, 61_000)}
+    cues = list(services.iter_subtitle_cues([segment], max_chars=40, max_duration_ms=3000))
+    assert " ".join(c[2] for c in cues) == text
+    assert all(len(c[2]) <= 40 and c[1] - c[0] <= 3000 for c in cues)
+    assert cues[0][0] == 61_000
+
+    srt = next(services.iter_srt_blocks([segment]))
+    assert srt.startswith("1\n00:01:01,000 --> ")
+    vtt = list(services.iter_vtt_blocks([{"speaker": "A", "text": "Без слов", "start": 500, "end": 1500}]))
+    assert vtt == ["WEBVTT", "00:00:00.500 --> 00:00:01.500\nБез слов"]
+
+
+def _youtube_format(format_id, ext, acodec, abr, vcodec="none"):
+    return {"format_id": format_id, "ext": ext, "acodec": acodec, "abr": abr, "vcodec": vcodec,
+            "url": f"https://media.example/{format_id}", "protocol": "https"}
+
+
+@pytest.mark.parametrize("formats, expected", [
+    # smallest audio-only track that still meets YOUTUBE_AUDIO_MIN_ABR
+    ([("139", "m4a", "mp4a.40.5", 48.8), ("140", "m4a", "mp4a.40.2", 129.5), ("249", "webm", "opus", 50.1),
+      ("251", "webm", "opus", 130.0), ("599", "m4a", "mp4a.40.5", 30.8)], "139"),
+    ([("249", "webm", "opus", 50.1), ("251", "webm", "opus", 130.0)], "249"),
+])
+def test_youtube_passthrough_picks_smallest_adequate_audio(formats, expected):
+    yt_dlp = pytest.importorskip("yt_dlp")
+    info = {"id": "dQw4w9WgXcQ", "title": "t", "extractor": "youtube", "extractor_key": "Youtube",
+            "webpage_url": "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+            "formats": [_youtube_format(*f) for f in formats] + [_youtube_format("18", "mp4", "mp4a.40.2", 96, "avc1")]}
+    options = services.youtube_download_options("/tmp/unused.%(ext)s", passthrough=True)
+    assert "postprocessors" not in options
+    with yt_dlp.YoutubeDL(options) as ydl:
+        assert ydl.process_ie_result(info, download=False)["format_id"] == expected
+
+
+@pytest.mark.asyncio
+async def test_download_youtube_audio_remuxes_instead_of_reencoding(tmp_path, monkeypatch, mocker):
+    imageio_ffmpeg = pytest.importorskip("imageio_ffmpeg")
+    ffmpeg = shutil.which("ffmpeg") or imageio_ffmpeg.get_ffmpeg_exe()
+    monkeypatch.setattr(services, "FFMPEG_PATH", ffmpeg)
+    monkeypatch.setattr(services, "FFPROBE_PATH", str(tmp_path / "missing-ffprobe"))
+    monkeypatch.setattr(services, "YOUTUBE_AUDIO_PASSTHROUGH", True)
+    downloaded = []
+
+    class FakeYoutubeDL:
+        def __init__(self, options):
+            self.options = options
+
+        def __enter__(self):
+            return self
+
+        def __exit__(self, *exc):
+            return False
+
+        def extract_info(self, url, download):
+            path = self.options["outtmpl"].replace("%(ext)s", "webm")
+            subprocess.run([ffmpeg, "-f", "lavfi", "-i", "sine=frequency=440:duration=2", "-c:a", "libopus",
+                            "-y", path], check=True, capture_output=True)
+            downloaded.append(path)
+            return {"requested_downloads": [{"filepath": path, "format_id": "249", "acodec": "opus",
+                                             "abr": 50.1, "ext": "webm"}]}
+
+    yt_dlp = pytest.importorskip("yt_dlp")
+    mocker.patch.object(yt_dlp, "YoutubeDL", FakeYoutubeDL)
+    result = await services.download_youtube_audio("https://youtu.be/dQw4w9WgXcQ")
+    try:
+        assert result.endswith(".ogg")
+        assert (await services.probe_audio(result))["codec"] == "opus"
+        assert not os.path.exists(downloaded[0])  # the .webm original is cleaned up
+    finally:
+        os.remove(result)
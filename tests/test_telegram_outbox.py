@@ -0,0 +1,133 @@
+import asyncio
+import time
+
+import pytest
+import pytest_asyncio
+from aiogram import Bot
+from aiogram.client.session.base import BaseSession
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.methods import GetMe
+
+from src.telegram_outbox import TelegramOutbox, ProgressEditDropped, progress_edits
+
+
+class FakeSession(BaseSession):
+    """Сессия без сети: записывает запросы, может ответить 429."""
+
+    def __init__(self):
+        super().__init__()
+        self.calls = []
+        self.flood_waits = 0
+
+    async def make_request(self, bot, method, timeout=None):
+        if self.flood_waits:
+            self.flood_waits -= 1
+            raise TelegramRetryAfter(method=method, message="Too Many Requests", retry_after=1)
+        self.calls.append((time.monotonic(), method))
+        return True
+
+    async def stream_content(self, url, headers=None, timeout=30, chunk_size=65536, raise_for_status=True):
+        yield b""
+
+    async def close(self):
+        pass
+
+    def sent(self, kind=None):
+        return [type(m).__name__ if kind is None else getattr(m, kind, None) for _, m in self.calls]
+
+
+@pytest_asyncio.fixture
+async def make_bot():
+    outboxes = []
+
+    def factory(**limits):
+        outbox = TelegramOutbox(**{"global_rate": 100, "chat_rate": 100, "chat_burst": 1, **limits})
+        outboxes.append(outbox)
+        session = FakeSession()
+        session.middleware(outbox)
+        return Bot(token="42:TEST", session=session), session, outbox
+
+    yield factory
+    for outbox in outboxes:
+        await outbox.aclose(timeout=0)
+
+
+@pytest.mark.asyncio
+async def test_chat_bucket_does_not_block_other_chats(make_bot):
+    bot, session, outbox = make_bot(chat_rate=10)
+    started = time.monotonic()
+    await asyncio.gather(*(bot.send_message(1, f"m{i}") for i in range(3)), bot.send_message(2, "other"))
+
+    times = {m.text: t - started for t, m in session.calls}
+    assert times["other"] < 0.05
+    assert times["m2"] >= 0.18  # 1 + 2 waits of 1/10 s
+
+
+@pytest.mark.asyncio
+async def test_global_bucket_limits_all_chats(make_bot):
+    bot, session, outbox = make_bot(global_rate=20)
+    started = time.monotonic()
+    await asyncio.gather(*(bot.send_message(chat, "hi") for chat in range(1, 23)))
+    # 20 tokens of burst, then one every 1/20 s
+    assert session.calls[19][0] - started < 0.05
+    assert session.calls[-1][0] - started >= 0.09
+    assert outbox.stats()["sent"] == 22
+
+
+@pytest.mark.asyncio
+async def test_results_go_before_progress_edits(make_bot):
+    bot, session, outbox = make_bot(chat_rate=20)
+    await bot.send_message(1, "first")  # spends the chat token
+
+    async def progress(message_id):
+        with progress_edits():
+            await bot.edit_message_text("50%", chat_id=1, message_id=message_id)
+
+    edits = [asyncio.create_task(progress(i)) for i in (10, 11)]
+    await asyncio.sleep(0)
+    await bot.send_document(1, "file_id")
+    await asyncio.gather(*edits)
+
+    assert session.sent() == ["SendMessage", "SendDocument", "EditMessageText", "EditMessageText"]
+
+
+@pytest.mark.asyncio
+async def test_stale_progress_edits_are_dropped(make_bot):
+    bot, session, outbox = make_bot(chat_rate=20)
+    await bot.send_message(1, "first")
+
+    async def progress(text):
+        with progress_edits():
+            await bot.edit_message_text(text, chat_id=1, message_id=10)
+
+    older = asyncio.create_task(progress("10%"))
+    await asyncio.sleep(0)
+    newer = asyncio.create_task(progress("20%"))
+    await asyncio.sleep(0)
+    with pytest.raises(ProgressEditDropped):
+        await older
+    await bot.edit_message_text("Готово", chat_id=1, message_id=10)  # final edit supersedes progress
+    with pytest.raises(ProgressEditDropped):
+        await newer
+
+    assert session.sent("text") == ["first", "Готово"]
+    assert outbox.stats()["dropped"] == 2
+
+
+@pytest.mark.asyncio
+async def test_retry_after_pauses_chat_and_retries(make_bot):
+    bot, session, outbox = make_bot()
+    session.flood_waits = 1
+    started = time.monotonic()
+
+    assert await bot.send_message(1, "hi") is True
+    assert session.calls[0][0] - started >= 0.95
+    assert outbox.stats()["retried"] == 1
+
+
+@pytest.mark.asyncio
+async def test_requests_without_chat_bypass_queue(make_bot):
+    bot, session, outbox = make_bot()
+    assert await bot(GetMe()) is True
+    assert outbox.stats()["sent"] == 0
+    assert session.sent() == ["GetMe"]
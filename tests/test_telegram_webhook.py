@@ -0,0 +1,94 @@
+import asyncio
+
+import pytest
+import pytest_asyncio
+from aiohttp.test_utils import TestClient, TestServer
+from aiogram import Bot, Dispatcher
+from aiogram.types import Message
+
+from src.telegram_webhook import TelegramWebhook, WEBHOOK_PATH, SECRET_HEADER
+
+
+def synthetic_update(update_id: int, text: str) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": 1700000000,
+            "chat": {"id": 42, "type": "private"},
+            "from": {"id": 42, "is_bot": False, "first_name": "Test"},
+            "text": text,
+        },
+    }
+
+
+@pytest_asyncio.fixture
+async def webhook():
+    received = []
+    release = asyncio.Event()
+    release.set()
+    dp = Dispatcher()
+
+    @dp.message()
+    async def record(message: Message):
+        await release.wait()
+        received.append(message.text)
+
+    hook = TelegramWebhook(Bot(token="42:TEST"), dp, public_url="https://bot.example", secret="s3cret",
+                           workers=2, max_queue=2)
+    hook.start_workers()
+    client = TestClient(TestServer(hook.app()))
+    await client.start_server()
+    hook.received, hook.release = received, release
+    yield hook, client
+    await hook.drain(timeout=1)
+    await client.close()
+
+
+@pytest.mark.asyncio
+async def test_webhook_feeds_updates_to_dispatcher(webhook):
+    hook, client = webhook
+    for i, text in enumerate(("/start", "привет"), start=1):
+        response = await client.post(WEBHOOK_PATH, json=synthetic_update(i, text), headers={SECRET_HEADER: "s3cret"})
+        assert response.status == 200
+
+    for _ in range(50):
+        if len(hook.received) == 2:
+            break
+        await asyncio.sleep(0.01)
+    assert sorted(hook.received) == ["/start", "привет"]
+    assert hook.url == "https://bot.example/telegram/webhook"
+
+
+@pytest.mark.asyncio
+async def test_webhook_rejects_bad_secret_and_payload(webhook):
+    hook, client = webhook
+    response = await client.post(WEBHOOK_PATH, json=synthetic_update(1, "x"), headers={SECRET_HEADER: "wrong"})
+    assert response.status == 401
+    response = await client.post(WEBHOOK_PATH, data=b"not json", headers={SECRET_HEADER: "s3cret"})
+    assert response.status == 400
+    await asyncio.sleep(0.05)
+    assert hook.received == []
+
+
+@pytest.mark.asyncio
+async def test_webhook_queue_bound_and_drain(webhook):
+    hook, client = webhook
+    hook.release.clear()  # handlers block: 2 busy workers + 2 queued fill the webhook
+    statuses = []
+    for i in range(1, 6):
+        response = await client.post(WEBHOOK_PATH, json=synthetic_update(i, f"m{i}"), headers={SECRET_HEADER: "s3cret"})
+        statuses.append(response.status)
+        await asyncio.sleep(0.01)
+    assert statuses == [200, 200, 200, 200, 503]
+
+    drain = asyncio.create_task(hook.drain(timeout=5))
+    await asyncio.sleep(0.05)
+    response = await client.post(WEBHOOK_PATH, json=synthetic_update(9, "late"), headers={SECRET_HEADER: "s3cret"})
+    assert response.status == 503  # draining: Telegram retries elsewhere
+    assert not drain.done()
+
+    hook.release.set()
+    await drain
+    assert sorted(hook.received) == ["m1", "m2", "m3", "m4"]
+    assert hook.pending == 0
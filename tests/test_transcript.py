@@ -0,0 +1,66 @@
+import json
+import sys
+
+from src.transcript import Transcript, as_transcript
+
+
+def _utterances(count, words_per=20):
+    utterances = []
+    t = 0
+    for i in range(count):
+        words = []
+        for w in range(words_per):
+            words.append({"text": f"слово{w}", "start": t, "end": t + 300, "confidence": 0.97,
+                          "speaker": "AB"[i % 2]})
+            t += 350
+        utterances.append({"speaker": "AB"[i % 2], "text": " ".join(x["text"] for x in words),
+                           "start": words[0]["start"], "end": words[-1]["end"], "confidence": 0.95, "words": words})
+    return utterances
+
+
+def test_columns_and_views_match_source():
+    utterances = _utterances(3, words_per=4)
+    transcript = Transcript.from_segments(utterances)
+    assert len(transcript) == 3
+    assert transcript.speakers == ["A", "B"]
+    assert list(transcript.speaker_ids) == [0, 1, 0]
+    seg = transcript[1]
+    assert seg["speaker"] == "B" and seg.get("text") == utterances[1]["text"]
+    assert seg["start"] == utterances[1]["start"] and transcript[-1]["end"] == utterances[2]["end"]
+    assert seg["words"][0] == [utterances[1]["words"][0]["start"], utterances[1]["words"][0]["end"], "слово0"]
+    assert seg.get("missing", "x") == "x"
+    assert [row[3] for row in transcript.rows()] == [u["text"] for u in utterances]
+
+
+def test_legacy_segments_and_serialisation_roundtrip():
+    legacy = [{"speaker": "A", "text": "  Привет  "}, {"speaker": "?", "text": "", "words": [[5, 9, "эх"]]}]
+    transcript = as_transcript(legacy)
+    assert transcript.to_segments() == [
+        {"speaker": "A", "text": "Привет", "start": 0, "end": 0, "words": []},
+        {"speaker": "?", "text": "", "start": 5, "end": 9, "words": [[5, 9, "эх"]]},
+    ]
+    assert as_transcript(transcript) is transcript
+    restored = Transcript.from_dict(json.loads(json.dumps(transcript.to_dict())))
+    assert restored == transcript
+    assert not Transcript() and not Transcript.from_segments([{"text": "   "}]).has_text()
+
+
+def test_columnar_store_is_much_smaller_than_dicts():
+    """Multi-hour transcripts: the columnar form costs a fraction of AssemblyAI's dicts."""
+    utterances = _utterances(500, words_per=40)
+
+    def deep_size(obj, seen=None):
+        seen = seen if seen is not None else set()
+        if id(obj) in seen:
+            return 0
+        seen.add(id(obj))
+        size = sys.getsizeof(obj)
+        if isinstance(obj, dict):
+            size += sum(deep_size(k, seen) + deep_size(v, seen) for k, v in obj.items())
+        elif isinstance(obj, (list, tuple)):
+            size += sum(deep_size(v, seen) for v in obj)
+        return size
+
+    transcript = Transcript.from_segments(utterances)
+    columnar = sum(deep_size(getattr(transcript, name)) for name in Transcript.__slots__)
+    assert columnar * 5 < deep_size(utterances)
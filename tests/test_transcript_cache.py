@@ -0,0 +1,146 @@
+import os
+import pytest
+import pytest_asyncio
+
+from src import services
+from src import transcript_cache
+from src.transcript import Transcript
+from src.transcript_cache import TranscriptCache, youtube_cache_key, youtube_video_id, audio_cache_key
+
+
+@pytest_asyncio.fixture
+async def cache(tmp_path):
+    cache = TranscriptCache(str(tmp_path / "transcripts.db"), max_bytes=1024 * 1024)
+    await cache.open()
+    yield cache
+    cache.close()
+
+
+@pytest.mark.parametrize("url", [
+    "https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+    "https://youtube.com/watch?v=dQw4w9WgXcQ&t=42s&list=PL123",
+    "https://youtu.be/dQw4w9WgXcQ?si=abc",
+    "https://m.youtube.com/shorts/dQw4w9WgXcQ",
+    "https://www.youtube.com/embed/dQw4w9WgXcQ",
+])
+def test_youtube_video_id_canonicalises_links(url):
+    assert youtube_video_id(url) == "dQw4w9WgXcQ"
+    assert youtube_cache_key(url) == f"v{transcript_cache.CACHE_VERSION}:youtube:dQw4w9WgXcQ"
+
+
+@pytest.mark.parametrize("url", ["https://example.com/watch?v=dQw4w9WgXcQ", "https://youtu.be/short", "not a url"])
+def test_youtube_video_id_rejects_other_links(url):
+    assert youtube_video_id(url) is None
+
+
+@pytest.mark.asyncio
+async def test_audio_cache_key_depends_on_content(tmp_path):
+    a, b, c = tmp_path / "a.ogg", tmp_path / "b.ogg", tmp_path / "c.ogg"
+    a.write_bytes(b"voice note")
+    b.write_bytes(b"voice note")
+    c.write_bytes(b"other note")
+    assert await audio_cache_key(str(a)) == await audio_cache_key(str(b))
+    assert await audio_cache_key(str(a)) != await audio_cache_key(str(c))
+
+
+@pytest.mark.asyncio
+async def test_put_get_roundtrip_survives_reopen(cache, tmp_path):
+    segments = Transcript.from_segments([
+        {"speaker": "A", "text": "Привет", "start": 0, "end": 900, "words": [[0, 900, "Привет"]]},
+        {"speaker": "B", "text": "Здравствуйте", "start": 1000, "end": 2000},
+    ])
+    await cache.put("k1", segments)
+    assert await cache.get("k1") == segments
+    assert await cache.get("missing") is None
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    cache.close()
+    reopened = TranscriptCache(str(tmp_path / "transcripts.db"))
+    try:
+        assert await reopened.get("k1") == segments
+    finally:
+        reopened.close()
+
+
+@pytest.mark.asyncio
+async def test_size_bound_evicts_least_recently_used(cache):
+    # Random payloads so every entry compresses to roughly the same size
+    entry = lambda: Transcript.from_segments([{"speaker": "A", "text": os.urandom(3000).hex()}])
+    await cache.put("old", entry())
+    await cache.put("used", entry())
+    size = await cache.total_size()
+    cache.max_bytes = int(size * 1.2)  # fits two entries, not three
+
+    assert await cache.get("old") is not None  # "old" becomes the most recently used
+    await cache.put("new", entry())
+
+    assert await cache.get("used") is None
+    assert await cache.get("old") is not None
+    assert await cache.get("new") is not None
+    assert await cache.total_size() <= cache.max_bytes
+
+
+@pytest.mark.asyncio
+async def test_process_audio_file_reuses_cached_transcript(cache, tmp_path, monkeypatch, mocker):
+    audio = tmp_path / "voice.ogg"
+    audio.write_bytes(b"same bytes")
+    monkeypatch.setattr(services, "transcript_cache", cache)
+    monkeypatch.setattr(services, "TRANSCRIBE_CHUNKED", False)
+    upload = mocker.patch("src.services.upload_to_assemblyai", return_value="https://cdn/audio")
+    transcribe = mocker.patch("src.services.transcribe_with_assemblyai",
+                              return_value={"utterances": [{"speaker": "A", "text": "Привет"}]})
+
+    first = await services.process_audio_file(str(audio), user_id=1)
+    second = await services.process_audio_file(str(audio), user_id=2)
+
+    assert first == second == [{"speaker": "A", "text": "Привет", "start": 0, "end": 0, "words": []}]
+    assert upload.await_count == 1
+    assert transcribe.await_count == 1
+
+    await services.process_audio_file(str(audio), user_id=3, cache_key="v1:youtube:dQw4w9WgXcQ")
+    assert await cache.get("v1:youtube:dQw4w9WgXcQ") == first
+
+
+@pytest.mark.asyncio
+async def test_same_telegram_upload_hits_cache_after_transcoding(cache, tmp_path, monkeypatch, mocker):
+    import shutil
+    import subprocess
+    from unittest.mock import AsyncMock, MagicMock
+    from src import handlers
+
+    imageio_ffmpeg = pytest.importorskip("imageio_ffmpeg")
+    ffmpeg = shutil.which("ffmpeg") or imageio_ffmpeg.get_ffmpeg_exe()
+    monkeypatch.setattr(services, "FFMPEG_PATH", ffmpeg)
+    monkeypatch.setattr(services, "transcript_cache", cache)
+    monkeypatch.setattr(services, "TRANSCRIBE_CHUNKED", False)
+    source = tmp_path / "voice.wav"
+    subprocess.run([ffmpeg, "-f", "lavfi", "-i", "sine=frequency=440:duration=2", "-y", str(source)],
+                   check=True, capture_output=True)
+    data = source.read_bytes()
+
+    async def stream_content(**kwargs):
+        for start in range(0, len(data), 16 * 1024):
+            yield data[start:start + 16 * 1024]
+
+    bot = MagicMock()
+    bot.session.api.is_local = False
+    bot.session.stream_content = stream_content
+    bot.get_file = AsyncMock(return_value=MagicMock(file_path="voice.wav"))
+    upload = MagicMock(file_id="f", mime_type="audio/wav", file_name="voice.wav")
+    mocker.patch("src.services.upload_to_assemblyai", return_value="https://cdn/audio")
+    transcribe = mocker.patch("src.services.transcribe_with_assemblyai",
+                              return_value={"utterances": [{"speaker": "A", "text": "Привет"}]})
+
+    # Ogg/Opus от ffmpeg меняется от запуска к запуску — ключ должен браться по исходнику
+    keys = []
+    for user_id in (1, 2):
+        audio_path, key = await handlers.ingest_telegram_file(bot, upload)
+        try:
+            await services.process_audio_file(audio_path, user_id, cache_key=key)
+        finally:
+            os.remove(audio_path)
+        keys.append(key)
+
+    assert keys[0] == keys[1]
+    assert transcribe.await_count == 1
+    assert cache.hits == 1
@@ -1,3 +1,6 @@
+import asyncio
+from unittest.mock import AsyncMock, MagicMock
+
 import pytest
 from aiogram.types import InlineKeyboardMarkup
 
@@ -83,3 +86,70 @@ def test_ensure_user_settings():
     
     # Clean up
     del ui.user_settings[user_id]
+
+
+def _progress_message(chat_id=1, message_id=10):
+    message = MagicMock()
+    message.chat.id = chat_id
+    message.message_id = message_id
+    message.edit_text = AsyncMock()
+    return message
+
+
+@pytest.mark.asyncio
+async def test_progress_updates_coalesce_without_blocking():
+    manager = ui.ProgressManager(min_interval=0.2, edits_per_second=100, idle_timeout=5)
+    message = _progress_message()
+
+    for value in (0.1, 0.2, 0.4, 0.5):
+        await manager.update_progress(value, message)
+    assert message.edit_text.await_count == 0  # producer never waits for Telegram
+    await asyncio.sleep(0.05)
+    assert message.edit_text.await_count == 1
+    assert "50%" in message.edit_text.await_args.args[0]
+
+    for value in (0.55, 0.6, 0.65):
+        await manager.update_progress(value, message)
+    await asyncio.sleep(0.1)
+    assert message.edit_text.await_count == 1  # still inside min_interval
+    await asyncio.sleep(0.2)
+    assert message.edit_text.await_count == 2
+    assert "65%" in message.edit_text.await_args.args[0]
+    await manager.aclose()
+
+
+@pytest.mark.asyncio
+async def test_progress_edits_share_global_rate_limit():
+    manager = ui.ProgressManager(min_interval=0, edits_per_second=10, idle_timeout=5)
+    messages = [_progress_message(chat_id=i, message_id=i) for i in range(5)]
+    for message in messages:
+        await manager.update_progress(0.5, message)
+    await asyncio.sleep(0.25)
+    assert sum(m.edit_text.await_count for m in messages) == 3  # at t=0, 0.1, 0.2
+    await asyncio.sleep(0.25)
+    assert all(m.edit_text.await_count == 1 for m in messages)
+    await manager.aclose()
+
+
+@pytest.mark.asyncio
+async def test_progress_finish_evicts_and_drops_pending_updates():
+    manager = ui.ProgressManager(min_interval=10, edits_per_second=100, idle_timeout=5)
+    message = _progress_message()
+    await manager.update_progress(0.1, message)
+    await asyncio.sleep(0.01)
+    await manager.update_progress(0.5, message)  # throttled, waits for min_interval
+    assert manager.tracked == 1
+
+    await manager.finish(message)
+    assert manager.tracked == 0
+    await asyncio.sleep(0.01)
+    assert message.edit_text.await_count == 1
+
+
+@pytest.mark.asyncio
+async def test_progress_actor_evicts_itself_when_idle():
+    manager = ui.ProgressManager(min_interval=0, edits_per_second=100, idle_timeout=0.05)
+    await manager.update_progress("Готово почти", _progress_message())
+    assert manager.tracked == 1
+    await asyncio.sleep(0.15)
+    assert manager.tracked == 0
@@ -0,0 +1,219 @@
+import asyncio
+import pytest
+
+from src import youtube
+from src.youtube import YoutubeMetadata, YoutubeProbe, YoutubeProbeError
+
+
+def _info(video_id="dQw4w9WgXcQ", duration=3600, **extra):
+    return {"id": video_id, "title": "Лекция", "duration": duration, "format_id": "249", "abr": 50.0,
+            "formats": [
+                {"format_id": "249", "ext": "webm", "acodec": "opus", "vcodec": "none", "abr": 50.0},
+                {"format_id": "18", "ext": "mp4", "acodec": "mp4a.40.2", "vcodec": "avc1", "tbr": 500.0},
+            ], **extra}
+
+
+def test_metadata_estimates_size_from_bitrate_when_filesize_unknown():
+    metadata = YoutubeMetadata(_info())
+    assert metadata.estimated_size == int(50.0 * 1000 / 8 * 3600)
+    assert [f["format_id"] for f in metadata.audio_formats] == ["249"]
+    assert not metadata.is_live
+
+    assert YoutubeMetadata(_info(filesize=12345)).estimated_size == 12345
+    assert YoutubeMetadata(_info(duration=None)).estimated_size is None
+    assert YoutubeMetadata(_info(live_status="is_live")).is_live
+
+
+@pytest.mark.asyncio
+async def test_probe_caches_by_video_id_across_url_forms():
+    calls = []
+
+    def extract(url):
+        calls.append(url)
+        return _info()
+
+    probe = YoutubeProbe(ttl=60, extract=extract)
+    first = await probe.probe("https://www.youtube.com/watch?v=dQw4w9WgXcQ")
+    second = await probe.probe("https://youtu.be/dQw4w9WgXcQ?t=42")
+    assert first is second
+    assert len(calls) == 1
+
+
+@pytest.mark.asyncio
+async def test_probe_entries_expire_and_failures_are_not_cached(monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(youtube.time, "monotonic", lambda: now[0])
+    results = [YoutubeProbeError("Video unavailable"), _info(), _info(duration=10)]
+
+    def extract(url):
+        result = results.pop(0)
+        if isinstance(result, Exception):
+            raise result
+        return result
+
+    probe = YoutubeProbe(ttl=60, extract=extract)
+    with pytest.raises(YoutubeProbeError):
+        await probe.probe("https://youtu.be/dQw4w9WgXcQ")
+    assert (await probe.probe("https://youtu.be/dQw4w9WgXcQ")).duration == 3600
+    now[0] += 61
+    assert (await probe.probe("https://youtu.be/dQw4w9WgXcQ")).duration == 10
+
+
+@pytest.mark.asyncio
+async def test_concurrent_probes_share_one_extraction():
+    calls = []
+
+    def extract(url):
+        calls.append(url)
+        import time
+        time.sleep(0.05)
+        return _info()
+
+    probe = YoutubeProbe(extract=extract)
+    results = await asyncio.gather(*(probe.probe("https://youtu.be/dQw4w9WgXcQ") for _ in range(5)))
+    assert len(calls) == 1
+    assert all(r is results[0] for r in results)
+
+
+@pytest.mark.asyncio
+async def test_probe_runs_yt_dlp_on_its_own_threads():
+    import threading
+    threads = []
+
+    def extract(url):
+        threads.append(threading.current_thread().name)
+        return _info()
+
+    probe = YoutubeProbe(extract=extract, workers=1)
+    await probe.probe("https://youtu.be/dQw4w9WgXcQ")
+    probe.shutdown()
+    assert threads[0].startswith("yt-dlp-probe")
+
+
+@pytest.mark.asyncio
+async def test_probe_bounds_cache_size():
+    probe = YoutubeProbe(max_entries=2, extract=lambda url: _info(video_id=url[-11:]))
+    for video_id in ("aaaaaaaaaaa", "bbbbbbbbbbb", "ccccccccccc"):
+        await probe.probe(f"https://youtu.be/{video_id}")
+    assert probe.get_cached("https://youtu.be/aaaaaaaaaaa") is None
+    assert probe.get_cached("https://youtu.be/ccccccccccc") is not None
+
+
+def _fake_fetch(tmp_path, gate: asyncio.Event, calls: list, active: list | None = None):
+    async def fetch(progress, cancelled, executor):
+        calls.append(cancelled)
+        if active is not None:
+            active.append(1)
+        try:
+            await progress(50.0)
+            await gate.wait()
+            path = tmp_path / f"download-{len(calls)}.ogg"
+            path.write_bytes(b"audio")
+            return str(path)
+        finally:
+            if active is not None:
+                active.pop()
+    return fetch
+
+
+@pytest.mark.asyncio
+async def test_same_video_is_downloaded_once_and_each_caller_gets_own_file(tmp_path):
+    manager = youtube.DownloadManager(workers=2)
+    gate, calls, seen = asyncio.Event(), [], []
+
+    async def on_progress(percent):
+        seen.append(percent)
+
+    first = asyncio.create_task(manager.download("https://youtu.be/dQw4w9WgXcQ", _fake_fetch(tmp_path, gate, calls),
+                                                 on_progress))
+    await asyncio.sleep(0)
+    second = asyncio.create_task(manager.download("https://www.youtube.com/watch?v=dQw4w9WgXcQ",
+                                                  _fake_fetch(tmp_path, gate, calls)))
+    await asyncio.sleep(0.01)
+    assert manager.stats()["subscribers"] == 2
+    gate.set()
+    paths = await asyncio.gather(first, second)
+
+    assert len(calls) == 1
+    assert seen == [50.0]
+    assert paths[0] != paths[1]
+    assert all(open(p, "rb").read() == b"audio" for p in paths)
+    assert not (tmp_path / "download-1.ogg").exists()  # the shared original is gone once both claimed
+    assert manager.stats()["deduplicated"] == 1
+    await manager.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_concurrency_cap_and_queue_limit(tmp_path):
+    manager = youtube.DownloadManager(workers=1, max_queue=1)
+    gate, calls, active, peak = asyncio.Event(), [], [], []
+
+    async def watch():
+        while True:
+            peak.append(len(active))
+            await asyncio.sleep(0.001)
+
+    watcher = asyncio.create_task(watch())
+    running = asyncio.create_task(manager.download("https://youtu.be/aaaaaaaaaaa",
+                                                   _fake_fetch(tmp_path, gate, calls, active)))
+    waiting = asyncio.create_task(manager.download("https://youtu.be/bbbbbbbbbbb",
+                                                   _fake_fetch(tmp_path, gate, calls, active)))
+    await asyncio.sleep(0.01)
+    assert (manager.running, manager.queued) == (1, 1)
+    with pytest.raises(youtube.DownloadQueueFull):
+        await manager.download("https://youtu.be/ccccccccccc", _fake_fetch(tmp_path, gate, calls, active))
+
+    gate.set()
+    await asyncio.gather(running, waiting)
+    watcher.cancel()
+    assert max(peak) == 1
+    assert manager.stats()["completed"] == 2
+    await manager.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_download_is_cancelled_when_last_caller_leaves(tmp_path):
+    manager = youtube.DownloadManager(workers=1)
+    gate, calls = asyncio.Event(), []
+    caller = asyncio.create_task(manager.download("https://youtu.be/dQw4w9WgXcQ", _fake_fetch(tmp_path, gate, calls)))
+    await asyncio.sleep(0.01)
+
+    caller.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await caller
+    await asyncio.sleep(0)
+
+    assert calls[0].is_set()  # the yt-dlp progress hook sees this and aborts the transfer
+    assert manager.stats()["cancelled"] == 1
+    assert (manager.running, manager.queued) == (0, 0)
+    await manager.shutdown()
+
+
+@pytest.mark.asyncio
+async def test_claimed_link_is_removed_when_caller_is_cancelled_mid_claim(tmp_path, monkeypatch):
+    import threading
+    import time
+
+    manager = youtube.DownloadManager(workers=1)
+    gate, calls = asyncio.Event(), []
+    linked = threading.Event()
+    real_link = youtube.os.link
+
+    def slow_link(src, dst):
+        real_link(src, dst)
+        linked.set()
+        time.sleep(0.2)  # the caller is cancelled before the path is handed back
+
+    monkeypatch.setattr(youtube.os, "link", slow_link)
+    caller = asyncio.create_task(manager.download("https://youtu.be/dQw4w9WgXcQ", _fake_fetch(tmp_path, gate, calls)))
+    gate.set()
+    while not linked.is_set():
+        await asyncio.sleep(0.01)
+
+    caller.cancel()
+    with pytest.raises(asyncio.CancelledError):
+        await caller
+    await asyncio.sleep(0.4)
+
+    assert list(tmp_path.iterdir()) == []
+    await manager.shutdown()